@@ -0,0 +1,136 @@
+from collections import deque
+from typing import Any, Callable, Deque, Tuple
+import asyncio
+import os
+
+from fastapi import HTTPException
+
+from celery_app import BULK_QUEUE, FAST_QUEUE
+from executor import ExecutorBusy
+from tools.file_io import InputTooLarge, JobCost
+
+# Estimated peak memory that the PDF jobs of one API worker may use at once
+MEMORY_BUDGET_BYTES = int(os.environ.get("MEMORY_BUDGET_BYTES", str(1024 * 1024 * 1024)))
+# Larger synchronous requests are handed to the Celery large-job lane
+SYNC_MAX_JOB_BYTES = int(os.environ.get("SYNC_MAX_JOB_BYTES", str(MEMORY_BUDGET_BYTES // 2)))
+# Requests estimated above this are refused outright (413)
+MAX_JOB_BYTES = int(os.environ.get("MAX_JOB_BYTES", str(4 * 1024 * 1024 * 1024)))
+# How long an admitted request may wait for budget before it gets a 503
+ADMISSION_WAIT = float(os.environ.get("ADMISSION_WAIT", "30"))
+# Jobs above any of these (or above SYNC_MAX_JOB_BYTES) run in the bulk lane
+FAST_MAX_BYTES = int(os.environ.get("FAST_MAX_BYTES", str(20 * 1024 * 1024)))
+FAST_MAX_PAGES = int(os.environ.get("FAST_MAX_PAGES", "50"))
+FAST_MAX_PIXELS = int(os.environ.get("FAST_MAX_PIXELS", str(200_000_000)))
+
+
+async def estimate_cost(estimator: Callable[..., JobCost], *args: Any, **kwargs: Any) -> JobCost:
+    """
+    Run a tool's estimate_cost (header inspection only) in a thread.
+    Inputs that are too large, or whose memory estimate exceeds
+    MAX_JOB_BYTES, are refused with 413 and unreadable ones with 400.
+    """
+    try:
+        cost = await asyncio.to_thread(estimator, *args, **kwargs)
+    except InputTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if cost.memory > MAX_JOB_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Request would need about {cost.memory // 2**20} MiB of memory; "
+                   f"the limit is {MAX_JOB_BYTES // 2**20} MiB",
+        )
+    return cost
+
+
+def job_queue(cost: JobCost) -> str:
+    """Celery queue (lane) for a job: bulk if any part of its cost is above the fast lane's limits."""
+    if (
+        cost.memory > SYNC_MAX_JOB_BYTES
+        or cost.input_bytes > FAST_MAX_BYTES
+        or cost.pages > FAST_MAX_PAGES
+        or cost.pixels > FAST_MAX_PIXELS
+    ):
+        return BULK_QUEUE
+    return FAST_QUEUE
+
+
+class Reservation:
+    """Memory reserved for one job; released exactly once."""
+
+    def __init__(self, budget: "MemoryBudget", amount: int):
+        self._budget = budget
+        self.amount = amount
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._budget._release(self.amount)
+
+
+class MemoryBudget:
+    """
+    Admits jobs against a per-process budget of estimated peak memory.
+
+    A job whose estimate fits in what is left starts right away; otherwise
+    it waits, in arrival order, until running jobs release enough, and gets
+    ExecutorBusy (503 + Retry-After) if that takes longer than wait_timeout.
+    Estimates above the whole budget are capped to it, so such a job runs
+    alone instead of never being admitted. Only used from the event loop.
+    """
+
+    def __init__(self, capacity: int, wait_timeout: float, retry_after: int = 5):
+        self.capacity = capacity
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self.reserved = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+    async def reserve(self, estimate: int) -> Reservation:
+        amount = min(max(estimate, 0), self.capacity)
+        if not self._waiters and self.reserved + amount <= self.capacity:
+            self.reserved += amount
+            return Reservation(self, amount)
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (amount, waiter)
+        self._waiters.append(entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.wait_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as we gave up: hand it back
+                self._release(amount)
+            else:
+                waiter.cancel()
+                self._waiters.remove(entry)
+                self._grant()
+            if isinstance(e, asyncio.TimeoutError):
+                raise ExecutorBusy(self.retry_after)
+            raise
+        return Reservation(self, amount)
+
+    def _release(self, amount: int) -> None:
+        self.reserved -= amount
+        self._grant()
+
+    def _grant(self) -> None:
+        while self._waiters:
+            amount, waiter = self._waiters[0]
+            if self.reserved + amount > self.capacity:
+                break
+            self._waiters.popleft()
+            self.reserved += amount
+            waiter.set_result(None)
+
+    def stats(self) -> dict:
+        return {"capacity": self.capacity, "reserved": self.reserved, "waiting": len(self._waiters)}
+
+
+memory_budget = MemoryBudget(
+    MEMORY_BUDGET_BYTES,
+    ADMISSION_WAIT,
+    retry_after=int(os.environ.get("PDF_EXECUTOR_RETRY_AFTER", "5")),
+)
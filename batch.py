@@ -0,0 +1,238 @@
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple
+import io
+import json
+import os
+import posixpath
+import time
+import uuid
+import zipfile
+
+from tools.file_io import InputTooLarge
+from uploads import (
+    ALLOWED_IMAGE_EXTENSIONS,
+    MAX_UPLOAD_FILE_BYTES,
+    MAX_UPLOAD_REQUEST_BYTES,
+    PDF_HEADER_WINDOW,
+    StoredUpload,
+    has_valid_signature,
+    upload_kind,
+)
+
+# Input files of one batch request, counting the entries of uploaded ZIP archives
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "1000"))
+
+MANIFEST_NAME = "manifest.json"
+# Bytes copied per step when extracting entries and adding results to the archive
+CHUNK_SIZE = 1024 * 1024
+
+
+class BatchInput(NamedTuple):
+    """One input file of a batch: its name in the upload and where it is stored."""
+    name: str
+    kind: str  # 'image' or 'pdf'
+    path: str
+
+
+class BatchJob(NamedTuple):
+    """One independent conversion of a batch and the name of its result in the archive."""
+    name: str
+    operation: str  # 'image-to-pdf' or 'compress-pdf'
+    inputs: List[BatchInput]
+
+
+def _entry_name(name: str) -> str:
+    """
+    Normalize the relative path of an uploaded file or archive entry.
+
+    Raises:
+        ValueError: If it is absolute or leaves its directory
+    """
+    normalized = posixpath.normpath(name.replace("\\", "/"))
+    if normalized.startswith("/") or normalized == ".." or normalized.startswith("../") or ":" in normalized:
+        raise ValueError(f"Invalid file name: {name}")
+    return normalized
+
+
+def _is_ignored(name: str) -> bool:
+    """Directories and the metadata files archivers add (__MACOSX/, .DS_Store, ...)."""
+    name = name.replace("\\", "/")
+    return (
+        name.endswith("/")
+        or name.startswith("__MACOSX/")
+        or posixpath.basename(name).startswith(".")
+    )
+
+
+def extract_archive(path: str, directory: Path, max_files: int, counted: int = 0) -> List[BatchInput]:
+    """
+    Extract the images and PDFs of an uploaded ZIP archive into directory.
+    Together with the counted files of the batch before it, there may be at
+    most max_files.
+
+    The sizes in the archive's directory are not trusted: entries are
+    copied in chunks and extraction stops as soon as an entry exceeds
+    MAX_UPLOAD_FILE_BYTES or all of them together exceed
+    MAX_UPLOAD_REQUEST_BYTES, so a decompression bomb never reaches the
+    disk in full.
+
+    Raises:
+        InputTooLarge: If an entry or the whole archive is too large when extracted
+        ValueError: If the archive is unreadable or holds too many,
+            unsafe or unsupported files
+    """
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"Not a valid ZIP archive: {e}")
+
+    inputs = []
+    total = 0
+    with archive:
+        for info in archive.infolist():
+            if _is_ignored(info.filename):
+                continue
+            name = _entry_name(info.filename)
+            ext = os.path.splitext(name)[1].lower()
+            if ext not in ALLOWED_IMAGE_EXTENSIONS | {".pdf"}:
+                raise ValueError(f"Invalid file type in archive: {name}. Allowed: PDF, JPG, PNG, GIF, BMP")
+            if counted + len(inputs) >= max_files:
+                raise ValueError(f"Too many files. Limit is {max_files}")
+            if info.flag_bits & 0x1:
+                raise ValueError(f"Encrypted archive entries are not supported: {name}")
+
+            kind = upload_kind(name)
+            target = directory / f"{uuid.uuid4()}{ext}"
+            size = 0
+            head = b""
+            try:
+                with archive.open(info) as entry, open(target, "wb") as output:
+                    while chunk := entry.read(CHUNK_SIZE):
+                        size += len(chunk)
+                        total += len(chunk)
+                        if size > MAX_UPLOAD_FILE_BYTES:
+                            raise InputTooLarge(f"File too large: {name}. Limit is {MAX_UPLOAD_FILE_BYTES} bytes")
+                        if total > MAX_UPLOAD_REQUEST_BYTES:
+                            raise InputTooLarge(
+                                f"Archive too large when extracted. Limit is {MAX_UPLOAD_REQUEST_BYTES} bytes"
+                            )
+                        if len(head) < PDF_HEADER_WINDOW:
+                            head += chunk[:PDF_HEADER_WINDOW]
+                        output.write(chunk)
+            except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError, EOFError) as e:
+                raise ValueError(f"Cannot extract {name}: {e}")
+            if not has_valid_signature(head, kind):
+                raise ValueError(f"File is not {'an image' if kind == 'image' else 'a PDF'}: {name}")
+            inputs.append(BatchInput(name, kind, str(target)))
+
+    if not inputs:
+        raise ValueError("The archive holds no images or PDFs")
+    return inputs
+
+
+def collect_inputs(uploads: List[StoredUpload], directory: Path, max_files: int = BATCH_MAX_FILES) -> List[BatchInput]:
+    """
+    The input files of a batch in upload order, with the contents of each
+    uploaded ZIP archive (extracted into directory) in its place.
+
+    Raises:
+        InputTooLarge: If an archive is too large when extracted
+        ValueError: If a name or archive is invalid or there are too many files
+    """
+    inputs = []
+    for upload in uploads:
+        kind = upload_kind(upload.filename)
+        if kind == "zip":
+            inputs += extract_archive(upload.path, directory, max_files, counted=len(inputs))
+            Path(upload.path).unlink(missing_ok=True)
+        elif len(inputs) >= max_files:
+            raise ValueError(f"Too many files. Limit is {max_files}")
+        else:
+            inputs.append(BatchInput(_entry_name(upload.filename), kind, upload.path))
+    return inputs
+
+
+def _unique(name: str, used: Dict[str, int]) -> str:
+    """name, or "name (2).pdf" etc. if an earlier result already has it."""
+    count = used.get(name, 0) + 1
+    used[name] = count
+    if count == 1:
+        return name
+    stem, ext = os.path.splitext(name)
+    return _unique(f"{stem} ({count}){ext}", used)
+
+
+def plan_jobs(inputs: List[BatchInput], image_sets: bool = False) -> List[BatchJob]:
+    """
+    Turn the input files of a batch into independent jobs: every PDF is
+    compressed and every image becomes its own PDF. With image_sets, the
+    images of each folder (of a ZIP archive, or in upload names such as
+    "receipt-17/page1.jpg") instead become one PDF named after the folder,
+    their pages in name order. Results keep the folders of their inputs.
+    """
+    jobs = []
+    sets: Dict[str, List[BatchInput]] = {}
+    for item in inputs:
+        folder = posixpath.dirname(item.name)
+        if item.kind == "pdf":
+            jobs.append(BatchJob(item.name, "compress-pdf", [item]))
+        elif image_sets and folder:
+            sets.setdefault(folder, []).append(item)
+        else:
+            jobs.append(BatchJob(os.path.splitext(item.name)[0] + ".pdf", "image-to-pdf", [item]))
+    for folder, images in sets.items():
+        jobs.append(BatchJob(folder + ".pdf", "image-to-pdf", sorted(images, key=lambda item: item.name)))
+
+    used: Dict[str, int] = {MANIFEST_NAME: 1}
+    return [job._replace(name=_unique(job.name, used)) for job in jobs]
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, unseekable buffer the archive is written into and drained from."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ArchiveStream:
+    """
+    Builds a ZIP archive front to back, handing out its bytes as each
+    entry is added, so a response can stream results while later ones are
+    still being produced. Entries are stored uncompressed: PDFs are
+    compressed already. The central directory follows in close().
+    """
+
+    def __init__(self):
+        self._sink = _Sink()
+        # The sink cannot seek, so zipfile writes sizes after each entry's data
+        self._archive = zipfile.ZipFile(self._sink, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def add_file(self, name: str, path: str) -> Iterator[bytes]:
+        """Add the file at path as name, yielding the archive's bytes chunk by chunk."""
+        size = os.path.getsize(path)
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        with open(path, "rb") as source, self._archive.open(info, "w", force_zip64=size > zipfile.ZIP64_LIMIT) as entry:
+            while chunk := source.read(CHUNK_SIZE):
+                entry.write(chunk)
+                yield self._sink.take()
+        yield self._sink.take()
+
+    def add_json(self, name: str, data) -> bytes:
+        self._archive.writestr(name, json.dumps(data, indent=2))
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        self._archive.close()
+        return self._sink.take()
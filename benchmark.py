@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the PDF tools.
+
+Calls convert_images_to_pdf, merge_pdfs and compress_pdf directly on
+synthetic, reproducible corpora (image sizes and formats, page counts,
+scanned and vector PDFs) and records wall time, CPU time, peak memory and
+output size per case. Every case runs in its own process so peak memory
+is not skewed by earlier cases.
+
+Usage:
+    python benchmark.py run --output results.json
+    python benchmark.py run --cases merge --repeat 5 --baseline baseline.json
+    python benchmark.py compare baseline.json results.json --threshold 10
+    python benchmark.py list
+
+compare (and run --baseline) exit with status 1 when a case regressed by
+more than the threshold.
+"""
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageFilter
+import PIL
+import pypdf
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from tools.compress_pdf import compress_pdf
+from tools.image_to_pdf import convert_images_to_pdf
+from tools.merge_pdf import merge_pdfs
+
+SEED = 1234
+# Bump whenever the corpus changes: results of different versions do not compare
+CORPUS_VERSION = 2
+
+# Metrics compared against a baseline: higher is worse for all of them.
+# Time and memory differences below the floor are treated as noise.
+COMPARED_METRICS = {
+    "wall_seconds": 0.005,
+    "cpu_seconds": 0.005,
+    "peak_rss_delta_bytes": 4 * 1024 * 1024,
+    "output_bytes": 0,
+}
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua invoice total amount date page").split()
+
+
+# Corpus generation
+
+def _noise(rng: random.Random, size, mode: str = "L") -> Image.Image:
+    bands = len(mode)
+    return Image.frombytes(mode, size, rng.randbytes(size[0] * size[1] * bands))
+
+
+def make_photo(rng: random.Random, width: int, height: int) -> Image.Image:
+    """Photo-like RGB image: smooth gradients with blurred noise for texture."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    texture = _noise(rng, (width, height), "RGB").filter(ImageFilter.GaussianBlur(2))
+    base = Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM), gradient.point(lambda p: p // 2 + 64)))
+    return Image.blend(base, texture, 0.35)
+
+
+def make_scan(rng: random.Random, width: int, height: int) -> Image.Image:
+    """Grayscale page scan: light paper noise with dark text-like lines."""
+    page = Image.blend(Image.new("L", (width, height), 235), _noise(rng, (width, height)), 0.08)
+    line_height = max(12, height // 60)
+    for top in range(line_height * 3, height - line_height * 3, line_height * 2):
+        length = rng.randint(width // 2, width - width // 5)
+        ink = _noise(rng, (length, line_height)).point(lambda p: 30 if p < 110 else 235)
+        page.paste(ink, (width // 10, top))
+    return page
+
+
+def write_vector_pdf(path: Path, rng: random.Random, pages: int) -> None:
+    """Text and line-art PDF with a shared Helvetica font resource."""
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    for _ in range(pages):
+        page = writer.add_blank_page(612, 792)
+        lines = [" ".join(rng.choice(WORDS) for _ in range(12)) for _ in range(55)]
+        text = "".join(f"({line}) '\n" for line in lines)
+        art = "".join(
+            f"{rng.randint(40, 560)} {rng.randint(40, 740)} m {rng.randint(40, 560)} {rng.randint(40, 740)} l S\n"
+            for _ in range(40)
+        )
+        content = DecodedStreamObject()
+        content.set_data(f"BT /F1 10 Tf 12 TL 50 760 Td\n{text}ET\n0.5 w\n{art}".encode())
+        page[NameObject("/Contents")] = writer._add_object(content)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font}),
+        })
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def write_scanned_pdf(path: Path, scans: List[Image.Image]) -> None:
+    """
+    One JPEG page per scan at 200 DPI, written by Pillow rather than by
+    image_to_pdf, so the inputs of the merge and compress cases do not
+    change with the tool being measured.
+    """
+    scans[0].save(path, "PDF", save_all=True, append_images=scans[1:], resolution=200, quality=90)
+
+
+def build_corpus(directory: Path) -> None:
+    """Generate the corpus into directory unless this version already exists there."""
+    marker = directory / f".corpus-v{CORPUS_VERSION}"
+    if marker.exists():
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(SEED)
+
+    for name, (width, height), fmt, count in (
+        ("photo_small", (800, 600), "JPEG", 20),
+        ("photo_large", (4000, 3000), "JPEG", 5),
+        ("photo_png", (1600, 1200), "PNG", 5),
+    ):
+        for i in range(count):
+            make_photo(rng, width, height).save(directory / f"{name}_{i}.{fmt.lower().replace('jpeg', 'jpg')}", fmt, quality=90)
+
+    scans = [make_scan(rng, 1700, 2200) for _ in range(10)]
+    for i in range(5):
+        write_scanned_pdf(directory / f"scanned_{i}.pdf", scans[i * 2:i * 2 + 2])
+    write_scanned_pdf(directory / "scanned_10p.pdf", scans)
+
+    for i in range(10):
+        write_vector_pdf(directory / f"vector_{i}.pdf", rng, 10)
+    write_vector_pdf(directory / "vector_100p.pdf", rng, 100)
+
+    marker.touch()
+
+
+# Cases
+
+class Case(NamedTuple):
+    tool: Callable
+    inputs: Callable[[Path], object]
+    kwargs: dict
+
+
+def _files(pattern: str) -> Callable[[Path], List[str]]:
+    return lambda directory: sorted(str(p) for p in directory.glob(pattern))
+
+
+def _file(name: str) -> Callable[[Path], str]:
+    return lambda directory: str(directory / name)
+
+
+CASES: Dict[str, Case] = {
+    "image-to-pdf/jpeg-small-x20": Case(convert_images_to_pdf, _files("photo_small_*.jpg"), {}),
+    "image-to-pdf/jpeg-large-x5": Case(convert_images_to_pdf, _files("photo_large_*.jpg"), {}),
+    "image-to-pdf/jpeg-large-x5-best": Case(convert_images_to_pdf, _files("photo_large_*.jpg"), {"resize_quality": "best"}),
+    "image-to-pdf/png-x5": Case(convert_images_to_pdf, _files("photo_png_*.png"), {}),
+    "merge/vector-10x10p": Case(merge_pdfs, _files("vector_*[0-9].pdf"), {}),
+    "merge/scanned-5x2p": Case(merge_pdfs, _files("scanned_[0-9].pdf"), {}),
+    "compress/scanned-10p": Case(compress_pdf, _file("scanned_10p.pdf"), {}),
+    "compress/scanned-10p-gray-72dpi": Case(compress_pdf, _file("scanned_10p.pdf"), {"dpi": 72, "color_mode": "grayscale"}),
+    "compress/vector-100p": Case(compress_pdf, _file("vector_100p.pdf"), {}),
+}
+
+
+def _peak_rss() -> int:
+    """Peak resident memory of this process in bytes."""
+    try:
+        # Unlike ru_maxrss, VmHWM is not inherited from the parent process
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(name: str, corpus: Path, repeat: int) -> dict:
+    """Run one case repeat times in this process and summarize the measurements."""
+    case = CASES[name]
+    inputs = case.inputs(corpus)
+    baseline_rss = _peak_rss()
+    walls, cpus = [], []
+    output_bytes = 0
+    for _ in range(repeat):
+        output = io.BytesIO()
+        wall, cpu = time.perf_counter(), time.process_time()
+        case.tool(inputs, output, **case.kwargs)
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+        output_bytes = len(output.getvalue())
+    peak_rss = _peak_rss()
+    return {
+        "wall_seconds": statistics.median(walls),
+        "wall_seconds_min": min(walls),
+        "cpu_seconds": statistics.median(cpus),
+        "peak_rss_bytes": peak_rss,
+        "peak_rss_delta_bytes": peak_rss - baseline_rss,
+        "output_bytes": output_bytes,
+        "repeat": repeat,
+    }
+
+
+def _run_isolated(name: str, corpus: Path, repeat: int) -> dict:
+    result = subprocess.run(
+        [sys.executable, __file__, "_case", name, "--corpus-dir", str(corpus), "--repeat", str(repeat)],
+        capture_output=True, text=True, cwd=Path(__file__).parent,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Case {name} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _select(patterns: List[str]) -> List[str]:
+    if not patterns:
+        return list(CASES)
+    names = [name for name in CASES if any(p in name for p in patterns)]
+    if not names:
+        raise SystemExit(f"No cases match: {', '.join(patterns)}")
+    return names
+
+
+# Comparison
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """
+    Return a line per case and metric that got worse by more than threshold
+    percent (and more than the metric's noise floor). Cases missing from
+    either side are skipped.
+
+    Raises:
+        SystemExit: If the two runs used different corpus versions
+    """
+    versions = (baseline.get("meta", {}).get("corpus_version"), current.get("meta", {}).get("corpus_version"))
+    if versions[0] != versions[1]:
+        raise SystemExit(
+            f"Corpus version {versions[0]} of the baseline differs from {versions[1]}: rerun the baseline"
+        )
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        for metric, floor in COMPARED_METRICS.items():
+            old, new = before.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            if new - old > max(floor, abs(old) * threshold / 100):
+                change = f"{(new - old) / old * 100:+.1f}%" if old else "new"
+                regressions.append(f"{name}: {metric} {old:.4g} -> {new:.4g} ({change})")
+    return regressions
+
+
+def print_results(results: Dict[str, dict]) -> None:
+    print(f"{'case':40} {'wall s':>8} {'cpu s':>8} {'peak MB':>8} {'+MB':>7} {'out KB':>9}")
+    for name, r in results.items():
+        print(
+            f"{name:40} {r['wall_seconds']:8.3f} {r['cpu_seconds']:8.3f} "
+            f"{r['peak_rss_bytes'] / 2**20:8.1f} {r['peak_rss_delta_bytes'] / 2**20:7.1f} "
+            f"{r['output_bytes'] / 1024:9.1f}"
+        )
+
+
+def _report_regressions(regressions: List[str], threshold: float) -> int:
+    if regressions:
+        print(f"\nRegressions beyond {threshold}%:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"\nNo regressions beyond {threshold}%")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the PDF tools on synthetic corpora")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run the benchmark cases")
+    run.add_argument("--cases", nargs="*", default=[], help="Substrings of the case names to run")
+    run.add_argument("--repeat", type=int, default=3, help="Runs per case; the median time is reported")
+    run.add_argument("--corpus-dir", type=Path, help="Reuse a generated corpus (default: a temporary directory)")
+    run.add_argument("--output", type=Path, help="Write the results as JSON")
+    run.add_argument("--baseline", type=Path, help="Compare against an earlier results file")
+    run.add_argument("--threshold", type=float, default=10.0, help="Allowed regression in percent")
+
+    cmp = commands.add_parser("compare", help="Compare two results files")
+    cmp.add_argument("baseline", type=Path)
+    cmp.add_argument("current", type=Path)
+    cmp.add_argument("--threshold", type=float, default=10.0, help="Allowed regression in percent")
+
+    commands.add_parser("list", help="List the benchmark cases")
+
+    case = commands.add_parser("_case")  # internal: one case in a fresh process
+    case.add_argument("name")
+    case.add_argument("--corpus-dir", type=Path, required=True)
+    case.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args()
+
+    if args.command == "list":
+        print("\n".join(CASES))
+        return 0
+
+    if args.command == "_case":
+        print(json.dumps(run_case(args.name, args.corpus_dir, args.repeat)))
+        return 0
+
+    if args.command == "compare":
+        baseline = json.loads(args.baseline.read_text())
+        current = json.loads(args.current.read_text())
+        return _report_regressions(compare(baseline, current, args.threshold), args.threshold)
+
+    names = _select(args.cases)
+    with tempfile.TemporaryDirectory(prefix="pdf-bench-") as tmp:
+        corpus = args.corpus_dir or Path(tmp)
+        print(f"Generating corpus in {corpus}...")
+        build_corpus(corpus)
+
+        results = {}
+        for name in names:
+            print(f"Running {name}...", flush=True)
+            results[name] = _run_isolated(name, corpus, args.repeat)
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "pillow": PIL.__version__,
+            "pypdf": pypdf.__version__,
+            "corpus_version": CORPUS_VERSION,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    print()
+    print_results(results)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        return _report_regressions(compare(baseline, report, args.threshold), args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
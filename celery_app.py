@@ -1,20 +1,42 @@
 from celery import Celery
+from kombu import Queue
 import os
 
 # Use Azure Redis in production, local Redis in development
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 
+# Run tasks inline with in-memory transport and results (local testing without Redis)
+always_eager = os.getenv('CELERY_TASK_ALWAYS_EAGER', '').lower() in ('1', 'true', 'yes')
+
 celery_app = Celery(
     'pdf_tools',
-    broker=os.getenv('CELERY_BROKER_URL', redis_url),
-    backend=os.getenv('CELERY_RESULT_BACKEND', redis_url),
+    broker='memory://' if always_eager else os.getenv('CELERY_BROKER_URL', redis_url),
+    backend='cache+memory://' if always_eager else os.getenv('CELERY_RESULT_BACKEND', redis_url),
     include=['tasks']  # Auto-discover tasks from tasks.py
 )
 
+# Jobs are classified by estimated cost (admission.job_queue): small ones go
+# to the fast lane, large ones to the bulk lane. Each lane has its own
+# workers (see startup.sh), so small jobs never wait behind large ones;
+# a worker started without -Q consumes both.
+FAST_QUEUE = 'pdf_fast'
+BULK_QUEUE = 'pdf_bulk'
+
+# (soft, hard) time limits in seconds, applied per job when it is enqueued
+QUEUE_TIME_LIMITS = {
+    FAST_QUEUE: (int(os.getenv('FAST_SOFT_TIME_LIMIT', '60')), int(os.getenv('FAST_TIME_LIMIT', '90'))),
+    BULK_QUEUE: (int(os.getenv('BULK_SOFT_TIME_LIMIT', '1500')), int(os.getenv('BULK_TIME_LIMIT', '1800'))),
+}
+
 celery_app.conf.task_routes = {
-    'tasks.*': {'queue': 'pdf_processing'}
+    'tasks.*': {'queue': FAST_QUEUE}
 }
 
+celery_app.conf.task_queues = (
+    Queue(FAST_QUEUE),
+    Queue(BULK_QUEUE),
+)
+
 celery_app.conf.update(
     task_serializer='json',
     accept_content=['json'],
@@ -22,23 +44,14 @@ celery_app.conf.update(
     timezone='Europe/Berlin',
     enable_utc=True,
     task_track_started=True,
-    task_time_limit=300,
-    task_soft_time_limit=240,
+    # Upper bound for tasks sent without a lane's limits
+    task_soft_time_limit=QUEUE_TIME_LIMITS[BULK_QUEUE][0],
+    task_time_limit=QUEUE_TIME_LIMITS[BULK_QUEUE][1],
     worker_prefetch_multiplier=1,
     worker_max_tasks_per_child=1000,
+    task_always_eager=always_eager,
+    task_store_eager_result=always_eager,
 )
 
-from celery.schedules import crontab
-
-celery_app.conf.beat_schedule = {
-    'cleanup-temp-files-every-30-minutes': {
-        'task': 'tasks.cleanup_old_files',
-        'schedule': crontab(minute='*/30'),
-        'args': ('temp', 1),
-    },
-    'cleanup-upload-files-every-30-minutes': {
-        'task': 'tasks.cleanup_old_files',
-        'schedule': crontab(minute='*/30'),
-        'args': ('uploads', 1),
-    },
-}
+# Expired job files are removed by the API's workspace cleaner (workspaces.py)
+celery_app.conf.beat_schedule = {}
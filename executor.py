@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorBusy(Exception):
+    """Raised when the executor's queue is full and a job cannot be accepted."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Server is busy, please retry later")
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """
+    Runs blocking PDF work on a dedicated thread pool so the event loop stays
+    responsive. At most max_workers jobs run at once and at most max_queue
+    more wait for a slot; anything beyond that is rejected immediately with
+    ExecutorBusy instead of piling up and blowing the latency of every
+    request on the worker.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, retry_after: int = 5):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdf-worker")
+        self._lock = threading.Lock()
+        self._pending = 0
+        # Called with the executor whenever pending changes (see metrics.py)
+        self.on_change: Optional[Callable[["BoundedExecutor"], None]] = None
+
+    @property
+    def pending(self) -> int:
+        """Jobs currently running or waiting for a worker thread."""
+        return self._pending
+
+    @property
+    def queued(self) -> int:
+        """Jobs waiting for a worker thread."""
+        return max(0, self._pending - self.max_workers)
+
+    def _acquire(self) -> None:
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise ExecutorBusy(self.retry_after)
+            self._pending += 1
+            self._changed()
+
+    def _release(self, _future=None) -> None:
+        with self._lock:
+            self._pending -= 1
+            self._changed()
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change(self)
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Run fn(*args, **kwargs) on the pool and await its result.
+
+        The slot is released when the job itself finishes, not when the
+        awaiting request goes away, so cancelled requests still count
+        against the limit until their work is done.
+
+        Raises:
+            ExecutorBusy: If the queue is full
+        """
+        self._acquire()
+        try:
+            # Carry context variables (request-scoped state) into the worker thread
+            ctx = contextvars.copy_context()
+            future = self._executor.submit(functools.partial(ctx.run, fn, *args, **kwargs))
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+pdf_executor = BoundedExecutor(
+    max_workers=int(os.environ.get("PDF_EXECUTOR_WORKERS", "2")),
+    max_queue=int(os.environ.get("PDF_EXECUTOR_QUEUE", "8")),
+    retry_after=int(os.environ.get("PDF_EXECUTOR_RETRY_AFTER", "5")),
+)
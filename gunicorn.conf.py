@@ -0,0 +1,6 @@
+# Picked up automatically by gunicorn when started from this directory
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges from the aggregated /metrics
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Concurrent load generator for the PDF Tools API.
+
+Replays a weighted mix of image-to-PDF, merge and compress requests against
+a running instance, either with a fixed number of concurrent clients
+(closed loop) or at a target arrival rate (open loop, Poisson arrivals),
+and reports latency percentiles, throughput, error and 429/503 rates, the
+share of synchronous requests offloaded to a background job (202), and
+the server's memory and executor depth over time (sampled from /metrics).
+
+Usage:
+    python load_test.py --concurrency 8 --duration 60
+    python load_test.py --rate 5 --duration 120 --mix image-to-pdf=6,merge-pdf=3,compress-pdf=1
+    python load_test.py --concurrency 4 --requests 200 --jobs --output load.json
+"""
+from collections import Counter, defaultdict
+from typing import Dict, List, NamedTuple, Tuple
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmark import SEED, make_photo, make_scan, write_scanned_pdf, write_vector_pdf
+
+OPERATIONS = ("image-to-pdf", "merge-pdf", "compress-pdf")
+DEFAULT_MIX = "image-to-pdf=5,merge-pdf=3,compress-pdf=2"
+
+# Statuses counted separately from other errors: the server shedding load
+BACKPRESSURE_STATUSES = (429, 503)
+# A synchronous request too large to run in the API worker is answered with
+# a job to poll instead of the file: neither a success nor an error
+OFFLOADED_STATUS = 202
+# No answer (or, with --jobs, no finished job) within --timeout; an error
+TIMEOUT_STATUS = -1
+
+
+class Result(NamedTuple):
+    operation: str
+    status: int  # 0 when the request failed without a response, TIMEOUT_STATUS when it took too long
+    latency: float
+    bytes_out: int
+
+
+class Payloads:
+    """Multipart bodies for each operation, generated once before the run."""
+
+    def __init__(self, images: int, image_size: Tuple[int, int], pdf_pages: int):
+        rng = random.Random(SEED)
+        self.images = []
+        for i in range(images):
+            buffer = io.BytesIO()
+            make_photo(rng, *image_size).save(buffer, "JPEG", quality=90)
+            self.images.append((f"photo_{i}.jpg", buffer.getvalue()))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            vector_path = os.path.join(tmp, "vector.pdf")
+            write_vector_pdf(vector_path, rng, pdf_pages)
+            with open(vector_path, "rb") as f:
+                self.vector_pdf = f.read()
+            scanned_path = os.path.join(tmp, "scanned.pdf")
+            write_scanned_pdf(scanned_path, [make_scan(rng, 1700, 2200) for _ in range(2)])
+            with open(scanned_path, "rb") as f:
+                self.scanned_pdf = f.read()
+
+    def files(self, operation: str, rng: random.Random, unique: bool = True) -> list:
+        """
+        Multipart files for one request. With unique, a few random bytes are
+        appended to every file (after the JPEG EOI marker or as a trailing
+        PDF comment, both ignored by readers) so the result cache cannot
+        answer the request.
+        """
+        def tag(data: bytes) -> bytes:
+            return data + b"\n%" + rng.randbytes(8).hex().encode() + b"\n" if unique else data
+
+        if operation == "image-to-pdf":
+            return [("files", (name, tag(data), "image/jpeg")) for name, data in self.images]
+        if operation == "merge-pdf":
+            pdfs = [self.vector_pdf, self.scanned_pdf, self.vector_pdf]
+            return [("files", (f"doc_{i}.pdf", tag(data), "application/pdf")) for i, data in enumerate(pdfs)]
+        return [("file", ("scan.pdf", tag(self.scanned_pdf), "application/pdf"))]
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation in --mix: {name}. Allowed: {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def wait_for_job(client: httpx.AsyncClient, job: dict, poll_interval: float) -> httpx.Response:
+    """Poll a submitted job until it has finished, then download its result."""
+    while True:
+        await asyncio.sleep(poll_interval)
+        state = (await client.get(job["status_url"])).json()["status"]
+        if state in ("SUCCESS", "FAILURE"):
+            return await client.get(job["download_url"])
+
+
+async def send(client: httpx.AsyncClient, payloads: Payloads, operation: str, rng: random.Random,
+               jobs: bool, poll_interval: float, timeout: float, unique: bool = True) -> Result:
+    """
+    Send one request (or submit and wait for one job) and time it end to
+    end. A job that has not finished timeout seconds after the request
+    was sent is given up on and counted as a timeout.
+    """
+    start = time.perf_counter()
+    path = f"/api/jobs/{operation}" if jobs else f"/api/{operation}"
+    try:
+        response = await client.post(path, files=payloads.files(operation, rng, unique))
+        if jobs and response.status_code == 202:
+            remaining = max(0.0, timeout - (time.perf_counter() - start))
+            response = await asyncio.wait_for(wait_for_job(client, response.json(), poll_interval), remaining)
+        return Result(operation, response.status_code, time.perf_counter() - start, len(response.content))
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        return Result(operation, TIMEOUT_STATUS, time.perf_counter() - start, 0)
+    except httpx.HTTPError:
+        return Result(operation, 0, time.perf_counter() - start, 0)
+
+
+def _scrape(text: str) -> dict:
+    sample = {"rss_bytes": 0.0, "executor_pending": 0.0, "celery_queue_depth": 0.0}
+    for family in text_string_to_metric_families(text):
+        for s in family.samples:
+            if s.name == "pdf_process_resident_memory_bytes":
+                sample["rss_bytes"] += s.value
+            elif s.name == "pdf_executor_pending":
+                sample["executor_pending"] += s.value
+            elif s.name == "pdf_celery_queue_depth":
+                sample["celery_queue_depth"] += s.value
+    return sample
+
+
+async def sample_server(client: httpx.AsyncClient, interval: float, samples: List[dict], start: float) -> None:
+    """Record the server's total RSS and queue depths every interval seconds."""
+    while True:
+        try:
+            response = await client.get("/metrics", timeout=5)
+            if response.status_code == 200:
+                samples.append({"t": round(time.perf_counter() - start, 2), **_scrape(response.text)})
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+
+async def run_load(args, payloads: Payloads, mix: Dict[str, float]) -> Tuple[List[Result], List[dict], float]:
+    rng = random.Random(SEED)
+    operations, weights = list(mix), list(mix.values())
+    results: List[Result] = []
+    samples: List[dict] = []
+    # In open loop mode requests must not queue for a connection on the client side
+    limits = httpx.Limits(max_connections=None if args.rate else args.concurrency + 1)
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    issued = 0
+
+    def more() -> bool:
+        nonlocal issued
+        if args.requests and issued >= args.requests:
+            return False
+        if deadline is not None and time.perf_counter() >= deadline:
+            return False
+        issued += 1
+        return True
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        sampler = asyncio.create_task(sample_server(client, args.sample_interval, samples, start))
+
+        async def one() -> None:
+            operation = rng.choices(operations, weights)[0]
+            results.append(await send(
+                client, payloads, operation, rng, args.jobs, args.poll_interval, args.timeout,
+                unique=not args.allow_cache
+            ))
+
+        if args.rate:
+            # Open loop: arrivals do not wait for earlier requests to finish
+            in_flight = set()
+            while more():
+                task = asyncio.create_task(one())
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                await asyncio.sleep(rng.expovariate(args.rate))
+            if in_flight:
+                await asyncio.wait(in_flight)
+        else:
+            async def client_loop() -> None:
+                while more():
+                    await one()
+
+            await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+
+        elapsed = time.perf_counter() - start
+        sampler.cancel()
+    return results, samples, elapsed
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(results: List[Result], elapsed: float) -> dict:
+    def stats(group: List[Result]) -> dict:
+        ok = [r.latency for r in group if 200 <= r.status < 300 and r.status != OFFLOADED_STATUS]
+        statuses = Counter(r.status for r in group)
+        summary = {
+            "requests": len(group),
+            "succeeded": len(ok),
+            "offloaded": statuses.get(OFFLOADED_STATUS, 0),
+            "timeouts": statuses.get(TIMEOUT_STATUS, 0),
+            "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+            "error_rate": sum(n for s, n in statuses.items() if not 200 <= s < 300) / len(group),
+            "offload_rate": statuses.get(OFFLOADED_STATUS, 0) / len(group),
+            "timeout_rate": statuses.get(TIMEOUT_STATUS, 0) / len(group),
+            "statuses": {str(s): n for s, n in sorted(statuses.items())},
+        }
+        for status in BACKPRESSURE_STATUSES:
+            summary[f"rate_{status}"] = statuses.get(status, 0) / len(group)
+        if ok:
+            summary.update({
+                "p50": _percentile(ok, 50),
+                "p95": _percentile(ok, 95),
+                "p99": _percentile(ok, 99),
+                "mean": statistics.mean(ok),
+                "max": max(ok),
+            })
+        return summary
+
+    by_operation = defaultdict(list)
+    for result in results:
+        by_operation[result.operation].append(result)
+    report = {"all": stats(results)} if results else {}
+    report.update({name: stats(group) for name, group in sorted(by_operation.items())})
+    return report
+
+
+def print_report(summary: dict, samples: List[dict], elapsed: float) -> None:
+    print(f"\nDuration: {elapsed:.1f}s")
+    print(f"{'operation':14} {'reqs':>6} {'ok':>6} {'rps':>7} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} "
+          f"{'err %':>6} {'429 %':>6} {'503 %':>6} {'202 %':>6} {'t/o %':>6}")
+    for name, s in summary.items():
+        print(
+            f"{name:14} {s['requests']:6} {s['succeeded']:6} {s['throughput_rps']:7.2f} "
+            f"{s.get('p50', 0):7.2f} {s.get('p95', 0):7.2f} {s.get('p99', 0):7.2f} "
+            f"{s['error_rate'] * 100:6.1f} {s['rate_429'] * 100:6.1f} {s['rate_503'] * 100:6.1f} "
+            f"{s['offload_rate'] * 100:6.1f} {s['timeout_rate'] * 100:6.1f}"
+        )
+    if any(s["offloaded"] for s in summary.values()):
+        print("202: offloaded to a background job; not counted as successes (use --jobs to follow them)")
+    if any(s["timeouts"] for s in summary.values()):
+        print("t/o: no response, or no finished job, within --timeout; counted as errors")
+    if samples:
+        print(f"\n{'t s':>7} {'server RSS MB':>14} {'executor':>9} {'celery q':>9}")
+        for sample in samples:
+            print(f"{sample['t']:7.1f} {sample['rss_bytes'] / 2**20:14.1f} "
+                  f"{sample['executor_pending']:9.0f} {sample['celery_queue_depth']:9.0f}")
+        print(f"Peak server RSS: {max(s['rss_bytes'] for s in samples) / 2**20:.1f} MB")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test the PDF Tools API")
+    parser.add_argument("--url", default=os.getenv("API_URL", "http://localhost:8000"))
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weighted operations, e.g. image-to-pdf=5,merge-pdf=3")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients (closed loop)")
+    parser.add_argument("--rate", type=float, help="Arrivals per second (open loop); overrides --concurrency")
+    parser.add_argument("--duration", type=float, help="Seconds to run (default: 30 unless --requests is given)")
+    parser.add_argument("--requests", type=int, help="Total requests to send")
+    parser.add_argument("--jobs", action="store_true", help="Use the Celery job endpoints and wait for each result")
+    parser.add_argument("--allow-cache", action="store_true",
+                        help="Send identical files so repeated requests can be served from the result cache")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Job status polling interval")
+    parser.add_argument("--images", type=int, default=5, help="Images per image-to-PDF request")
+    parser.add_argument("--image-size", default="2000x1500", help="Size of the generated images")
+    parser.add_argument("--pdf-pages", type=int, default=10, help="Pages of the generated vector PDF")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="Seconds a request, or with --jobs the whole job, may take before it is a timeout")
+    parser.add_argument("--sample-interval", type=float, default=2.0, help="Seconds between /metrics samples")
+    parser.add_argument("--output", help="Write the summary and samples as JSON")
+    args = parser.parse_args()
+
+    if not args.duration and not args.requests:
+        args.duration = 30
+    width, _, height = args.image_size.partition("x")
+    mix = parse_mix(args.mix)
+
+    print("Generating payloads...")
+    payloads = Payloads(args.images, (int(width), int(height)), args.pdf_pages)
+
+    mode = f"{args.rate}/s open loop" if args.rate else f"{args.concurrency} concurrent clients"
+    print(f"Load testing {args.url} with {mode} ({'jobs' if args.jobs else 'synchronous'}), mix {mix}")
+    results, samples, elapsed = asyncio.run(run_load(args, payloads, mix))
+    if not results:
+        print("No requests were sent")
+        return 1
+
+    summary = summarize(results, elapsed)
+    print_report(summary, samples, elapsed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "elapsed": elapsed, "summary": summary, "samples": samples}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,58 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from starlette.concurrency import iterate_in_threadpool
+from typing import Dict, List, Optional, Tuple
 import os
-import uuid
-import shutil
-from datetime import datetime, timedelta
+import io
+import json
+import tempfile
+import time
 import asyncio
 from pathlib import Path
 
-from tools.image_to_pdf import convert_images_to_pdf
-from tools.merge_pdf import merge_pdfs
-from tools.compress_pdf import compress_pdf
+from tools.image_to_pdf import (
+    convert_images_to_pdf,
+    estimate_cost as estimate_image_to_pdf,
+    shutdown_process_pools,
+    DEFAULT_RESIZE_QUALITY,
+    RESIZE_QUALITY_PRESETS,
+)
+from tools.merge_pdf import estimate_cost as estimate_merge, merge_pdfs
+from tools.pipeline import check_inputs, estimate_cost as estimate_pipeline, parse_steps
+from tools.file_io import InputTooLarge
+from tools.optimize_pdf import DEFAULT_OPTIMIZE_LEVEL, OPTIMIZE_LEVELS
+from tools.compress_pdf import (
+    compress_pdf,
+    estimate_cost as estimate_compress,
+    COLOR_MODES,
+    MIN_DPI,
+    MAX_DPI,
+    MIN_IMAGE_QUALITY,
+    MAX_IMAGE_QUALITY,
+)
+from executor import ExecutorBusy, pdf_executor
+from streaming import TempFileResponse, produce_into, stream_job
+from celery_app import FAST_QUEUE, QUEUE_TIME_LIMITS, celery_app
+from celery.result import AsyncResult
+from tasks import process_image_to_pdf, process_merge_pdf, process_compress_pdf, process_pipeline
+from result_cache import make_cache_key, result_cache
+from single_flight import Flight, single_flight
+from uploads import (
+    IN_MEMORY_MAX_BYTES,
+    StoredUpload,
+    fits_in_memory,
+    multipart_openapi,
+    receive_uploads,
+    spill_uploads,
+    upload_kind,
+)
+from admission import ADMISSION_WAIT, SYNC_MAX_JOB_BYTES, estimate_cost, job_queue, memory_budget
+from batch import BATCH_MAX_FILES, MANIFEST_NAME, ArchiveStream, BatchJob, collect_inputs, plan_jobs
+from workspaces import JOB_QUEUE_TTL, Workspace, run_cleaner, workspace_store
+from metrics import CeleryQueueCollector, StageTimingMiddleware, render as render_metrics, track_executor
+from prometheus_client import CONTENT_TYPE_LATEST
+from profiling import ProfilingMiddleware, artifact_path, list_profiles, profiled, task_headers, token_matches
 
 app = FastAPI(title="PDF Tools API")
 
@@ -23,29 +64,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-UPLOAD_DIR = Path("uploads")
-TEMP_DIR = Path("temp")
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-TEMP_DIR.mkdir(parents=True, exist_ok=True)
+# Upload and download timing for the synchronous tool endpoints
+app.add_middleware(
+    StageTimingMiddleware,
+    paths={
+        "/api/image-to-pdf": "image-to-pdf",
+        "/api/merge-pdf": "merge-pdf",
+        "/api/compress-pdf": "compress-pdf",
+        "/api/batch": "batch",
+    },
+)
 
-async def cleanup_old_files():
-    """Remove files older than 1 hour"""
-    while True:
-        try:
-            now = datetime.now()
-            for directory in [UPLOAD_DIR, TEMP_DIR]:
-                for file_path in directory.glob("*"):
-                    if file_path.is_file():
-                        file_age = now - datetime.fromtimestamp(file_path.stat().st_mtime)
-                        if file_age > timedelta(hours=1):
-                            file_path.unlink()
-        except Exception as e:
-            print(f"Cleanup error: {e}")
-        await asyncio.sleep(300)
+# Opt-in profiling of single requests (X-Profile-Token header or PROFILE_SAMPLE_RATE)
+app.add_middleware(ProfilingMiddleware)
+
+track_executor(pdf_executor)
+celery_queue_collector = CeleryQueueCollector(celery_app, [queue.name for queue in celery_app.conf.task_queues])
+
+# Worker processes used per request to decode/resize images in parallel (1 = serial)
+IMAGE_TO_PDF_WORKERS = int(os.environ.get("IMAGE_TO_PDF_WORKERS", "1"))
+
+# Job event streams: seconds between checks of the job's state, between
+# keep-alive comments and before the stream ends (clients reconnect)
+JOB_EVENTS_INTERVAL = float(os.environ.get("JOB_EVENTS_INTERVAL", "1"))
+JOB_EVENTS_KEEPALIVE = 15
+JOB_EVENTS_MAX_SECONDS = float(os.environ.get("JOB_EVENTS_MAX_SECONDS", "300"))
+JOB_EVENTS_RETRY_MS = 2000
+FINISHED_STATES = ("SUCCESS", "FAILURE", "REVOKED")
+
+# Jobs of one batch request running at once; more would only wait in the executor's queue
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", str(pdf_executor.max_workers)))
+
+@app.exception_handler(ExecutorBusy)
+async def executor_busy_handler(request, exc: ExecutorBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
 
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(cleanup_old_files())
+    # Every worker starts the loop; only the one elected through the
+    # workspace lock actually removes expired jobs
+    asyncio.create_task(run_cleaner(workspace_store))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    pdf_executor.shutdown()
+    shutdown_process_pools()
 
 @app.get("/")
 async def root():
@@ -55,150 +122,757 @@ async def root():
 async def health():
     return {"status": "healthy"}
 
-@app.post("/api/image-to-pdf")
-async def image_to_pdf(files: List[UploadFile] = File(...)):
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Result cache hit/miss counters and size, shared by all workers, and this worker's request coalescing"""
+    stats = await asyncio.to_thread(result_cache.stats)
+    return {**stats, "single_flight": single_flight.stats()}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics, aggregated over all API and Celery worker processes"""
+    data = await asyncio.to_thread(render_metrics, celery_queue_collector)
+    return Response(content=data, media_type=CONTENT_TYPE_LATEST)
+
+def require_profile_token(token: Optional[str]) -> None:
+    if not token_matches(token):
+        raise HTTPException(status_code=403, detail="A valid X-Profile-Token header is required")
+
+@app.get("/api/profiles")
+async def profiles(x_profile_token: Optional[str] = Header(None)):
+    """List stored request and task profiles (admin only)"""
+    require_profile_token(x_profile_token)
+    return await asyncio.to_thread(list_profiles)
+
+@app.get("/api/profiles/{profile_id}/{artifact}")
+async def profile_download(profile_id: str, artifact: str, x_profile_token: Optional[str] = Header(None)):
+    """Download summary.txt or profile.pstats of a stored profile (admin only)"""
+    require_profile_token(x_profile_token)
+    path = artifact_path(profile_id, artifact)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    media_type = "text/plain" if artifact.endswith(".txt") else "application/octet-stream"
+    return FileResponse(path=path, media_type=media_type, filename=f"{profile_id}-{artifact}")
+
+@app.get("/api/admission/stats")
+async def admission_stats():
+    """Estimated memory reserved by running jobs and requests waiting for it, in this worker"""
+    return memory_budget.stats()
+
+@app.get("/api/cleanup/stats")
+async def cleanup_stats():
+    """Expired workspaces removed and bytes reclaimed, plus live workspaces"""
+    return await asyncio.to_thread(workspace_store.stats)
+
+async def receive_into_workspace(
+    request: Request,
+    field: str,
+    kind: str,
+    memory_limit: int = IN_MEMORY_MAX_BYTES,
+    **kwargs
+) -> Tuple[Optional[Workspace], List[StoredUpload]]:
+    """
+    Receive the uploads of a request. Requests up to memory_limit bytes are
+    kept in memory (workspace is None); larger ones get their own workspace
+    directory, which is removed again if receiving fails.
+    """
+    workspace = None
+    if not fits_in_memory(request, memory_limit):
+        workspace = await asyncio.to_thread(workspace_store.create)
+    try:
+        uploads = await receive_uploads(
+            request, field, kind, workspace.path if workspace is not None else None, **kwargs
+        )
+    except BaseException:
+        await close_workspace(workspace)
+        raise
+    return workspace, uploads
+
+async def close_workspace(workspace: Optional[Workspace]) -> None:
+    if workspace is not None:
+        await asyncio.to_thread(workspace_store.remove, workspace.job_id)
+
+def validate_image_request(resize_quality: str) -> None:
+    if resize_quality not in RESIZE_QUALITY_PRESETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid resize_quality: {resize_quality}. Allowed: {', '.join(RESIZE_QUALITY_PRESETS)}"
+        )
+
+def validate_optimize_level(optimize_level: int) -> None:
+    if optimize_level not in OPTIMIZE_LEVELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid optimize_level: {optimize_level}. Allowed: {', '.join(map(str, OPTIMIZE_LEVELS))}"
+        )
+
+def validate_compress_request(dpi: int, image_quality: int, color_mode: str, optimize_level: int) -> None:
+    if not MIN_DPI <= dpi <= MAX_DPI:
+        raise HTTPException(status_code=400, detail=f"dpi must be between {MIN_DPI} and {MAX_DPI}")
+
+    if not MIN_IMAGE_QUALITY <= image_quality <= MAX_IMAGE_QUALITY:
+        raise HTTPException(
+            status_code=400,
+            detail=f"image_quality must be between {MIN_IMAGE_QUALITY} and {MAX_IMAGE_QUALITY}"
+        )
+
+    if color_mode not in COLOR_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid color_mode: {color_mode}. Allowed: {', '.join(COLOR_MODES)}"
+        )
+
+    validate_optimize_level(optimize_level)
+
+async def lookup_cache(
+    operation: str, uploads: List[StoredUpload], **params
+) -> Tuple[str, Optional[Path], Optional[Flight]]:
+    """
+    Look the result up in the shared result cache by the uploads' content
+    hashes. On a miss, wait while an identical request anywhere on the host
+    is producing it (single flight) and take its result from the cache.
+    Otherwise the caller produces the result and gets the Flight, which it
+    must release once the result is cached or has failed.
+    """
+    key = make_cache_key(operation, [upload.sha256 for upload in uploads], **params)
+    if not result_cache.enabled:
+        return key, None, None
+    # Each request counts as exactly one hit or miss, however often it looks
+    cached = await asyncio.to_thread(result_cache.get, key, count=False)
+    if cached is not None:
+        await asyncio.to_thread(result_cache.count_lookup, True)
+        return key, cached, None
+
+    flight = await single_flight.acquire(key)
+    # Look again: the request producing it may have finished while we waited,
+    # or just before we took the flight
+    cached = await asyncio.to_thread(result_cache.get, key, count=False)
+    await asyncio.to_thread(result_cache.count_lookup, cached is not None)
+    if cached is not None:
+        flight.release()
+        return key, cached, None
+    return key, None, flight
+
+def release_flight(flight: Optional[Flight]) -> None:
+    if flight is not None:
+        flight.release()
+
+def pdf_response(path: Path, filename: str, cache_status: str) -> FileResponse:
+    return FileResponse(
+        path=path,
+        media_type="application/pdf",
+        filename=filename,
+        headers={"X-Cache": cache_status}
+    )
+
+def pdf_bytes_response(data: bytes, filename: str, cache_status: str) -> Response:
+    return Response(
+        content=data,
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Cache": cache_status,
+        }
+    )
+
+async def run_admitted(estimate: int, fn, *args, **kwargs):
+    """
+    Reserve the job's estimated peak memory from this worker's budget
+    (waiting for it if necessary), then run fn on the PDF executor. The
+    reservation is held until the job itself has finished, even if the
+    request goes away earlier.
+    """
+    reservation = await memory_budget.reserve(estimate)
+    job = asyncio.ensure_future(pdf_executor.run(fn, *args, **kwargs))
+
+    def finished(job: asyncio.Future) -> None:
+        reservation.release()
+        if not job.cancelled():
+            job.exception()  # retrieved here in case the request is gone
+
+    job.add_done_callback(finished)
+    return await asyncio.shield(job)
+
+async def run_tool(
+    tool,
+    inputs,
+    workspace: Optional[Workspace],
+    cache_key: str,
+    flight: Optional[Flight],
+    filename: str,
+    estimate: int,
+    **kwargs
+) -> Response:
+    """
+    Run tool(inputs, output, **kwargs) on the PDF executor, store the result
+    in the cache, release the flight and return it. Requests without a
+    workspace (small enough to be kept in memory) are also produced in
+    memory and never touch the disk; otherwise the response removes the
+    workspace once it is sent.
+    """
+    try:
+        if workspace is None:
+            output = io.BytesIO()
+            await run_admitted(estimate, profiled(tool), inputs, output, **kwargs)
+            data = output.getvalue()
+            await asyncio.to_thread(result_cache.put_bytes, cache_key, data)
+            return pdf_bytes_response(data, filename, "MISS")
+
+        output_path = workspace.path / "output.pdf"
+        await run_admitted(estimate, profiled(tool), inputs, str(output_path), **kwargs)
+        await asyncio.to_thread(result_cache.put, cache_key, str(output_path))
+    finally:
+        release_flight(flight)
+    # The cache keeps its own link to the file, so the output can go once sent
+    return TempFileResponse(
+        path=output_path,
+        media_type="application/pdf",
+        filename=filename,
+        headers={"X-Cache": "MISS"},
+        on_close=lambda: close_workspace(workspace)
+    )
+
+async def stream_tool(
+    tool,
+    inputs,
+    workspace: Optional[Workspace],
+    cache_key: str,
+    flight: Optional[Flight],
+    filename: str,
+    estimate: int,
+    **kwargs
+) -> Response:
+    """
+    Run tool(inputs, output, **kwargs) on the PDF executor and stream the
+    output to the client while it is still being generated. A copy is
+    spooled (in memory up to IN_MEMORY_MAX_BYTES) for the result cache.
+    The response takes over the workspace and the flight and releases them
+    once it is over, so identical requests wait until the result is cached.
+    """
+    spool = None
+    if result_cache.enabled:
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=IN_MEMORY_MAX_BYTES, dir=workspace.path if workspace is not None else None
+        )
+
+    async def store_result() -> None:
+        await asyncio.to_thread(result_cache.put_stream, cache_key, spool)
+
+    async def close() -> None:
+        release_flight(flight)
+        if spool is not None:
+            spool.close()
+        await close_workspace(workspace)
+
+    return await stream_job(
+        lambda channel: run_admitted(estimate, produce_into, channel, profiled(tool), inputs, **kwargs),
+        on_chunk=spool.write if spool is not None else None,
+        on_complete=store_result if spool is not None else None,
+        on_close=close,
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Cache": "MISS",
+        }
+    )
+
+async def offload(
+    task, uploads: List[StoredUpload], workspace: Optional[Workspace], queue: str, single: bool = False, **kwargs
+) -> JSONResponse:
+    """
+    Hand a synchronous request whose estimated memory is too large for the
+    API worker to a Celery job. The client gets the same 202 answer as
+    from the job endpoints and polls for the result.
+    """
+    if workspace is None:
+        workspace = await asyncio.to_thread(workspace_store.create)
+    uploads = await asyncio.to_thread(spill_uploads, uploads, workspace.path)
+    paths = [upload.path for upload in uploads]
+    job = await enqueue(task, paths[0] if single else paths, workspace, queue, **kwargs)
+    return JSONResponse(status_code=202, content=job)
+
+@app.post("/api/image-to-pdf", openapi_extra=multipart_openapi("files"))
+async def image_to_pdf(
+    request: Request,
+    resize_quality: str = DEFAULT_RESIZE_QUALITY
+):
     """Convert images to PDF"""
-    if not files:
-        raise HTTPException(status_code=400, detail="No files provided")
-    
-    allowed_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp"}
-    uploaded_files = []
-    
+    validate_image_request(resize_quality)
+    workspace, uploads = await receive_into_workspace(request, "files", "image")
+    flight = None
+
     try:
-        for file in files:
-            if not file.filename:
-                raise HTTPException(status_code=400, detail="Filename is required")
-            
-            ext = os.path.splitext(file.filename)[1].lower()
-            if ext not in allowed_extensions:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Invalid file type: {file.filename}. Allowed: JPG, PNG, GIF, BMP"
-                )
-            
-            file_id = f"{uuid.uuid4()}{ext}"
-            file_path = UPLOAD_DIR / file_id
-            
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            uploaded_files.append(str(file_path))
-        
-        output_filename = f"{uuid.uuid4()}.pdf"
-        output_path = TEMP_DIR / output_filename
-        
-        convert_images_to_pdf(uploaded_files, str(output_path))
-        
-        for file_path in uploaded_files:
-            Path(file_path).unlink(missing_ok=True)
-        
-        return FileResponse(
-            path=output_path,
-            media_type="application/pdf",
-            filename="converted.pdf"
+        cache_key, cached, flight = await lookup_cache("image-to-pdf", uploads, resize_quality=resize_quality)
+        if cached:
+            await close_workspace(workspace)
+            return pdf_response(cached, "converted.pdf", "HIT")
+
+        sources = [upload.source for upload in uploads]
+        cost = await estimate_cost(estimate_image_to_pdf, sources, resize_quality=resize_quality)
+        if cost.memory > SYNC_MAX_JOB_BYTES:
+            # Background jobs are not coalesced
+            release_flight(flight)
+            return await offload(process_image_to_pdf, uploads, workspace, job_queue(cost), resize_quality=resize_quality)
+
+        # Pages are sent as they are rendered; the response removes the workspace
+        return await stream_tool(
+            convert_images_to_pdf,
+            sources,
+            workspace,
+            cache_key,
+            flight,
+            "converted.pdf",
+            cost.memory,
+            workers=IMAGE_TO_PDF_WORKERS,
+            resize_quality=resize_quality
         )
-    
+
+    except (ExecutorBusy, HTTPException):
+        release_flight(flight)
+        await close_workspace(workspace)
+        raise
     except Exception as e:
-        for file_path in uploaded_files:
-            Path(file_path).unlink(missing_ok=True)
+        release_flight(flight)
+        await close_workspace(workspace)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/merge-pdf")
-async def merge_pdf_endpoint(files: List[UploadFile] = File(...)):
+@app.post("/api/merge-pdf", openapi_extra=multipart_openapi("files"))
+async def merge_pdf_endpoint(
+    request: Request,
+    optimize_level: int = DEFAULT_OPTIMIZE_LEVEL
+):
     """Merge multiple PDFs into one"""
-    if not files:
-        raise HTTPException(status_code=400, detail="No files provided")
-    
-    if len(files) < 2:
-        raise HTTPException(status_code=400, detail="At least 2 PDF files required")
-    
-    uploaded_files = []
-    
+    validate_optimize_level(optimize_level)
+    workspace, uploads = await receive_into_workspace(request, "files", "pdf", min_files=2)
+    flight = None
+
     try:
-        for file in files:
-            if not file.filename:
-                raise HTTPException(status_code=400, detail="Filename is required")
-            
-            if not file.filename.lower().endswith('.pdf'):
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Invalid file type: {file.filename}. Only PDF files allowed"
-                )
-            
-            file_id = f"{uuid.uuid4()}.pdf"
-            file_path = UPLOAD_DIR / file_id
-            
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            uploaded_files.append(str(file_path))
-        
-        output_filename = f"{uuid.uuid4()}.pdf"
-        output_path = TEMP_DIR / output_filename
-        
-        merge_pdfs(uploaded_files, str(output_path))
-        
-        for file_path in uploaded_files:
-            Path(file_path).unlink(missing_ok=True)
-        
-        return FileResponse(
-            path=output_path,
-            media_type="application/pdf",
-            filename="merged.pdf"
+        cache_key, cached, flight = await lookup_cache("merge-pdf", uploads, optimize_level=optimize_level)
+        if cached:
+            await close_workspace(workspace)
+            return pdf_response(cached, "merged.pdf", "HIT")
+
+        sources = [upload.source for upload in uploads]
+        cost = await estimate_cost(estimate_merge, sources)
+        if cost.memory > SYNC_MAX_JOB_BYTES:
+            # Background jobs are not coalesced
+            release_flight(flight)
+            return await offload(process_merge_pdf, uploads, workspace, job_queue(cost), optimize_level=optimize_level)
+
+        return await run_tool(
+            merge_pdfs,
+            sources,
+            workspace,
+            cache_key,
+            flight,
+            "merged.pdf",
+            cost.memory,
+            optimize_level=optimize_level
         )
-    
+
+    except (ExecutorBusy, HTTPException):
+        release_flight(flight)
+        await close_workspace(workspace)
+        raise
     except Exception as e:
-        for file_path in uploaded_files:
-            Path(file_path).unlink(missing_ok=True)
+        release_flight(flight)
+        await close_workspace(workspace)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/compress-pdf")
+@app.post("/api/compress-pdf", openapi_extra=multipart_openapi("file", many=False))
 async def compress_pdf_endpoint(
-    file: UploadFile = File(...),
+    request: Request,
     dpi: int = 144,
     image_quality: int = 75,
-    color_mode: str = "no-change"
+    color_mode: str = "no-change",
+    optimize_level: int = DEFAULT_OPTIMIZE_LEVEL
 ):
     """Compress a PDF file with advanced options"""
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="Filename is required")
-    
-    if not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid file type: {file.filename}. Only PDF files allowed"
-        )
-    
-    file_id = f"{uuid.uuid4()}.pdf"
-    file_path = UPLOAD_DIR / file_id
-    
+    validate_compress_request(dpi, image_quality, color_mode, optimize_level)
+    workspace, uploads = await receive_into_workspace(request, "file", "pdf", max_files=1)
+    flight = None
+
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        output_filename = f"{uuid.uuid4()}.pdf"
-        output_path = TEMP_DIR / output_filename
-        
-        compress_pdf(
-            str(file_path), 
-            str(output_path),
+        cache_key, cached, flight = await lookup_cache(
+            "compress-pdf",
+            uploads,
             dpi=dpi,
             image_quality=image_quality,
-            color_mode=color_mode
+            color_mode=color_mode,
+            optimize_level=optimize_level
         )
-        
-        file_path.unlink(missing_ok=True)
-        
-        return FileResponse(
-            path=output_path,
-            media_type="application/pdf",
-            filename="compressed.pdf"
+        if cached:
+            await close_workspace(workspace)
+            return pdf_response(cached, "compressed.pdf", "HIT")
+
+        cost = await estimate_cost(estimate_compress, uploads[0].source)
+        if cost.memory > SYNC_MAX_JOB_BYTES:
+            # Background jobs are not coalesced
+            release_flight(flight)
+            return await offload(
+                process_compress_pdf,
+                uploads,
+                workspace,
+                job_queue(cost),
+                single=True,
+                dpi=dpi,
+                image_quality=image_quality,
+                color_mode=color_mode,
+                optimize_level=optimize_level
+            )
+
+        return await run_tool(
+            compress_pdf,
+            uploads[0].source,
+            workspace,
+            cache_key,
+            flight,
+            "compressed.pdf",
+            cost.memory,
+            dpi=dpi,
+            image_quality=image_quality,
+            color_mode=color_mode,
+            optimize_level=optimize_level
         )
-    
+
+    except (ExecutorBusy, HTTPException):
+        release_flight(flight)
+        await close_workspace(workspace)
+        raise
     except Exception as e:
-        file_path.unlink(missing_ok=True)
+        release_flight(flight)
+        await close_workspace(workspace)
         raise HTTPException(status_code=500, detail=str(e))
 
+async def run_batch_job(job: BatchJob, output_path: Path, options: dict) -> None:
+    """
+    Run one job of a batch on the PDF executor, admitted like a synchronous
+    request. While the executor is busy with other requests the job waits
+    and tries again, for up to ADMISSION_WAIT seconds.
+    """
+    paths = [item.path for item in job.inputs]
+    if job.operation == "image-to-pdf":
+        tool, sources = convert_images_to_pdf, paths
+        cost = await estimate_cost(estimate_image_to_pdf, sources, resize_quality=options["resize_quality"])
+    else:
+        tool, sources = compress_pdf, paths[0]
+        cost = await estimate_cost(estimate_compress, sources)
+    if cost.memory > SYNC_MAX_JOB_BYTES:
+        raise HTTPException(status_code=413, detail=f"Too large for a batch; use /api/jobs/{job.operation}")
+
+    deadline = time.monotonic() + ADMISSION_WAIT
+    while True:
+        try:
+            await run_admitted(cost.memory, profiled(tool), sources, str(output_path), **options)
+            return
+        except ExecutorBusy as e:
+            if time.monotonic() + e.retry_after > deadline:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+async def stream_batch(jobs: List[BatchJob], workspace: Workspace, options: Dict[str, dict]):
+    """
+    Run the jobs of a batch, BATCH_CONCURRENCY at a time, and yield a ZIP
+    archive with each result as soon as it is done (in completion order),
+    followed by a manifest of all jobs. A failed job does not stop the
+    others; its error is reported in the manifest. The workspace is
+    removed at the end, or when the client goes away.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(index: int, job: BatchJob):
+        output_path = workspace.path / f"result-{index}.pdf"
+        async with semaphore:
+            try:
+                await run_batch_job(job, output_path, options[job.operation])
+            except HTTPException as e:
+                return job, None, e.detail
+            except Exception as e:
+                return job, None, str(e) or type(e).__name__
+        return job, output_path, None
+
+    pending = [asyncio.ensure_future(run(index, job)) for index, job in enumerate(jobs)]
+    archive = ArchiveStream()
+    results = []
+    try:
+        for next_done in asyncio.as_completed(pending):
+            job, output_path, error = await next_done
+            result = {"name": job.name, "operation": job.operation, "inputs": [item.name for item in job.inputs]}
+            if error is None:
+                result.update(status="ok", size=output_path.stat().st_size)
+                async for chunk in iterate_in_threadpool(archive.add_file(job.name, str(output_path))):
+                    if chunk:
+                        yield chunk
+                await asyncio.to_thread(output_path.unlink)
+            else:
+                result.update(status="error", error=error)
+            results.append(result)
+
+        failed = sum(result["status"] == "error" for result in results)
+        yield archive.add_json(MANIFEST_NAME, {"jobs": len(jobs), "failed": failed, "results": results})
+        yield archive.close()
+    finally:
+        for task in pending:
+            task.cancel()
+        await close_workspace(workspace)
+
+@app.post("/api/batch", openapi_extra=multipart_openapi("files"))
+async def batch_endpoint(
+    request: Request,
+    image_sets: bool = False,
+    resize_quality: str = DEFAULT_RESIZE_QUALITY,
+    dpi: int = 144,
+    image_quality: int = 75,
+    color_mode: str = "no-change",
+    optimize_level: int = DEFAULT_OPTIMIZE_LEVEL
+):
+    """
+    Run many independent conversions in one request: every uploaded image
+    becomes its own PDF and every PDF is compressed (see batch.plan_jobs
+    for image_sets). Files can also be uploaded as ZIP archives. The
+    results are streamed back as a ZIP archive while the jobs run, in the
+    order they finish, followed by manifest.json with each job's outcome.
+    """
+    validate_image_request(resize_quality)
+    validate_compress_request(dpi, image_quality, color_mode, optimize_level)
+    workspace, uploads = await receive_into_workspace(
+        request, "files", "batch", memory_limit=0, max_files=BATCH_MAX_FILES
+    )
+    try:
+        inputs = await asyncio.to_thread(collect_inputs, uploads, workspace.path)
+    except InputTooLarge as e:
+        await close_workspace(workspace)
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        await close_workspace(workspace)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        await close_workspace(workspace)
+        raise
+
+    jobs = plan_jobs(inputs, image_sets=image_sets)
+    options = {
+        # Batch jobs run in parallel with each other rather than spreading one over processes
+        "image-to-pdf": {"resize_quality": resize_quality, "workers": 1},
+        "compress-pdf": {
+            "dpi": dpi,
+            "image_quality": image_quality,
+            "color_mode": color_mode,
+            "optimize_level": optimize_level,
+        },
+    }
+    return StreamingResponse(
+        stream_batch(jobs, workspace, options),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": 'attachment; filename="batch.zip"',
+            "X-Batch-Jobs": str(len(jobs)),
+        }
+    )
+
+# Asynchronous job API: uploads are handed to the Celery workers and the
+# client polls for the result instead of holding the connection open.
+# Each job's inputs and output live in its workspace until it expires.
+
+def job_response(job_id: str) -> dict:
+    return {
+        "job_id": job_id,
+        "status": "PENDING",
+        "status_url": f"/api/jobs/{job_id}",
+        "download_url": f"/api/jobs/{job_id}/download",
+    }
+
+async def receive_job_uploads(request: Request, field: str, kind: str, **kwargs) -> Tuple[Workspace, List[str]]:
+    """Receive the uploads of a job into a new workspace; jobs always go to disk"""
+    workspace, uploads = await receive_into_workspace(request, field, kind, memory_limit=0, **kwargs)
+    return workspace, [upload.path for upload in uploads]
+
+async def admit_job(workspace: Workspace, estimator, *args, **kwargs) -> str:
+    """
+    Estimate a job's cost and pick its Celery queue (lane); the workspace
+    is removed if the job is refused.
+    """
+    try:
+        return job_queue(await estimate_cost(estimator, *args, **kwargs))
+    except HTTPException:
+        await close_workspace(workspace)
+        raise
+
+async def enqueue(task, inputs, workspace: Workspace, queue: str = FAST_QUEUE, **kwargs) -> dict:
+    """
+    Submit a Celery task called as task(inputs, output_path, **kwargs) to
+    the given queue, with that lane's time limits. The job id is the
+    workspace's, and the workspace is removed if the task cannot be queued.
+    """
+    output_path = workspace.path / "output.pdf"
+    soft_time_limit, time_limit = QUEUE_TIME_LIMITS[queue]
+    try:
+        # The inputs must outlive the wait in the queue (see tasks._keep_workspace)
+        await asyncio.to_thread(workspace_store.extend, workspace.job_id, JOB_QUEUE_TTL)
+        # Talks to the broker (or, when eager, runs the whole task): off the event loop
+        await asyncio.to_thread(
+            task.apply_async,
+            args=[inputs, str(output_path)],
+            kwargs=kwargs,
+            task_id=workspace.job_id,
+            queue=queue,
+            soft_time_limit=soft_time_limit,
+            time_limit=time_limit,
+            headers=task_headers()
+        )
+    except Exception as e:
+        await close_workspace(workspace)
+        raise HTTPException(status_code=503, detail=f"Job queue unavailable: {e}")
+    return job_response(workspace.job_id)
+
+@app.post("/api/jobs/image-to-pdf", status_code=202, openapi_extra=multipart_openapi("files"))
+async def submit_image_to_pdf_job(
+    request: Request,
+    resize_quality: str = DEFAULT_RESIZE_QUALITY
+):
+    """Queue an image to PDF conversion"""
+    validate_image_request(resize_quality)
+    workspace, uploaded_files = await receive_job_uploads(request, "files", "image")
+    queue = await admit_job(workspace, estimate_image_to_pdf, uploaded_files, resize_quality=resize_quality)
+    return await enqueue(process_image_to_pdf, uploaded_files, workspace, queue, resize_quality=resize_quality)
+
+@app.post("/api/jobs/merge-pdf", status_code=202, openapi_extra=multipart_openapi("files"))
+async def submit_merge_pdf_job(
+    request: Request,
+    optimize_level: int = DEFAULT_OPTIMIZE_LEVEL
+):
+    """Queue a PDF merge"""
+    validate_optimize_level(optimize_level)
+    workspace, uploaded_files = await receive_job_uploads(request, "files", "pdf", min_files=2)
+    queue = await admit_job(workspace, estimate_merge, uploaded_files)
+    return await enqueue(process_merge_pdf, uploaded_files, workspace, queue, optimize_level=optimize_level)
+
+@app.post("/api/jobs/compress-pdf", status_code=202, openapi_extra=multipart_openapi("file", many=False))
+async def submit_compress_pdf_job(
+    request: Request,
+    dpi: int = 144,
+    image_quality: int = 75,
+    color_mode: str = "no-change",
+    optimize_level: int = DEFAULT_OPTIMIZE_LEVEL
+):
+    """Queue a PDF compression"""
+    validate_compress_request(dpi, image_quality, color_mode, optimize_level)
+    workspace, uploaded_files = await receive_job_uploads(request, "file", "pdf", max_files=1)
+    queue = await admit_job(workspace, estimate_compress, uploaded_files[0])
+    return await enqueue(
+        process_compress_pdf,
+        uploaded_files[0],
+        workspace,
+        queue,
+        dpi=dpi,
+        image_quality=image_quality,
+        color_mode=color_mode,
+        optimize_level=optimize_level
+    )
+
+@app.post("/api/jobs/pipeline", status_code=202, openapi_extra=multipart_openapi("files"))
+async def submit_pipeline_job(request: Request, steps: str):
+    """
+    Queue a pipeline of image-to-pdf, merge-pdf and compress-pdf steps
+    (JSON, see tools.pipeline.parse_steps) over images and PDFs uploaded
+    together. All steps run in one worker with the intermediate documents
+    in memory; only the final PDF is stored for download.
+    """
+    try:
+        parsed = parse_steps(steps)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    workspace, uploaded_files = await receive_job_uploads(request, "files", "any")
+    try:
+        check_inputs(parsed, [upload_kind(path) for path in uploaded_files])
+    except ValueError as e:
+        await close_workspace(workspace)
+        raise HTTPException(status_code=400, detail=str(e))
+    queue = await admit_job(workspace, estimate_pipeline, parsed, uploaded_files)
+    return await enqueue(process_pipeline, uploaded_files, workspace, queue, steps=steps)
+
+def job_state(job_id: str) -> dict:
+    """State of a job, with its progress while it runs; queries the result backend"""
+    result = AsyncResult(job_id, app=celery_app)
+    state = result.state
+    response = {"job_id": job_id, "status": state}
+
+    if state == "SUCCESS":
+        response["download_url"] = f"/api/jobs/{job_id}/download"
+    elif state == "FAILURE":
+        response["error"] = str(result.result)
+    elif state == "PROGRESS":
+        progress = result.info
+        # The job may have finished between the two backend reads
+        if isinstance(progress, dict) and "stage" in progress:
+            progress["percent"] = round(100 * progress["done"] / progress["total"]) if progress["total"] else 0
+            response["progress"] = progress
+
+    return response
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Report the state of a queued job, and its progress while it runs"""
+    return await asyncio.to_thread(job_state, job_id)
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Server-Sent Events stream of a job's state (as from GET /api/jobs/{job_id}):
+    one event whenever its status or progress changes, until it has
+    finished or JOB_EVENTS_MAX_SECONDS have passed, after which
+    EventSource clients reconnect by themselves.
+    """
+    async def events():
+        yield f"retry: {JOB_EVENTS_RETRY_MS}\n\n"
+        last = None
+        started = quiet_since = time.monotonic()
+        while True:
+            state = await asyncio.to_thread(job_state, job_id)
+            now = time.monotonic()
+            if state != last:
+                yield f"data: {json.dumps(state)}\n\n"
+                last = state
+                quiet_since = now
+            elif now - quiet_since >= JOB_EVENTS_KEEPALIVE:
+                yield ": keep-alive\n\n"
+                quiet_since = now
+            if state["status"] in FINISHED_STATES or now - started >= JOB_EVENTS_MAX_SECONDS:
+                return
+            await asyncio.sleep(JOB_EVENTS_INTERVAL)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def job_outcome(job_id: str) -> Tuple[str, object]:
+    """A job's state and result (or error); queries the result backend"""
+    result = AsyncResult(job_id, app=celery_app)
+    state = result.state
+    return state, result.result
+
+@app.get("/api/jobs/{job_id}/download")
+async def job_download(job_id: str):
+    """Download the output of a finished job"""
+    state, outcome = await asyncio.to_thread(job_outcome, job_id)
+
+    if state == "FAILURE":
+        raise HTTPException(status_code=409, detail=f"Job failed: {outcome}")
+    if state != "SUCCESS":
+        raise HTTPException(status_code=409, detail=f"Job is not finished (status: {state})")
+
+    output_path = Path(outcome["output_path"])
+    if output_path.parent.resolve() != workspace_store.path_for(job_id).resolve() or not output_path.is_file():
+        raise HTTPException(status_code=404, detail="Job output has expired")
+
+    return FileResponse(
+        path=output_path,
+        media_type="application/pdf",
+        filename=outcome.get("filename", "result.pdf")
+    )
+
 if __name__ == "__main__":
     import uvicorn
     import os
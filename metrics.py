@@ -0,0 +1,191 @@
+from typing import Dict, Iterable
+import logging
+import os
+import resource
+import time
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from tools import instrument
+
+logger = logging.getLogger(__name__)
+
+# When set, every process (gunicorn and Celery workers) writes its samples to
+# this directory and /metrics aggregates them. It must be set, and emptied,
+# before any of the processes start (see startup.sh).
+MULTIPROCESS_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "pdf_stage_seconds",
+    "Time spent in each stage of a tool, including upload and download",
+    ["tool", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+_COUNTERS: Dict[str, Counter] = {
+    "bytes_in": Counter("pdf_input_bytes", "Bytes received for a tool", ["tool"]),
+    "bytes_out": Counter("pdf_output_bytes", "Bytes produced by a tool", ["tool"]),
+    "pages": Counter("pdf_pages", "Pages written by a tool", ["tool"]),
+    "images": Counter("pdf_images", "Images converted or recompressed by a tool", ["tool"]),
+}
+
+EXECUTOR_PENDING = Gauge(
+    "pdf_executor_pending", "PDF jobs running or waiting on the API executors", multiprocess_mode="livesum"
+)
+EXECUTOR_QUEUED = Gauge(
+    "pdf_executor_queued", "PDF jobs waiting for an API executor thread", multiprocess_mode="livesum"
+)
+RESIDENT_MEMORY = Gauge(
+    "pdf_process_resident_memory_bytes", "Resident set size of each API and Celery process",
+    multiprocess_mode="liveall",
+)
+
+
+class _PrometheusRecorder:
+    """Feeds the stages and counts reported by the tools into the metrics above."""
+
+    def observe_stage(self, tool: str, stage: str, seconds: float) -> None:
+        STAGE_SECONDS.labels(tool, stage).observe(seconds)
+
+    def count(self, tool: str, name: str, amount: int) -> None:
+        _COUNTERS[name].labels(tool).inc(amount)
+
+
+instrument.set_recorder(_PrometheusRecorder())
+
+
+def _resident_memory() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # No procfs: fall back to the peak, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def sample_process() -> None:
+    """Record this process's current memory use."""
+    RESIDENT_MEMORY.set(_resident_memory())
+
+
+def track_executor(executor) -> None:
+    """Publish a BoundedExecutor's depth whenever it changes."""
+    def update(executor) -> None:
+        EXECUTOR_PENDING.set(executor.pending)
+        EXECUTOR_QUEUED.set(executor.queued)
+
+    executor.on_change = update
+    update(executor)
+
+
+def count_io(tool: str, bytes_in: int, bytes_out: int) -> None:
+    instrument.count(tool, "bytes_in", bytes_in)
+    instrument.count(tool, "bytes_out", bytes_out)
+
+
+def mark_process_dead(pid: int) -> None:
+    """Drop the live gauges of a process that exited (gunicorn and Celery hooks)."""
+    if MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+class CeleryQueueCollector:
+    """
+    Reports the number of messages waiting in each Celery queue. The broker
+    is asked at scrape time, so the value is the same whichever worker
+    serves /metrics.
+    """
+
+    def __init__(self, celery_app, queues: Iterable[str]):
+        self.celery_app = celery_app
+        self.queues = sorted(set(queues))
+
+    def collect(self):
+        depth = GaugeMetricFamily("pdf_celery_queue_depth", "Messages waiting in a Celery queue", labels=["queue"])
+        try:
+            with self.celery_app.connection_for_read() as conn:
+                conn.ensure_connection(max_retries=1)
+                channel = conn.default_channel
+                for queue in self.queues:
+                    depth.add_metric([queue], channel.queue_declare(queue=queue, passive=True).message_count)
+        except Exception as e:
+            logger.debug(f"Could not read Celery queue depth: {e}")
+        yield depth
+
+
+def render(*collectors) -> bytes:
+    """
+    Prometheus text exposition of all processes' metrics plus the given
+    scrape-time collectors.
+    """
+    sample_process()
+    if MULTIPROCESS_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    output = generate_latest(registry)
+
+    extra = CollectorRegistry(auto_describe=False)
+    for collector in collectors:
+        extra.register(collector)
+    return output + generate_latest(extra)
+
+
+class StageTimingMiddleware:
+    """
+    ASGI middleware timing the transfer stages of the synchronous tool
+    endpoints: upload (request start until the body has been received) and
+    download (response start until the last byte was sent), and counting
+    the request and response body bytes.
+    """
+
+    def __init__(self, app, paths: Dict[str, str]):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send) -> None:
+        tool = self.paths.get(scope["path"]) if scope["type"] == "http" else None
+        if tool is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        received = sent = 0
+        response_start = None
+
+        async def timed_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    STAGE_SECONDS.labels(tool, "upload").observe(time.perf_counter() - start)
+            return message
+
+        async def timed_send(message) -> None:
+            nonlocal sent, response_start
+            if message["type"] == "http.response.start":
+                response_start = time.perf_counter()
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                STAGE_SECONDS.labels(tool, "download").observe(time.perf_counter() - response_start)
+
+        try:
+            await self.app(scope, timed_receive, timed_send)
+        finally:
+            count_io(tool, received, sent)
+            sample_process()
@@ -0,0 +1,248 @@
+from pathlib import Path
+from typing import Any, Callable, List, Optional
+import contextvars
+import cProfile
+import functools
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import shutil
+import threading
+import time
+import tracemalloc
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Profiling on request is only possible when a token is configured
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+# Fraction of tool requests and Celery tasks profiled without being asked
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR", "profiles"))
+# Older profiles beyond this number are deleted
+PROFILE_MAX_ARTIFACTS = int(os.environ.get("PROFILE_MAX_ARTIFACTS", "100"))
+
+# Header that carries PROFILE_TOKEN, both to profile a request and to download profiles
+PROFILE_HEADER = "x-profile-token"
+# Artifacts written for every profile
+ARTIFACTS = ("summary.txt", "profile.pstats")
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_FRAMES = 10
+
+# tracemalloc is process-wide, so only one profile at a time records allocations
+_tracemalloc_lock = threading.Lock()
+
+
+class ProfileSession:
+    """A request or task that is being profiled, identified by profile_id."""
+
+    def __init__(self, label: str, profile_id: Optional[str] = None):
+        self.profile_id = profile_id or uuid.uuid4().hex
+        self.label = label
+        # Whether any work was handed to the session; cache hits do none
+        self.used = False
+        self._profile: Optional[cProfile.Profile] = None
+        self._traced = False
+        self._start = 0.0
+
+    def start(self) -> None:
+        """Start profiling the calling thread, and allocations if no other profile records them."""
+        self._traced = _tracemalloc_lock.acquire(blocking=False)
+        if self._traced and tracemalloc.is_tracing():
+            # Started by someone else (e.g. PYTHONTRACEMALLOC); leave it alone
+            _tracemalloc_lock.release()
+            self._traced = False
+        if self._traced:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._profile = cProfile.Profile()
+        self._start = time.perf_counter()
+        self._profile.enable()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Stop profiling (on the thread that started it) and store the artifacts."""
+        self._profile.disable()
+        wall = time.perf_counter() - self._start
+        snapshot = None
+        peak = 0
+        if self._traced:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            _tracemalloc_lock.release()
+        try:
+            self._save(self._profile, snapshot, peak, wall, error)
+        except Exception as e:
+            logger.error(f"Could not store profile {self.profile_id}: {e}")
+
+    def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run fn under the profiler and store the artifacts."""
+        self.start()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(e)
+            raise
+        self.finish()
+        return result
+
+    def _save(self, profile: cProfile.Profile, snapshot, peak: int, wall: float, error: Optional[BaseException]) -> None:
+        directory = PROFILE_DIR / self.profile_id
+        directory.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(str(directory / "profile.pstats"))
+
+        out = io.StringIO()
+        out.write(f"Profile {self.profile_id}: {self.label}\n")
+        out.write(f"Wall time: {wall:.3f}s\n")
+        if error is not None:
+            out.write(f"Failed: {error!r}\n")
+        out.write(f"\nTop {TOP_FUNCTIONS} functions by cumulative time:\n")
+        pstats.Stats(profile, stream=out).strip_dirs().sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+
+        if snapshot is None:
+            out.write("\nAllocations were not recorded (another profile was tracing)\n")
+        else:
+            snapshot = snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ))
+            stats = snapshot.statistics("lineno")
+            total = sum(stat.size for stat in stats)
+            out.write(f"\nPeak Python allocations: {peak / 2**20:.1f} MiB (image buffers are not included)\n")
+            out.write(f"Still allocated at the end: {total / 2**20:.1f} MiB; top {TOP_ALLOCATIONS}:\n")
+            for stat in stats[:TOP_ALLOCATIONS]:
+                out.write(f"{stat}\n")
+        (directory / "summary.txt").write_text(out.getvalue())
+        logger.info(f"Stored profile {self.profile_id} for {self.label}")
+        _prune()
+
+
+_current: contextvars.ContextVar[Optional[ProfileSession]] = contextvars.ContextVar("profile_session", default=None)
+
+
+def profiled(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Return fn, or a wrapper that profiles it if the current request is
+    being profiled. Call this in the request's context; the wrapper may then
+    run on any thread.
+    """
+    session = _current.get()
+    if session is None:
+        return fn
+    session.used = True
+    return functools.partial(session.run, fn)
+
+
+def token_matches(token: Optional[str]) -> bool:
+    return bool(PROFILE_TOKEN) and token is not None and hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+def should_sample() -> bool:
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _prune() -> None:
+    if PROFILE_MAX_ARTIFACTS <= 0:
+        return
+    profiles = sorted((p for p in PROFILE_DIR.iterdir() if p.is_dir()), key=lambda p: p.stat().st_mtime)
+    for old in profiles[:-PROFILE_MAX_ARTIFACTS]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def list_profiles() -> List[dict]:
+    if not PROFILE_DIR.is_dir():
+        return []
+    profiles = []
+    for directory in sorted(PROFILE_DIR.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True):
+        summary = directory / "summary.txt"
+        if summary.is_file():
+            with open(summary) as f:
+                label = f.readline().strip().partition(": ")[2]
+            profiles.append({"profile_id": directory.name, "label": label, "created": directory.stat().st_mtime})
+    return profiles
+
+
+def artifact_path(profile_id: str, artifact: str) -> Optional[Path]:
+    """Path of a stored artifact, or None if it does not exist or the name is not valid."""
+    if artifact not in ARTIFACTS or not profile_id.isalnum():
+        return None
+    path = PROFILE_DIR / profile_id / artifact
+    return path if path.is_file() else None
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that starts a ProfileSession for tool requests (POSTs
+    under /api/) carrying the profiling token, and for a sample of the
+    others. Costs one header lookup per request when nothing is profiled.
+    The profile id is returned in the X-Profile-Id response header, unless
+    the request did no profiled work (e.g. a cache hit) and so stores none.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        token = None
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER.encode():
+                token = value.decode("latin-1")
+                break
+        if not token_matches(token) and not should_sample():
+            await self.app(scope, receive, send)
+            return
+
+        session = ProfileSession(f"{scope['method']} {scope['path']}")
+
+        async def send_with_id(message) -> None:
+            if message["type"] == "http.response.start" and session.used:
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", session.profile_id.encode())]
+            await send(message)
+
+        reset = _current.set(session)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _current.reset(reset)
+
+
+# Celery: the API passes the session's id in the task headers; tasks can
+# also be sampled on their own
+
+_task_sessions = {}
+
+
+def task_headers() -> dict:
+    """Headers for apply_async that make the task profile into the current session."""
+    session = _current.get()
+    if session is None:
+        return {}
+    session.used = True
+    return {"profile_id": session.profile_id}
+
+
+def start_task_profile(task_id: str, task_name: str, profile_id: Optional[str]) -> None:
+    """task_prerun: begin profiling the task if it was asked for or sampled."""
+    if profile_id is not None and not profile_id.isalnum():
+        profile_id = None
+    if profile_id is None and not should_sample():
+        return
+    session = ProfileSession(f"task {task_name} {task_id}", profile_id)
+    _task_sessions[task_id] = session
+    session.start()
+
+
+def finish_task_profile(task_id: str, error: Optional[BaseException] = None) -> None:
+    """task_postrun: stop and store the task's profile."""
+    session = _task_sessions.pop(task_id, None)
+    if session is not None:
+        session.finish(error)
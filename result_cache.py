@@ -0,0 +1,228 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever a tool's output for the same inputs changes, so results
+# produced by older code are no longer served
+CACHE_KEY_VERSION = 4
+
+
+def make_cache_key(operation: str, input_hashes: Iterable[str], **params) -> str:
+    """
+    Build a content-addressed cache key from the operation name, the
+    content hashes of its inputs (order matters) and its parameters.
+    """
+    payload = json.dumps(
+        {
+            "version": CACHE_KEY_VERSION,
+            "operation": operation,
+            "inputs": list(input_hashes),
+            "params": params,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Size-bounded, content-addressed store for finished PDF outputs.
+
+    Results live as files under directory/<key[:2]>/<key>.pdf. A SQLite
+    index next to them records each entry's size and last access time plus
+    the hit/miss counters, so every gunicorn worker and Celery worker on the
+    host shares the same cache and statistics. When the total size exceeds
+    max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._db_path = self.directory / "index.sqlite3"
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)")
+            db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            db.execute(
+                "INSERT OR IGNORE INTO counters (name, value) VALUES"
+                " ('hits', 0), ('misses', 0), ('stores', 0), ('evictions', 0)"
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def _path_for(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.pdf"
+
+    @staticmethod
+    def _bump(db: sqlite3.Connection, name: str, amount: int = 1) -> None:
+        db.execute("UPDATE counters SET value = value + ? WHERE name = ?", (amount, name))
+
+    def get(self, key: str, count: bool = True) -> Optional[Path]:
+        """
+        Return the stored result for key and mark it as recently used, or
+        None on a miss. Requests that look up the same key more than once
+        pass count=False and report their outcome once with count_lookup().
+        """
+        if not self.enabled:
+            return None
+        path = self._path_for(key)
+        with self._transaction() as db:
+            updated = db.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            ).rowcount
+            if updated and path.is_file():
+                if count:
+                    self._bump(db, "hits")
+                return path
+            if updated:
+                # File vanished underneath the index; forget the entry
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if count:
+                self._bump(db, "misses")
+        return None
+
+    def count_lookup(self, hit: bool) -> None:
+        """Count the outcome of a request's uncounted lookups as one hit or miss."""
+        if not self.enabled:
+            return
+        with self._transaction() as db:
+            self._bump(db, "hits" if hit else "misses")
+
+    def put(self, key: str, source_path: str) -> Optional[Path]:
+        """
+        Store a copy of source_path under key and evict old entries if the
+        cache is over budget. The source file is left in place.
+
+        Returns:
+            Path of the stored entry, or None if it was not cached
+        """
+        if not self.enabled:
+            return None
+        size = Path(source_path).stat().st_size
+        if size > self.max_bytes:
+            return None
+
+        def link_or_copy(tmp_path: Path) -> None:
+            # Hard link when possible (same filesystem), otherwise copy
+            try:
+                os.link(source_path, tmp_path)
+            except OSError:
+                shutil.copyfile(source_path, tmp_path)
+
+        return self._store(key, size, link_or_copy)
+
+    def put_bytes(self, key: str, data: bytes) -> Optional[Path]:
+        """
+        Store an in-memory result under key, see put().
+
+        Returns:
+            Path of the stored entry, or None if it was not cached
+        """
+        if not self.enabled or len(data) > self.max_bytes:
+            return None
+        return self._store(key, len(data), lambda tmp_path: tmp_path.write_bytes(data))
+
+    def put_stream(self, key: str, fp: BinaryIO) -> Optional[Path]:
+        """
+        Store the contents of a readable, seekable binary file under key,
+        see put().
+
+        Returns:
+            Path of the stored entry, or None if it was not cached
+        """
+        if not self.enabled:
+            return None
+        size = fp.seek(0, os.SEEK_END)
+        if size > self.max_bytes:
+            return None
+
+        def copy(tmp_path: Path) -> None:
+            fp.seek(0)
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(fp, f)
+
+        return self._store(key, size, copy)
+
+    def _store(self, key: str, size: int, write: Callable[[Path], None]) -> Optional[Path]:
+        """Create the entry file through write(tmp_path), then index it and evict."""
+        path = self._path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{uuid.uuid4()}.tmp")
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            tmp_path.unlink(missing_ok=True)
+            logger.warning(f"Could not store cache entry {key}: {e}")
+            return None
+
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO entries (key, size, last_access) VALUES (?, ?, ?)",
+                (key, size, time.time()),
+            )
+            self._bump(db, "stores")
+            self._evict(db)
+        return path
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in db.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._path_for(key).unlink(missing_ok=True)
+            self._bump(db, "evictions")
+            total -= size
+
+    def stats(self) -> dict:
+        with self._transaction() as db:
+            counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "hit_ratio": counters["hits"] / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+result_cache = ResultCache(
+    directory=os.environ.get("RESULT_CACHE_DIR", "cache"),
+    max_bytes=int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))),
+)
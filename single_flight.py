@@ -0,0 +1,146 @@
+from pathlib import Path
+from typing import Dict, Optional
+import asyncio
+import fcntl
+import os
+import time
+
+SINGLE_FLIGHT_DIR = os.environ.get(
+    "SINGLE_FLIGHT_DIR", os.path.join(os.environ.get("RESULT_CACHE_DIR", "cache"), "inflight")
+)
+# How long a request waits for an identical one to finish before it does the work itself
+SINGLE_FLIGHT_WAIT = float(os.environ.get("SINGLE_FLIGHT_WAIT", "120"))
+# Seconds between attempts to take a key another worker process holds
+POLL_INTERVAL = 0.05
+
+
+class _LocalKey:
+    """The in-process side of a key: a lock and how many requests use it."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class Flight:
+    """
+    The right to produce the result of one key, held until release().
+    waited tells whether another request held the key first; its result
+    may then already be stored.
+    """
+
+    def __init__(self, owner: "SingleFlight", key: str, local: Optional[_LocalKey], fd: Optional[int], waited: bool):
+        self._owner = owner
+        self.key = key
+        self._local = local
+        self._fd = fd
+        self.waited = waited
+
+    def release(self) -> None:
+        """Let the next request with the same key in; safe to call more than once."""
+        if self._fd is not None:
+            # Unlink before unlocking, so a waiter never locks a file
+            # nobody else can find (it checks the inode after locking)
+            self._owner._lock_path(self.key).unlink(missing_ok=True)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        if self._local is not None:
+            if self._local.lock.locked():
+                self._local.lock.release()
+            self._owner._leave(self.key, self._local)
+            self._local = None
+
+
+class SingleFlight:
+    """
+    Lets only one request at a time produce the result for a key, across
+    the coroutines of this process (an asyncio lock) and all worker
+    processes of the host (an flock on directory/<key>.lock). The others
+    wait and then find the result in the result cache instead of
+    recomputing it. Waiting is bounded by wait_timeout, after which the
+    request goes ahead on its own.
+    """
+
+    def __init__(self, directory: str, wait_timeout: float):
+        self.directory = Path(directory)
+        self.wait_timeout = wait_timeout
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._keys: Dict[str, _LocalKey] = {}
+        self.waited = 0
+        self.timeouts = 0
+
+    def _lock_path(self, key: str) -> Path:
+        return self.directory / f"{key}.lock"
+
+    def _leave(self, key: str, local: _LocalKey) -> None:
+        local.users -= 1
+        if local.users == 0 and self._keys.get(key) is local:
+            del self._keys[key]
+
+    async def acquire(self, key: str) -> Flight:
+        """Wait until no other request on this host holds key, then hold it."""
+        local = self._keys.setdefault(key, _LocalKey())
+        local.users += 1
+        deadline = time.monotonic() + self.wait_timeout
+        waited = local.lock.locked()
+        try:
+            await asyncio.wait_for(local.lock.acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            self._leave(key, local)
+            self.timeouts += 1
+            return Flight(self, key, None, None, waited=True)
+        except BaseException:
+            self._leave(key, local)
+            raise
+
+        try:
+            fd, waited_elsewhere = await self._lock_file(key, deadline)
+        except BaseException:
+            local.lock.release()
+            self._leave(key, local)
+            raise
+        waited = waited or waited_elsewhere
+        if fd is None:
+            self.timeouts += 1
+        if waited:
+            self.waited += 1
+        return Flight(self, key, local, fd, waited)
+
+    async def _lock_file(self, key: str, deadline: float):
+        """Take the key's lock file, polling while another process holds it. Returns (fd or None, waited)."""
+        path = self._lock_path(key)
+        waited = False
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                waited = True
+                if time.monotonic() >= deadline:
+                    return None, waited
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            except BaseException:
+                os.close(fd)
+                raise
+            try:
+                same_file = os.fstat(fd).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                return fd, waited
+            # The holder removed the file as we locked it; start over on the new one
+            os.close(fd)
+            waited = True
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._keys),
+            "waited": self.waited,
+            "timeouts": self.timeouts,
+        }
+
+
+single_flight = SingleFlight(SINGLE_FLIGHT_DIR, SINGLE_FLIGHT_WAIT)
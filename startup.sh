@@ -31,27 +31,40 @@ mkdir -p /tmp/celery
 export CELERY_LOG_DIR=/tmp/celery
 export CELERY_PID_DIR=/tmp/celery
 
-# Start Celery worker in background with proper logging
-echo "Starting Celery worker..."
+# Shared directory in which every API and Celery process writes its metrics;
+# it must start empty so samples of earlier runs are not counted again
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+# Start one Celery worker per lane, so small jobs (pdf_fast) never wait
+# behind large ones (pdf_bulk)
+echo "Starting Celery workers..."
 celery -A celery_app worker \
+    --queues=pdf_fast \
+    --hostname=fast@%h \
     --loglevel=info \
-    --concurrency=2 \
-    --logfile=$CELERY_LOG_DIR/worker.log \
-    --pidfile=$CELERY_PID_DIR/worker.pid \
+    --concurrency=${FAST_WORKER_CONCURRENCY:-2} \
+    --logfile=$CELERY_LOG_DIR/worker-fast.log \
+    --pidfile=$CELERY_PID_DIR/worker-fast.pid \
     --detach
 
-# Start Celery beat scheduler in background with proper logging
-echo "Starting Celery beat scheduler..."
-celery -A celery_app beat \
+celery -A celery_app worker \
+    --queues=pdf_bulk \
+    --hostname=bulk@%h \
     --loglevel=info \
-    --logfile=$CELERY_LOG_DIR/beat.log \
-    --pidfile=$CELERY_PID_DIR/beat.pid \
+    --concurrency=${BULK_WORKER_CONCURRENCY:-1} \
+    --logfile=$CELERY_LOG_DIR/worker-bulk.log \
+    --pidfile=$CELERY_PID_DIR/worker-bulk.pid \
     --detach
 
+# No Celery beat: nothing is scheduled, expired job files are swept by the
+# API's workspace cleaner (workspaces.py)
+
 # Give Celery a moment to start
 sleep 2
 
-# Verify Celery is running
+# Verify the Celery workers are running
 if ! celery -A celery_app inspect ping > /dev/null 2>&1; then
     echo "WARNING: Celery worker may not be fully ready (this is normal on first start)"
 fi
@@ -0,0 +1,195 @@
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+import asyncio
+import logging
+import os
+
+from starlette.responses import FileResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks handed from a worker thread to the response
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(64 * 1024)))
+# Chunks a worker may run ahead of a slow client before it blocks
+STREAM_MAX_PENDING_CHUNKS = 8
+
+
+class TempFileResponse(FileResponse):
+    """
+    FileResponse for a temporary output: as soon as the response is over,
+    whether the transfer completed, failed or the client went away, the
+    file is deleted or on_close is awaited instead.
+    """
+
+    def __init__(self, *args: Any, on_close: Optional[Callable[[], Awaitable[None]]] = None, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self._on_close is not None:
+                await self._on_close()
+            else:
+                Path(self.path).unlink(missing_ok=True)
+
+
+class StreamCancelled(Exception):
+    """Raised in the worker when the client stops reading a streamed result."""
+
+
+class ChunkChannel:
+    """
+    Write-only file object that hands a worker thread's output to the event
+    loop in chunks of about STREAM_CHUNK_SIZE bytes. The writer blocks when
+    STREAM_MAX_PENDING_CHUNKS are waiting, so a slow client slows the job
+    down instead of letting the output pile up in memory. on_chunk is
+    called with every chunk in the worker thread, before it is handed over,
+    so it may block (e.g. write to disk) without stalling the event loop.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+        on_chunk: Optional[Callable[[bytes], None]] = None
+    ):
+        self._loop = loop
+        self._chunk_size = chunk_size
+        self._on_chunk = on_chunk
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_MAX_PENDING_CHUNKS)
+        self._buffer = bytearray()
+        self._cancelled = False
+
+    # Worker side
+
+    def write(self, data: bytes) -> int:
+        if self._cancelled:
+            raise StreamCancelled("Client stopped reading the result")
+        self._buffer += data
+        if len(self._buffer) >= self._chunk_size:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def finish(self, complete: bool = True) -> None:
+        """
+        Mark the end of the stream. What is still buffered is sent only if
+        the output is complete; after a failure it is dropped, so a job
+        that fails early never sends a byte.
+        """
+        if complete and self._buffer:
+            self._put(bytes(self._buffer))
+        self._buffer.clear()
+        self._put(None)
+
+    def _put(self, item: Optional[bytes]) -> None:
+        if self._cancelled:
+            return
+        if item is not None and self._on_chunk is not None:
+            self._on_chunk(item)
+        asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop).result()
+
+    # Event loop side
+
+    async def get(self) -> Optional[bytes]:
+        """Next chunk, or None once the worker is done."""
+        return await self._queue.get()
+
+    def cancel(self) -> None:
+        """Stop the stream; a worker blocked on a full queue is released."""
+        self._cancelled = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+
+def produce_into(channel: ChunkChannel, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run fn(*args, channel, **kwargs) in a worker and close the channel afterwards."""
+    try:
+        result = fn(*args, channel, **kwargs)
+    except BaseException:
+        channel.finish(complete=False)
+        raise
+    channel.finish()
+    return result
+
+
+def _discard_result(job: asyncio.Future) -> None:
+    if not job.cancelled() and job.exception() is not None:
+        logger.info(f"Streamed job stopped: {job.exception()}")
+
+
+async def stream_job(
+    start: Callable[[ChunkChannel], Awaitable[Any]],
+    on_chunk: Optional[Callable[[bytes], None]] = None,
+    on_complete: Optional[Callable[[], Awaitable[None]]] = None,
+    on_close: Optional[Callable[[], Awaitable[None]]] = None,
+    **response_kwargs: Any
+) -> StreamingResponse:
+    """
+    Start a job that writes its output to a ChunkChannel and stream that
+    output to the client while the job is still running.
+
+    The response is only returned once the first chunk exists, so a job
+    that fails (or is rejected) before producing any output raises here
+    and can still be answered with a normal error. A failure after that
+    aborts the transfer. on_chunk sees every chunk (in the job's worker
+    thread, see ChunkChannel), on_complete runs after
+    the job finished successfully and everything was sent, and on_close
+    always runs once the response is over.
+
+    Args:
+        start: Called with the channel; returns an awaitable for the job,
+            e.g. lambda channel: executor.run(produce_into, channel, fn, ...)
+        response_kwargs: Passed on to StreamingResponse (media_type, headers)
+    """
+    channel = ChunkChannel(asyncio.get_running_loop(), on_chunk=on_chunk)
+    job = asyncio.ensure_future(start(channel))
+    first_chunk = asyncio.ensure_future(channel.get())
+    try:
+        await asyncio.wait({job, first_chunk}, return_when=asyncio.FIRST_COMPLETED)
+        if not first_chunk.done() or first_chunk.result() is None:
+            # Rejected, failed or produced nothing: surface the job's outcome
+            first_chunk.cancel()
+            await job
+            raise RuntimeError("Job produced no output")
+    except BaseException:
+        channel.cancel()
+        if on_close is not None:
+            await on_close()
+        raise
+
+    async def body() -> AsyncIterator[bytes]:
+        chunk = first_chunk.result()
+        while chunk is not None:
+            yield chunk
+            chunk = await channel.get()
+        await job
+        if on_complete is not None:
+            await on_complete()
+
+    return _ChannelResponse(body(), channel, job, on_close, **response_kwargs)
+
+
+class _ChannelResponse(StreamingResponse):
+    """StreamingResponse that stops its job and runs on_close however the response ends."""
+
+    def __init__(self, content, channel: ChunkChannel, job: asyncio.Future, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self._channel = channel
+        self._job = job
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._channel.cancel()
+            if not self._job.done():
+                self._job.add_done_callback(_discard_result)
+            if self._on_close is not None:
+                await self._on_close()
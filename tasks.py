@@ -1,78 +1,167 @@
-from celery_app import celery_app
-from tools.image_to_pdf import convert_images_to_pdf
+from celery.signals import task_postrun, task_prerun, worker_process_shutdown
+from celery_app import BULK_QUEUE, QUEUE_TIME_LIMITS, celery_app
+from tools.image_to_pdf import convert_images_to_pdf, DEFAULT_RESIZE_QUALITY
 from tools.merge_pdf import merge_pdfs
 from tools.compress_pdf import compress_pdf
+from tools.pipeline import parse_steps, run_pipeline
+from tools.optimize_pdf import DEFAULT_OPTIMIZE_LEVEL
+from tools.instrument import Progress, ProgressCallback
 from pathlib import Path
 import logging
+import os
+import time
+
+import metrics
+import profiling
+from workspaces import WORKSPACE_TTL, workspace_store
 
 logger = logging.getLogger(__name__)
 
-@celery_app.task(name='tasks.process_image_to_pdf')
-def process_image_to_pdf(image_paths: list, output_path: str) -> dict:
+# Least time between two progress updates of a task (each is a backend write)
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "0.5"))
+# Processes that compress the page-range shards of a long PDF (see
+# tools.compress_pdf). Long PDFs run on the bulk lane, whose worker already
+# runs BULK_WORKER_CONCURRENCY jobs at once, so by default they share the CPUs
+BULK_WORKER_CONCURRENCY = int(os.environ.get("BULK_WORKER_CONCURRENCY", "1"))
+COMPRESS_PROCESSES = int(os.environ.get(
+    "COMPRESS_PROCESSES", str(max(1, (os.cpu_count() or 1) // BULK_WORKER_CONCURRENCY))
+))
+
+
+def _file_size(path: str) -> int:
     try:
-        convert_images_to_pdf(image_paths, output_path)
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _progress_reporter(task) -> ProgressCallback:
+    """Publish a tool's progress as the task's PROGRESS state, at most every PROGRESS_INTERVAL seconds."""
+    last = 0.0
+
+    def report(progress: Progress) -> None:
+        nonlocal last
+        now = time.monotonic()
+        if now - last < PROGRESS_INTERVAL and progress.done < progress.total:
+            return
+        last = now
+        task.update_state(state='PROGRESS', meta=progress._asdict())
+
+    return report
+
+
+@task_prerun.connect
+def _start_profile(task_id=None, task=None, **kwargs) -> None:
+    # Custom headers are request attributes on a worker, but stay in headers when run eagerly
+    request = task.request
+    profile_id = request.get("profile_id") or (request.headers or {}).get("profile_id")
+    profiling.start_task_profile(task_id, task.name, profile_id)
+
+
+@task_postrun.connect
+def _finish_task(task_id=None, **kwargs) -> None:
+    profiling.finish_task_profile(task_id)
+    metrics.sample_process()
+
+
+@task_prerun.connect
+def _keep_workspace(task_id=None, task=None, **kwargs) -> None:
+    """
+    Push back the expiry of the job's workspace (its id is the task's) when
+    the task starts, so it covers the run plus WORKSPACE_TTL for the download.
+    """
+    hard_limit = (task.request.timelimit or (None,))[0] or QUEUE_TIME_LIMITS[BULK_QUEUE][1]
+    if not workspace_store.extend(task_id, WORKSPACE_TTL + hard_limit):
+        logger.warning(f"Workspace of job {task_id} expired before the job started")
+
+
+@task_postrun.connect
+def _keep_output(task_id=None, state=None, **kwargs) -> None:
+    """Give a finished job's output a full WORKSPACE_TTL to be downloaded."""
+    if state == "SUCCESS":
+        workspace_store.extend(task_id, WORKSPACE_TTL)
+
+
+@worker_process_shutdown.connect
+def _mark_worker_dead(pid=None, **kwargs) -> None:
+    metrics.mark_process_dead(pid or os.getpid())
+
+@celery_app.task(bind=True, name='tasks.process_image_to_pdf')
+def process_image_to_pdf(self, image_paths: list, output_path: str,
+                         resize_quality: str = DEFAULT_RESIZE_QUALITY) -> dict:
+    try:
+        convert_images_to_pdf(image_paths, output_path, resize_quality=resize_quality,
+                              progress=_progress_reporter(self))
+        metrics.count_io("image-to-pdf", sum(map(_file_size, image_paths)), _file_size(output_path))
         return {
             'status': 'success',
             'output_path': output_path,
+            'filename': 'converted.pdf',
             'message': 'Images converted to PDF successfully'
         }
     except Exception as e:
         logger.error(f"Error converting images to PDF: {str(e)}")
+        raise
+    finally:
         for path in image_paths:
             Path(path).unlink(missing_ok=True)
-        raise
 
-@celery_app.task(name='tasks.process_merge_pdf')
-def process_merge_pdf(pdf_paths: list, output_path: str) -> dict:
+@celery_app.task(bind=True, name='tasks.process_merge_pdf')
+def process_merge_pdf(self, pdf_paths: list, output_path: str,
+                      optimize_level: int = DEFAULT_OPTIMIZE_LEVEL) -> dict:
     try:
-        merge_pdfs(pdf_paths, output_path)
+        merge_pdfs(pdf_paths, output_path, optimize_level=optimize_level,
+                   progress=_progress_reporter(self))
+        metrics.count_io("merge-pdf", sum(map(_file_size, pdf_paths)), _file_size(output_path))
         return {
             'status': 'success',
             'output_path': output_path,
+            'filename': 'merged.pdf',
             'message': 'PDFs merged successfully'
         }
     except Exception as e:
         logger.error(f"Error merging PDFs: {str(e)}")
+        raise
+    finally:
         for path in pdf_paths:
             Path(path).unlink(missing_ok=True)
-        raise
 
-@celery_app.task(name='tasks.process_compress_pdf')
-def process_compress_pdf(input_path: str, output_path: str, dpi: int = 144, 
-                        image_quality: int = 75, color_mode: str = "no-change") -> dict:
+@celery_app.task(bind=True, name='tasks.process_compress_pdf')
+def process_compress_pdf(self, input_path: str, output_path: str, dpi: int = 144, 
+                        image_quality: int = 75, color_mode: str = "no-change",
+                        optimize_level: int = DEFAULT_OPTIMIZE_LEVEL) -> dict:
     try:
-        compress_pdf(input_path, output_path, dpi, image_quality, color_mode)
+        compress_pdf(input_path, output_path, dpi, image_quality, color_mode,
+                     optimize_level=optimize_level, progress=_progress_reporter(self),
+                     processes=COMPRESS_PROCESSES)
+        metrics.count_io("compress-pdf", _file_size(input_path), _file_size(output_path))
         return {
             'status': 'success',
             'output_path': output_path,
+            'filename': 'compressed.pdf',
             'message': 'PDF compressed successfully'
         }
     except Exception as e:
         logger.error(f"Error compressing PDF: {str(e)}")
-        Path(input_path).unlink(missing_ok=True)
         raise
+    finally:
+        Path(input_path).unlink(missing_ok=True)
 
-@celery_app.task(name='tasks.cleanup_old_files')
-def cleanup_old_files(directory: str, max_age_hours: int = 1) -> dict:
-    from datetime import datetime, timedelta
-    
+@celery_app.task(bind=True, name='tasks.process_pipeline')
+def process_pipeline(self, input_paths: list, output_path: str, steps: str) -> dict:
+    """Run a pipeline (see tools.pipeline) with its intermediate results in memory."""
     try:
-        cleaned_count = 0
-        dir_path = Path(directory)
-        now = datetime.now()
-        
-        for file_path in dir_path.glob("*"):
-            if file_path.is_file():
-                file_age = now - datetime.fromtimestamp(file_path.stat().st_mtime)
-                if file_age > timedelta(hours=max_age_hours):
-                    file_path.unlink()
-                    cleaned_count += 1
-        
+        run_pipeline(parse_steps(steps), input_paths, output_path, progress=_progress_reporter(self))
+        metrics.count_io("pipeline", sum(map(_file_size, input_paths)), _file_size(output_path))
         return {
             'status': 'success',
-            'cleaned_count': cleaned_count,
-            'directory': directory
+            'output_path': output_path,
+            'filename': 'processed.pdf',
+            'message': 'Pipeline completed successfully'
         }
     except Exception as e:
-        logger.error(f"Error cleaning up files: {str(e)}")
+        logger.error(f"Error running pipeline: {str(e)}")
         raise
+    finally:
+        for path in input_paths:
+            Path(path).unlink(missing_ok=True)
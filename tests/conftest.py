@@ -0,0 +1,130 @@
+import atexit
+import io
+import os
+import shutil
+import tempfile
+from typing import Dict, List
+
+# The API modules create their stores on import; keep them out of the checkout
+_RUNTIME_DIR = tempfile.mkdtemp(prefix="pdf-tools-tests-")
+atexit.register(shutil.rmtree, _RUNTIME_DIR, ignore_errors=True)
+for _name, _directory in (("WORKSPACE_DIR", "workspaces"), ("RESULT_CACHE_DIR", "cache"), ("PROFILE_DIR", "profiles")):
+    os.environ.setdefault(_name, os.path.join(_RUNTIME_DIR, _directory))
+# Background jobs run inline, without Redis
+os.environ.setdefault("CELERY_TASK_ALWAYS_EAGER", "1")
+
+import pytest
+from PIL import Image
+from pypdf import PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, NameObject, NumberObject, StreamObject
+
+
+def jpeg_image(writer: PdfWriter, size, seed: int, quality: int = 90) -> object:
+    """Add a noisy RGB JPEG image XObject to the writer; returns its reference."""
+    buffer = io.BytesIO()
+    Image.effect_noise(size, 20 + seed % 50).convert("RGB").save(buffer, "JPEG", quality=quality)
+    stream = StreamObject()
+    stream.set_data(buffer.getvalue())
+    stream.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Image"),
+        NameObject("/Width"): NumberObject(size[0]),
+        NameObject("/Height"): NumberObject(size[1]),
+        NameObject("/BitsPerComponent"): NumberObject(8),
+        NameObject("/ColorSpace"): NameObject("/DeviceRGB"),
+        NameObject("/Filter"): NameObject("/DCTDecode"),
+    })
+    return writer._add_object(stream)
+
+
+def add_page(writer: PdfWriter, content: bytes, resources: Dict[str, dict], size=(612, 792)):
+    page = writer.add_blank_page(*size)
+    page[NameObject("/Resources")] = DictionaryObject({
+        NameObject(category): DictionaryObject({NameObject(name): ref for name, ref in entries.items()})
+        for category, entries in resources.items()
+    })
+    contents = StreamObject()
+    contents.set_data(content)
+    page[NameObject("/Contents")] = writer._add_object(contents)
+    return page
+
+
+def to_bytes(writer: PdfWriter) -> bytes:
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+@pytest.fixture(scope="session")
+def client():
+    """The API under one lifespan; its shutdown stops the shared executor for good."""
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def text_and_image_pdf() -> bytes:
+    """Three text pages sharing a font, then two pages sharing one image."""
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    for number in range(1, 4):
+        add_page(writer, b"BT /F1 24 Tf 72 700 Td (Page %d) Tj ET" % number, {"/Font": {"/F1": font}})
+    image = jpeg_image(writer, (400, 300), seed=1)
+    for _ in range(2):
+        add_page(writer, b"q 400 0 0 300 72 300 cm /Im0 Do Q", {"/XObject": {"/Im0": image}})
+    return to_bytes(writer)
+
+
+@pytest.fixture
+def image_pdf():
+    """Factory for a one-page PDF showing one JPEG of the given size across the page."""
+    def make(size, quality: int = 90, page_size=(612, 792)) -> bytes:
+        writer = PdfWriter()
+        image = jpeg_image(writer, size, seed=7, quality=quality)
+        add_page(writer, b"q %d 0 0 %d 0 0 cm /Im0 Do Q" % page_size, {"/XObject": {"/Im0": image}}, page_size)
+        return to_bytes(writer)
+
+    return make
+
+
+@pytest.fixture
+def linked_pdf() -> bytes:
+    """Three pages; page 1 has a link annotation to page 3."""
+    writer = PdfWriter()
+    for number in range(1, 4):
+        add_page(writer, b"BT /F1 12 Tf 72 700 Td (Page %d) Tj ET" % number, {})
+    link = DictionaryObject({
+        NameObject("/Type"): NameObject("/Annot"),
+        NameObject("/Subtype"): NameObject("/Link"),
+        NameObject("/Rect"): ArrayObject([NumberObject(72), NumberObject(72), NumberObject(200), NumberObject(100)]),
+        NameObject("/Dest"): ArrayObject([writer.pages[2].indirect_reference, NameObject("/Fit")]),
+    })
+    writer.pages[0][NameObject("/Annots")] = ArrayObject([writer._add_object(link)])
+    return to_bytes(writer)
+
+
+@pytest.fixture
+def scanned_pdf() -> bytes:
+    """
+    120 pages with an image each; one image is shared between pages 4 and
+    100 (of different sizes), so it spans two shards of compress_pdf.
+    """
+    writer = PdfWriter()
+    shared = jpeg_image(writer, (900, 700), seed=99)
+    for index in range(120):
+        size = (1224, 1584) if index == 99 else (612, 792)
+        images: Dict[str, object] = {"/Im0": jpeg_image(writer, (300 + index, 200 + index), seed=index)}
+        content: List[bytes] = [b"q 500 0 0 400 50 50 cm /Im0 Do Q"]
+        if index in (3, 99):
+            images["/Sh"] = shared
+            content.append(b"q 200 0 0 150 50 600 cm /Sh Do Q")
+        add_page(writer, b"\n".join(content), {"/XObject": images}, size)
+    return to_bytes(writer)
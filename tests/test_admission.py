@@ -0,0 +1,224 @@
+import asyncio
+import io
+import os
+import time
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+import admission
+from admission import MemoryBudget, estimate_cost, job_queue
+from celery_app import BULK_QUEUE, FAST_QUEUE
+from executor import ExecutorBusy
+from tools.file_io import InputTooLarge, JobCost
+
+
+def test_reservations_within_capacity_start_at_once():
+    budget = MemoryBudget(100, wait_timeout=1)
+
+    async def run():
+        first = await budget.reserve(60)
+        second = await budget.reserve(40)
+        assert budget.stats() == {"capacity": 100, "reserved": 100, "waiting": 0}
+        first.release()
+        first.release()
+        assert budget.reserved == 40
+        second.release()
+
+    asyncio.run(run())
+    assert budget.reserved == 0
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    budget = MemoryBudget(100, wait_timeout=1)
+    admitted = []
+
+    async def run():
+        running = await budget.reserve(80)
+
+        async def wait(name, amount):
+            reservation = await budget.reserve(amount)
+            admitted.append(name)
+            return reservation
+
+        large = asyncio.ensure_future(wait("large", 90))
+        await asyncio.sleep(0)
+        # Would fit now, but must not overtake the earlier waiter
+        small = asyncio.ensure_future(wait("small", 10))
+        await asyncio.sleep(0.05)
+        assert admitted == []
+        assert budget.stats()["waiting"] == 2
+
+        running.release()
+        (await large).release()
+        (await small).release()
+
+    asyncio.run(run())
+    assert admitted == ["large", "small"]
+    assert budget.reserved == 0
+
+
+def test_waiting_too_long_gives_executor_busy():
+    budget = MemoryBudget(100, wait_timeout=0.1, retry_after=7)
+
+    async def run():
+        running = await budget.reserve(100)
+        start = time.monotonic()
+        with pytest.raises(ExecutorBusy) as raised:
+            await budget.reserve(1)
+        assert time.monotonic() - start >= 0.1
+        assert raised.value.retry_after == 7
+        assert budget.stats() == {"capacity": 100, "reserved": 100, "waiting": 0}
+        running.release()
+
+    asyncio.run(run())
+    assert budget.reserved == 0
+
+
+def test_cancelled_waiter_lets_the_next_one_in():
+    budget = MemoryBudget(100, wait_timeout=5)
+
+    async def run():
+        running = await budget.reserve(50)
+        blocked = asyncio.ensure_future(budget.reserve(80))
+        await asyncio.sleep(0)
+        behind = asyncio.ensure_future(budget.reserve(30))
+        await asyncio.sleep(0.05)
+        assert not behind.done()
+
+        blocked.cancel()
+        (await asyncio.wait_for(behind, 1)).release()
+        assert blocked.cancelled()
+        running.release()
+
+    asyncio.run(run())
+    assert budget.stats() == {"capacity": 100, "reserved": 0, "waiting": 0}
+
+
+def test_estimate_above_capacity_runs_alone():
+    budget = MemoryBudget(100, wait_timeout=0.05)
+
+    async def run():
+        huge = await budget.reserve(10_000)
+        assert huge.amount == 100
+        with pytest.raises(ExecutorBusy):
+            await budget.reserve(1)
+        huge.release()
+        # Once it is done, it no longer blocks anyone
+        (await budget.reserve(10_000)).release()
+
+    asyncio.run(run())
+    assert budget.reserved == 0
+
+
+def test_job_queue_thresholds(monkeypatch):
+    monkeypatch.setattr(admission, "SYNC_MAX_JOB_BYTES", 1000)
+    monkeypatch.setattr(admission, "FAST_MAX_BYTES", 100)
+    monkeypatch.setattr(admission, "FAST_MAX_PAGES", 10)
+    monkeypatch.setattr(admission, "FAST_MAX_PIXELS", 5000)
+
+    assert job_queue(JobCost(memory=1000, input_bytes=100, pages=10, pixels=5000)) == FAST_QUEUE
+    assert job_queue(JobCost(memory=1001, input_bytes=100, pages=10, pixels=5000)) == BULK_QUEUE
+    assert job_queue(JobCost(memory=1000, input_bytes=101, pages=10, pixels=5000)) == BULK_QUEUE
+    assert job_queue(JobCost(memory=1000, input_bytes=100, pages=11, pixels=5000)) == BULK_QUEUE
+    assert job_queue(JobCost(memory=1000, input_bytes=100, pages=10, pixels=5001)) == BULK_QUEUE
+
+
+def test_estimate_cost_refuses_what_cannot_run(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_JOB_BYTES", 1000)
+
+    def estimator(memory=0, error=None):
+        if error is not None:
+            raise error
+        return JobCost(memory=memory, input_bytes=0, pages=1, pixels=0)
+
+    assert asyncio.run(estimate_cost(estimator, memory=1000)).memory == 1000
+    for kwargs, status in (
+        ({"memory": 1001}, 413),
+        ({"error": InputTooLarge("Too many pixels")}, 413),
+        ({"error": ValueError("Not a PDF")}, 400),
+    ):
+        with pytest.raises(HTTPException) as raised:
+            asyncio.run(estimate_cost(estimator, **kwargs))
+        assert raised.value.status_code == status
+
+
+def photo() -> bytes:
+    buffer = io.BytesIO()
+    Image.effect_noise((64, 48), 40).convert("RGB").save(buffer, "JPEG")
+    # Unique bytes after the end of the image, so the result cache misses
+    return buffer.getvalue() + os.urandom(16)
+
+
+def test_reservation_is_released_when_the_job_fails():
+    import main
+
+    def fail():
+        raise RuntimeError("broken input")
+
+    async def run():
+        baseline = main.memory_budget.reserved
+        with pytest.raises(RuntimeError):
+            await main.run_admitted(1000, fail)
+        assert main.memory_budget.reserved == baseline
+
+    asyncio.run(run())
+
+
+def test_reservation_is_held_until_a_cancelled_request_s_job_ends():
+    import main
+
+    async def run():
+        baseline = main.memory_budget.reserved
+        request = asyncio.ensure_future(main.run_admitted(1000, time.sleep, 0.3))
+        await asyncio.sleep(0.1)
+        request.cancel()
+        await asyncio.sleep(0)
+        # The job still runs on the executor and still needs its memory
+        assert main.memory_budget.reserved == baseline + 1000
+        await asyncio.sleep(0.5)
+        assert main.memory_budget.reserved == baseline
+
+    asyncio.run(run())
+
+
+def test_sync_request_too_large_for_the_api_worker_is_offloaded(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "SYNC_MAX_JOB_BYTES", 0)
+    response = client.post("/api/image-to-pdf", files=[("files", ("a.jpg", photo(), "image/jpeg"))])
+
+    assert response.status_code == 202, response.text
+    job = response.json()
+    assert job["status_url"] == f"/api/jobs/{job['job_id']}"
+    download = client.get(job["download_url"])
+    assert download.status_code == 200, download.text
+    assert download.content.startswith(b"%PDF-")
+
+
+def test_sync_request_within_the_limit_is_answered_directly(client):
+    response = client.post("/api/image-to-pdf", files=[("files", ("a.jpg", photo(), "image/jpeg"))])
+
+    assert response.status_code == 200, response.text
+    assert response.headers["x-cache"] == "MISS"
+    assert response.content.startswith(b"%PDF-")
+
+
+def test_sync_request_over_max_job_bytes_is_refused(client, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_JOB_BYTES", 0)
+    response = client.post("/api/image-to-pdf", files=[("files", ("a.jpg", photo(), "image/jpeg"))])
+
+    assert response.status_code == 413
+    assert "limit is 0 MiB" in response.json()["detail"]
+
+
+def test_sync_request_waiting_too_long_for_memory_gets_503(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main.memory_budget, "wait_timeout", 0.1)
+    monkeypatch.setattr(main.memory_budget, "reserved", main.memory_budget.capacity)
+    response = client.post("/api/image-to-pdf", files=[("files", ("a.jpg", photo(), "image/jpeg"))])
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == str(main.memory_budget.retry_after)
@@ -0,0 +1,209 @@
+import asyncio
+import io
+import json
+import zipfile
+
+import pytest
+from PIL import Image
+
+import batch
+from batch import BatchInput, collect_inputs, extract_archive, plan_jobs
+from tools.file_io import InputTooLarge
+from uploads import StoredUpload
+
+PDF = b"%PDF-1.4\n%%EOF\n"
+
+
+def jpeg() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (40, 30), "navy").save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def write_zip(path, entries) -> str:
+    """Write a ZIP archive of (name, data) entries; names ending in / are directories."""
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+    return str(path)
+
+
+@pytest.mark.parametrize("name", [
+    "../evil.pdf",
+    "docs/../../evil.pdf",
+    "/etc/evil.pdf",
+    "C:/evil.pdf",
+    "C:evil.pdf",
+    "..\\evil.pdf",
+    "docs\\..\\..\\evil.pdf",
+])
+def test_unsafe_entry_names_are_rejected(tmp_path, name):
+    archive = write_zip(tmp_path / "in.zip", [(name, PDF)])
+
+    with pytest.raises(ValueError, match="Invalid file name"):
+        extract_archive(archive, tmp_path, max_files=10)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["in.zip"]
+
+
+def test_entries_are_extracted_under_their_normalized_names(tmp_path):
+    archive = write_zip(tmp_path / "in.zip", [
+        ("scans\\a.pdf", PDF),
+        ("scans/./b/../c.jpg", jpeg()),
+        ("scans/", b""),
+        ("__MACOSX/scans/._a.pdf", b"resource fork"),
+        ("scans/.DS_Store", b"finder"),
+    ])
+    out = tmp_path / "out"
+    out.mkdir()
+
+    inputs = extract_archive(archive, out, max_files=10)
+
+    assert [(item.name, item.kind) for item in inputs] == [("scans/a.pdf", "pdf"), ("scans/c.jpg", "image")]
+    for item in inputs:
+        assert item.path.startswith(str(out))
+    assert open(inputs[0].path, "rb").read() == PDF
+
+
+def test_oversized_entry_is_stopped_while_extracting(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "MAX_UPLOAD_FILE_BYTES", 1024 * 1024)
+    # Compresses to a few KB, claims nothing about its size up front
+    archive = write_zip(tmp_path / "bomb.zip", [("bomb.pdf", PDF + bytes(8 * 1024 * 1024))])
+    assert (tmp_path / "bomb.zip").stat().st_size < 64 * 1024
+    out = tmp_path / "out"
+    out.mkdir()
+
+    with pytest.raises(InputTooLarge, match="File too large: bomb.pdf"):
+        extract_archive(archive, out, max_files=10)
+    assert all(p.stat().st_size <= 1024 * 1024 + batch.CHUNK_SIZE for p in out.iterdir())
+
+
+def test_archive_over_the_request_limit_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "MAX_UPLOAD_REQUEST_BYTES", 1024 * 1024)
+    entry = PDF + bytes(600 * 1024)
+    archive = write_zip(tmp_path / "in.zip", [("a.pdf", entry), ("b.pdf", entry)])
+
+    with pytest.raises(InputTooLarge, match="Archive too large when extracted"):
+        extract_archive(archive, tmp_path, max_files=10)
+
+
+def test_encrypted_entries_are_rejected(tmp_path):
+    path = tmp_path / "in.zip"
+    write_zip(path, [("secret.pdf", PDF)])
+    # Set the encryption flag in the local and central directory headers
+    data = bytearray(path.read_bytes())
+    for signature, offset in ((b"PK\x03\x04", 6), (b"PK\x01\x02", 8)):
+        start = data.index(signature) + offset
+        data[start] |= 0x1
+    path.write_bytes(bytes(data))
+
+    with pytest.raises(ValueError, match="Encrypted archive entries"):
+        extract_archive(str(path), tmp_path, max_files=10)
+
+
+@pytest.mark.parametrize("entries, message", [
+    ([("notes.txt", b"text")], "Invalid file type in archive: notes.txt"),
+    ([("fake.pdf", b"not a pdf")], "File is not a PDF: fake.pdf"),
+    ([("fake.png", PDF)], "File is not an image: fake.png"),
+    ([("empty/", b""), ("__MACOSX/x.pdf", PDF)], "holds no images or PDFs"),
+])
+def test_invalid_archive_contents_are_rejected(tmp_path, entries, message):
+    archive = write_zip(tmp_path / "in.zip", entries)
+
+    with pytest.raises(ValueError, match=message):
+        extract_archive(archive, tmp_path, max_files=10)
+
+
+def test_not_a_zip_is_rejected(tmp_path):
+    path = tmp_path / "in.zip"
+    path.write_bytes(b"PK\x03\x04 but nothing else")
+
+    with pytest.raises(ValueError, match="Not a valid ZIP archive"):
+        extract_archive(str(path), tmp_path, max_files=10)
+
+
+def test_file_limit_counts_archive_entries_and_uploads(tmp_path):
+    archive = write_zip(tmp_path / "in.zip", [(f"{i}.pdf", PDF) for i in range(3)])
+    with pytest.raises(ValueError, match="Too many files. Limit is 2"):
+        extract_archive(archive, tmp_path, max_files=2)
+
+    pdf_path = tmp_path / "loose.pdf"
+    pdf_path.write_bytes(PDF)
+    uploads = [
+        StoredUpload("loose.pdf", str(pdf_path), len(PDF), ""),
+        StoredUpload("in.zip", archive, 0, ""),
+    ]
+    with pytest.raises(ValueError, match="Too many files. Limit is 3"):
+        collect_inputs(uploads, tmp_path, max_files=3)
+
+    inputs = collect_inputs(uploads, tmp_path, max_files=4)
+    assert [item.name for item in inputs] == ["loose.pdf", "0.pdf", "1.pdf", "2.pdf"]
+    assert not (tmp_path / "in.zip").exists()
+
+
+def _inputs(*names):
+    return [BatchInput(name, "pdf" if name.endswith(".pdf") else "image", f"/data/{name}") for name in names]
+
+
+def test_plan_jobs_converts_each_file():
+    jobs = plan_jobs(_inputs("a.pdf", "r/2.jpg", "r/1.jpg", "photo.png"))
+
+    assert [(job.name, job.operation, [i.name for i in job.inputs]) for job in jobs] == [
+        ("a.pdf", "compress-pdf", ["a.pdf"]),
+        ("r/2.pdf", "image-to-pdf", ["r/2.jpg"]),
+        ("r/1.pdf", "image-to-pdf", ["r/1.jpg"]),
+        ("photo.pdf", "image-to-pdf", ["photo.png"]),
+    ]
+
+
+def test_plan_jobs_groups_folders_into_image_sets():
+    jobs = plan_jobs(
+        _inputs("receipt-17/page2.jpg", "loose.jpg", "receipt-17/page1.jpg", "x/y/b.png", "x/y/a.png", "x/y/doc.pdf"),
+        image_sets=True,
+    )
+
+    assert [(job.name, job.operation, [i.name for i in job.inputs]) for job in jobs] == [
+        ("loose.pdf", "image-to-pdf", ["loose.jpg"]),
+        ("x/y/doc.pdf", "compress-pdf", ["x/y/doc.pdf"]),
+        ("receipt-17.pdf", "image-to-pdf", ["receipt-17/page1.jpg", "receipt-17/page2.jpg"]),
+        ("x/y.pdf", "image-to-pdf", ["x/y/a.png", "x/y/b.png"]),
+    ]
+
+
+def test_plan_jobs_gives_every_result_its_own_name():
+    jobs = plan_jobs(_inputs("a.pdf", "a.jpg", "a.png", "manifest.jpg"))
+
+    assert [job.name for job in jobs] == ["a.pdf", "a (2).pdf", "a (3).pdf", "manifest.pdf"]
+    assert batch.MANIFEST_NAME not in [job.name for job in plan_jobs(_inputs("manifest.json.jpg"))]
+
+
+@pytest.mark.usefixtures("client")
+def test_stream_batch_reports_failed_jobs_in_the_manifest(tmp_path):
+    import main
+
+    workspace = main.workspace_store.create()
+    good = workspace.path / "good.jpg"
+    good.write_bytes(jpeg())
+    broken = workspace.path / "broken.pdf"
+    broken.write_bytes(PDF + b"garbage")
+    jobs = plan_jobs([BatchInput("photo.jpg", "image", str(good)), BatchInput("broken.pdf", "pdf", str(broken))])
+    options = {
+        "image-to-pdf": {"resize_quality": main.DEFAULT_RESIZE_QUALITY, "workers": 1},
+        "compress-pdf": {},
+    }
+
+    async def collect() -> bytes:
+        return b"".join([chunk async for chunk in main.stream_batch(jobs, workspace, options)])
+
+    archive = zipfile.ZipFile(io.BytesIO(asyncio.run(collect())))
+
+    assert set(archive.namelist()) == {"photo.pdf", batch.MANIFEST_NAME}
+    assert archive.read("photo.pdf").startswith(b"%PDF-")
+    manifest = json.loads(archive.read(batch.MANIFEST_NAME))
+    assert manifest["jobs"] == 2
+    assert manifest["failed"] == 1
+    results = {result["name"]: result for result in manifest["results"]}
+    assert results["photo.pdf"]["status"] == "ok"
+    assert results["broken.pdf"]["status"] == "error"
+    assert results["broken.pdf"]["error"]
+    assert results["broken.pdf"]["inputs"] == ["broken.pdf"]
+    assert not workspace.path.exists()
@@ -0,0 +1,101 @@
+import io
+
+import pytest
+from PIL import Image
+from pypdf import PdfReader
+
+import tools.compress_pdf as compress_module
+from tools.compress_pdf import SHARD_PAGES, _ImageJob, _recompress_image, compress_pdf
+
+
+@pytest.mark.parametrize("color_mode", ["no-change", "monochrome"])
+def test_sharded_output_matches_serial(scanned_pdf, monkeypatch, color_mode):
+    assert len(PdfReader(io.BytesIO(scanned_pdf)).pages) > SHARD_PAGES
+
+    serial = io.BytesIO()
+    compress_pdf(scanned_pdf, serial, dpi=72, color_mode=color_mode, processes=1)
+    assert len(serial.getvalue()) < len(scanned_pdf)
+
+    sharded_calls = []
+    sharded = compress_module._recompress_sharded
+
+    def spy(*args, **kwargs):
+        sharded_calls.append(args)
+        return sharded(*args, **kwargs)
+
+    monkeypatch.setattr(compress_module, "_recompress_sharded", spy)
+    parallel = io.BytesIO()
+    compress_pdf(scanned_pdf, parallel, dpi=72, color_mode=color_mode, processes=3)
+
+    assert sharded_calls
+    assert parallel.getvalue() == serial.getvalue()
+
+
+def only_image(data: bytes):
+    reader = PdfReader(io.BytesIO(data))
+    images = [
+        xobject.get_object()
+        for page in reader.pages
+        for xobject in page["/Resources"].get("/XObject", {}).values()
+    ]
+    assert len({id(image) for image in images}) == 1
+    return images[0]
+
+
+def compressed(source: bytes, **kwargs) -> bytes:
+    output = io.BytesIO()
+    compress_pdf(source, output, **kwargs)
+    return output.getvalue()
+
+
+def test_grayscale_reencodes_shared_images_once(text_and_image_pdf):
+    image = only_image(compressed(text_and_image_pdf, color_mode="grayscale"))
+
+    assert image["/ColorSpace"] == "/DeviceGray"
+    assert image["/Filter"] == "/DCTDecode"
+    assert image["/BitsPerComponent"] == 8
+    assert Image.open(io.BytesIO(image.get_data())).mode == "L"
+
+
+def test_monochrome_writes_one_bit_images(text_and_image_pdf):
+    image = only_image(compressed(text_and_image_pdf, color_mode="monochrome"))
+
+    assert image["/ColorSpace"] == "/DeviceGray"
+    assert image["/Filter"] == "/FlateDecode"
+    assert image["/BitsPerComponent"] == 1
+    width, height = image["/Width"], image["/Height"]
+    assert (width, height) == (400, 300)
+    # Rows are padded to whole bytes
+    assert len(image.get_data()) == (width + 7) // 8 * height
+
+
+@pytest.mark.parametrize("dpi, size", [(72, (816, 612)), (144, (1632, 1224)), (300, (2000, 1500))])
+def test_images_are_downsampled_to_the_target_dpi(image_pdf, dpi, size):
+    # 2000x1500 filling a letter page: 792x612 points, i.e. 11x8.5 inches
+    source = image_pdf((2000, 1500), page_size=(792, 612))
+    image = only_image(compressed(source, dpi=dpi, image_quality=50))
+
+    assert (image["/Width"], image["/Height"]) == size
+
+
+def test_image_is_kept_when_reencoding_would_grow_it(image_pdf):
+    source = image_pdf((400, 300), quality=20)
+    original = only_image(source).get_data()
+
+    image = only_image(compressed(source, image_quality=95))
+
+    assert image.get_data() == original
+    assert (image["/Width"], image["/Height"]) == (400, 300)
+
+
+def test_recompress_image_skips_only_unchanged_larger_results(image_pdf):
+    stream = only_image(image_pdf((400, 300), quality=20))
+    job = _ImageJob(stream, (792, 612))
+
+    assert _recompress_image(job, dpi=144, image_quality=95, color_mode="no-change") is None
+    # Converting is what was asked for, even if the result is larger
+    grayscale = _recompress_image(job, dpi=144, image_quality=95, color_mode="grayscale")
+    assert grayscale is not None and grayscale.color_space == "/DeviceGray"
+    # A smaller encoding replaces the original
+    smaller = _recompress_image(job, dpi=144, image_quality=10, color_mode="no-change")
+    assert smaller is not None and len(smaller.data) < len(stream._data)
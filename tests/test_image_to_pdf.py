@@ -0,0 +1,104 @@
+import io
+
+import pytest
+from PIL import ExifTags, Image, ImageOps
+from pypdf import PdfReader
+
+from tools.image_to_pdf import DPI, _orientation_matrix, convert_images_to_pdf
+from tools.pdf_stream import StreamingPdfWriter
+
+ORIENTATIONS = range(1, 9)
+
+
+class WriteOnly:
+    """Output that can neither seek nor tell, like a response stream."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data: bytes) -> int:
+        return self.buffer.write(data)
+
+
+def strict_reader(data: bytes) -> PdfReader:
+    """Open data strictly and check that every xref entry points at its object."""
+    reader = PdfReader(io.BytesIO(data), strict=True)
+    for number, offset in reader.xref[0].items():
+        assert data[offset:].startswith(b"%d 0 obj" % number)
+        assert reader.get_object(number) is not None
+    return reader
+
+
+def media_box(page) -> tuple:
+    return tuple(float(value) for value in page.mediabox)
+
+
+def marked_image(size=(6, 4)) -> Image.Image:
+    """An image in which every pixel has a different colour."""
+    img = Image.new("RGB", size)
+    img.putdata([(x * 40, y * 60, 0) for y in range(size[1]) for x in range(size[0])])
+    return img
+
+
+@pytest.mark.parametrize("orientation", ORIENTATIONS)
+def test_orientation_matrix_shows_the_image_upright(orientation):
+    stored = marked_image()
+    exif = stored.getexif()
+    exif[ExifTags.Base.Orientation] = orientation
+    stored.info["exif"] = exif.tobytes()
+    upright = ImageOps.exif_transpose(stored)
+
+    width, height = upright.size
+    a, b, c, d, e, f = _orientation_matrix(orientation, float(width), float(height))
+    placed = Image.new("RGB", upright.size)
+    for y in range(stored.height):
+        for x in range(stored.width):
+            # Centre of the pixel in image space, whose first row is at the top
+            u, v = (x + 0.5) / stored.width, 1 - (y + 0.5) / stored.height
+            page_x, page_y = a * u + c * v + e, b * u + d * v + f
+            placed.putpixel((int(page_x), int(height - page_y)), stored.getpixel((x, y)))
+
+    assert placed.tobytes() == upright.tobytes()
+
+
+@pytest.mark.parametrize("orientation", ORIENTATIONS)
+def test_exif_orientation_is_applied_on_the_page(orientation):
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = orientation
+    Image.effect_noise((300, 200), 30).convert("RGB").save(buffer, "JPEG", exif=exif)
+    output = io.BytesIO()
+    convert_images_to_pdf([buffer.getvalue()], output)
+
+    reader = strict_reader(output.getvalue())
+
+    assert len(reader.pages) == 1
+    width, height = (200, 300) if orientation >= 5 else (300, 200)
+    assert media_box(reader.pages[0]) == pytest.approx((0, 0, width * 72 / DPI, height * 72 / DPI))
+    image = reader.pages[0]["/Resources"]["/XObject"]["/image"].get_object()
+    # The JPEG is embedded as stored; only the page matrix turns it
+    assert (image["/Width"], image["/Height"]) == (300, 200)
+    assert image.get_data() == buffer.getvalue()
+
+
+def test_streaming_writer_output_is_a_valid_pdf():
+    output = WriteOnly()
+    writer = StreamingPdfWriter(output, title="scans.pdf")
+    sizes = [(30, 20), (20, 30), (25, 25)]
+    for width, height in sizes:
+        buffer = io.BytesIO()
+        Image.effect_noise((width, height), 30).save(buffer, "JPEG")
+        writer.add_image_page(
+            buffer.getvalue(), width, height, "DeviceGray", page_width=width * 2, page_height=height * 2
+        )
+    writer.close()
+    writer.close()
+
+    data = output.buffer.getvalue()
+    assert writer.bytes_written == len(data)
+    reader = strict_reader(data)
+    assert len(reader.pages) == writer.page_count == 3
+    assert [media_box(page) for page in reader.pages] == [(0, 0, w * 2, h * 2) for w, h in sizes]
+    assert reader.metadata.title == "scans.pdf"
+    with pytest.raises(ValueError):
+        writer.add_image_page(b"", 1, 1, "DeviceGray", 1, 1)
@@ -0,0 +1,33 @@
+import io
+
+import pytest
+from pypdf import PdfReader
+
+from tools.merge_pdf import merge_pdfs
+
+
+@pytest.mark.parametrize("dedupe_resources", [True, False])
+@pytest.mark.parametrize("optimize_level", [0, 2])
+def test_internal_links_point_at_merged_pages(linked_pdf, dedupe_resources, optimize_level):
+    output = io.BytesIO()
+    merge_pdfs([linked_pdf, linked_pdf], output, optimize_level=optimize_level, dedupe_resources=dedupe_resources)
+
+    reader = PdfReader(io.BytesIO(output.getvalue()))
+    pages = [page.indirect_reference.idnum for page in reader.pages]
+    assert len(pages) == 6
+    targets = {}
+    for number, page in enumerate(reader.pages):
+        for annotation in page.get("/Annots", []):
+            targets[number] = pages.index(annotation.get_object()["/Dest"][0].idnum)
+    # Page 1 of each source links to page 3 of the same source
+    assert targets == {0: 2, 3: 5}
+
+
+def test_merge_keeps_pages_and_order(linked_pdf, text_and_image_pdf):
+    output = io.BytesIO()
+    merge_pdfs([text_and_image_pdf, linked_pdf], output)
+
+    reader = PdfReader(io.BytesIO(output.getvalue()))
+    texts = [page.extract_text() for page in reader.pages]
+    assert texts[:3] == ["Page 1", "Page 2", "Page 3"]
+    assert len(reader.pages) == 8
@@ -0,0 +1,56 @@
+import io
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject
+
+from tools.optimize_pdf import OPTIMIZE_LEVELS, write_optimized
+
+
+def _optimize(data: bytes, level: int) -> bytes:
+    writer = PdfWriter(clone_from=PdfReader(io.BytesIO(data)))
+    output = io.BytesIO()
+    write_optimized(writer, output, level)
+    return output.getvalue()
+
+
+def _page_summary(reader: PdfReader):
+    return [(page.extract_text(), [image.data for image in page.images]) for page in reader.pages]
+
+
+def _reachable(reader: PdfReader) -> int:
+    """Resolve every object reachable from the trailer; returns how many there are."""
+    seen = set()
+    pending = [reader.trailer["/Root"], reader.trailer.get("/Info")]
+    while pending:
+        obj = pending.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.idnum in seen:
+                continue
+            seen.add(obj.idnum)
+            obj = obj.get_object()
+            assert obj is not None
+        if isinstance(obj, DictionaryObject):
+            pending.extend(value for key, value in obj.items() if key != "/Parent")
+        elif isinstance(obj, ArrayObject):
+            pending.extend(obj)
+    return len(seen)
+
+
+@pytest.mark.parametrize("level", OPTIMIZE_LEVELS)
+def test_optimized_output_round_trips(text_and_image_pdf, level):
+    data = _optimize(text_and_image_pdf, level)
+
+    reader = PdfReader(io.BytesIO(data), strict=True)
+    assert _page_summary(reader) == _page_summary(PdfReader(io.BytesIO(text_and_image_pdf)))
+    assert _reachable(reader) > 0
+    if level >= 2:
+        # Packed into object streams with a cross-reference stream
+        assert b"/ObjStm" in data and b"/XRef" in data
+
+
+def test_identical_objects_are_merged(text_and_image_pdf):
+    # The two image pages have identical content streams
+    plain = PdfReader(io.BytesIO(_optimize(text_and_image_pdf, 0)))
+    packed = PdfReader(io.BytesIO(_optimize(text_and_image_pdf, 2)), strict=True)
+    assert _reachable(packed) < _reachable(plain)
@@ -0,0 +1,162 @@
+import asyncio
+import fcntl
+import os
+import subprocess
+import sys
+import textwrap
+import time
+import uuid
+
+from single_flight import SingleFlight
+from uploads import StoredUpload
+
+HOLDER = textwrap.dedent("""
+    import asyncio, sys, time
+    from single_flight import SingleFlight
+
+    async def hold():
+        flight = await SingleFlight(sys.argv[1], 5).acquire("key")
+        print("locked", flush=True)
+        time.sleep(float(sys.argv[2]))
+        flight.release()
+
+    asyncio.run(hold())
+""")
+
+
+def hold_in_other_process(directory, seconds: float) -> subprocess.Popen:
+    """Start a process that holds "key" for seconds; returns once it has it."""
+    process = subprocess.Popen(
+        [sys.executable, "-c", HOLDER, str(directory), str(seconds)],
+        stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.dirname(__file__)),
+    )
+    assert process.stdout.readline().strip() == "locked"
+    return process
+
+
+def test_requests_in_one_process_take_turns(tmp_path):
+    flights = SingleFlight(str(tmp_path), wait_timeout=5)
+
+    async def run():
+        first = await flights.acquire("key")
+        second = asyncio.ensure_future(flights.acquire("key"))
+        await asyncio.sleep(0.1)
+        assert not second.done()
+        assert flights.stats()["in_flight"] == 1
+        first.release()
+        second = await asyncio.wait_for(second, 1)
+        assert not first.waited
+        assert second.waited
+        second.release()
+        second.release()
+
+    asyncio.run(run())
+    assert flights.stats() == {"in_flight": 0, "waited": 1, "timeouts": 0}
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_requests_in_other_processes_are_waited_for(tmp_path):
+    flights = SingleFlight(str(tmp_path), wait_timeout=5)
+    holder = hold_in_other_process(tmp_path, 0.5)
+    try:
+        start = time.monotonic()
+        flight = asyncio.run(flights.acquire("key"))
+        waited = time.monotonic() - start
+    finally:
+        holder.wait(5)
+
+    assert flight.waited
+    assert waited > 0.2
+    assert holder.returncode == 0
+    flight.release()
+
+
+def test_wait_for_another_process_is_bounded(tmp_path):
+    flights = SingleFlight(str(tmp_path), wait_timeout=0.3)
+    holder = hold_in_other_process(tmp_path, 2)
+    try:
+        start = time.monotonic()
+        flight = asyncio.run(flights.acquire("key"))
+        elapsed = time.monotonic() - start
+        # The request goes ahead without the lock; releasing it is harmless
+        flight.release()
+        assert holder.poll() is None
+    finally:
+        holder.wait(5)
+
+    assert flight.waited
+    assert 0.3 <= elapsed < 1.5
+    assert flights.stats()["timeouts"] == 1
+
+
+def test_wait_in_one_process_is_bounded(tmp_path):
+    flights = SingleFlight(str(tmp_path), wait_timeout=0.2)
+
+    async def run():
+        first = await flights.acquire("key")
+        second = await flights.acquire("key")
+        assert second.waited
+        second.release()
+        assert flights.stats()["in_flight"] == 1
+        first.release()
+
+    asyncio.run(run())
+    assert flights.stats() == {"in_flight": 0, "waited": 0, "timeouts": 1}
+
+
+def test_lock_file_replaced_while_locking_is_not_trusted(tmp_path, monkeypatch):
+    flights = SingleFlight(str(tmp_path), wait_timeout=5)
+    path = flights._lock_path("key")
+    real_flock = fcntl.flock
+    newer = []
+
+    def flock(fd, operation):
+        if not newer and operation & fcntl.LOCK_EX:
+            # Between our open and flock, the holder releases (unlinking the
+            # file) and another process takes the key with a fresh file
+            path.unlink()
+            newer.append(os.open(path, os.O_RDWR | os.O_CREAT, 0o644))
+            real_flock(newer[0], fcntl.LOCK_EX)
+        return real_flock(fd, operation)
+
+    monkeypatch.setattr(fcntl, "flock", flock)
+
+    async def run():
+        waiter = asyncio.ensure_future(flights.acquire("key"))
+        await asyncio.sleep(0.3)
+        # Locking the unlinked file must not count as holding the key
+        assert not waiter.done()
+        path.unlink()
+        real_flock(newer[0], fcntl.LOCK_UN)
+        os.close(newer[0])
+        flight = await asyncio.wait_for(waiter, 2)
+        assert flight.waited
+        assert os.fstat(flight._fd).st_ino == os.stat(path).st_ino
+        flight.release()
+
+    asyncio.run(run())
+    assert not path.exists()
+
+
+def test_coalesced_requests_count_one_cache_outcome_each():
+    import main
+
+    upload = StoredUpload("a.pdf", None, 1, uuid.uuid4().hex, b"x")
+    before = main.result_cache.stats()
+
+    async def run():
+        key, cached, flight = await main.lookup_cache("compress-pdf", [upload])
+        assert cached is None
+        waiter = asyncio.ensure_future(main.lookup_cache("compress-pdf", [upload]))
+        await asyncio.sleep(0.1)
+        assert not waiter.done()
+        await asyncio.to_thread(main.result_cache.put_bytes, key, b"%PDF-1.4 result")
+        flight.release()
+        _, cached, flight = await waiter
+        assert cached is not None
+        assert flight is None
+
+    asyncio.run(run())
+    after = main.result_cache.stats()
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 1
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from starlette.requests import ClientDisconnect
+
+import main
+from streaming import STREAM_CHUNK_SIZE, StreamCancelled
+
+# Streamed jobs run on the shared executor, which lives as long as the app
+pytestmark = pytest.mark.usefixtures("client")
+
+CHUNK = b"%PDF-" + bytes(STREAM_CHUNK_SIZE)
+
+
+def scope(spec_version: str) -> dict:
+    return {"type": "http", "asgi": {"spec_version": spec_version}}
+
+
+async def stream(tool, workspace, cache_key: str):
+    return await main.stream_tool(tool, [], workspace, cache_key, None, "out.pdf", 1)
+
+
+def cached(cache_key: str) -> bool:
+    return main.result_cache.get(cache_key, count=False) is not None
+
+
+def test_first_chunk_is_sent_while_the_job_is_still_running():
+    workspace = main.workspace_store.create()
+    cache_key = os.urandom(32).hex()
+    first_chunk_sent = threading.Event()
+    waited = []
+
+    def tool(inputs, output):
+        output.write(CHUNK)
+        # Only the client receiving the first chunk lets the job finish
+        waited.append(first_chunk_sent.wait(timeout=10))
+        output.write(b"%%EOF")
+
+    async def run():
+        response = await stream(tool, workspace, cache_key)
+        body = []
+
+        async def receive():
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                body.append(message["body"])
+                first_chunk_sent.set()
+
+        await response(scope("2.4"), receive, send)
+        return b"".join(body)
+
+    body = asyncio.run(run())
+
+    assert waited == [True]
+    assert body == CHUNK + b"%%EOF"
+    assert main.result_cache.get(cache_key, count=False).read_bytes() == body
+    assert not workspace.path.exists()
+
+
+@pytest.mark.parametrize("spec_version", ["2.0", "2.4"])
+def test_client_disconnect_cancels_the_job_and_removes_the_workspace(spec_version):
+    workspace = main.workspace_store.create()
+    cache_key = os.urandom(32).hex()
+    stopped = threading.Event()
+    outcome = []
+
+    def tool(inputs, output):
+        try:
+            while True:
+                output.write(CHUNK)
+        except StreamCancelled as e:
+            outcome.append(e)
+            raise
+        finally:
+            stopped.set()
+
+    async def run():
+        response = await stream(tool, workspace, cache_key)
+        disconnected = asyncio.Event()
+
+        async def receive():
+            # Before ASGI 2.4 the response listens for the disconnect message
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                if spec_version == "2.4":
+                    # From 2.4 on, sending to a closed connection fails
+                    raise OSError("connection reset")
+                disconnected.set()
+
+        try:
+            await response(scope(spec_version), receive, send)
+        except ClientDisconnect:
+            pass
+        assert await asyncio.to_thread(stopped.wait, 10)
+        # The reservation is released once the job is gone
+        for _ in range(100):
+            if main.memory_budget.reserved == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+
+    assert len(outcome) == 1
+    assert main.memory_budget.reserved == 0
+    assert not workspace.path.exists()
+    assert not cached(cache_key)
+
+
+def test_job_failing_after_the_first_chunk_aborts_and_caches_nothing():
+    workspace = main.workspace_store.create()
+    cache_key = os.urandom(32).hex()
+
+    def tool(inputs, output):
+        output.write(CHUNK)
+        raise ValueError("broken page")
+
+    async def run():
+        response = await stream(tool, workspace, cache_key)
+        body = []
+
+        async def receive():
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                body.append(message["body"])
+
+        with pytest.raises(ValueError):
+            await response(scope("2.4"), receive, send)
+        return body
+
+    body = asyncio.run(run())
+
+    # The client got a truncated body, never the final empty message
+    assert body == [CHUNK]
+    assert not workspace.path.exists()
+    assert not cached(cache_key)
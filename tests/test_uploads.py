@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import ClientDisconnect, Request
+
+import uploads
+from uploads import receive_uploads
+
+BOUNDARY = b"test-boundary"
+PDF = b"%PDF-1.4\n" + bytes(2000) + b"\n%%EOF\n"
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(100)
+
+
+def multipart(*parts, complete: bool = True) -> bytes:
+    """Body with a file part per (field, filename, data); filename None makes a plain field."""
+    body = b""
+    for field, filename, data in parts:
+        disposition = f'form-data; name="{field}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += b"--" + BOUNDARY + b"\r\nContent-Disposition: " + disposition.encode() + b"\r\n\r\n" + data + b"\r\n"
+    if complete:
+        body += b"--" + BOUNDARY + b"--\r\n"
+    return body
+
+
+def request(body: bytes, chunk_size: int = 512, disconnect: bool = False) -> Request:
+    """A request whose body arrives in chunks, optionally ending with the client going away."""
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": disconnect or i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+    if disconnect:
+        messages.append({"type": "http.disconnect"})
+
+    async def receive():
+        return messages.pop(0)
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "headers": [
+            (b"content-type", b"multipart/form-data; boundary=" + BOUNDARY),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    }
+    return Request(scope, receive)
+
+
+def receive(body: bytes, kind: str, directory, **kwargs):
+    return asyncio.run(receive_uploads(request(body, **kwargs.pop("request", {})), "files", kind, directory, **kwargs))
+
+
+def test_files_are_streamed_to_disk_with_their_hash(tmp_path):
+    body = multipart(("other", None, b"ignored"), ("files", "a.pdf", PDF), ("files", "b.pdf", PDF + b"more"))
+
+    stored = receive(body, "pdf", tmp_path)
+
+    assert [upload.filename for upload in stored] == ["a.pdf", "b.pdf"]
+    assert open(stored[0].path, "rb").read() == PDF
+    assert stored[0].sha256 == hashlib.sha256(PDF).hexdigest()
+    assert stored[0].size == len(PDF)
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_in_memory_uploads_never_touch_the_disk():
+    stored = receive(multipart(("files", "a.png", PNG)), "image", None)
+
+    assert stored[0].path is None
+    assert stored[0].source == PNG
+
+
+@pytest.mark.parametrize("kind, filename, data, detail", [
+    ("pdf", "a.pdf", b"GIF89a" + bytes(2000), "File is not a PDF: a.pdf"),
+    ("pdf", "short.pdf", b"not", "File is not a PDF: short.pdf"),
+    ("image", "a.png", PDF, "File is not an image: a.png"),
+    ("any", "a.jpg", PDF, "File is not an image: a.jpg"),
+    ("batch", "a.zip", PDF, "File is not a ZIP archive: a.zip"),
+    ("pdf", "a.png", PNG, "Only PDF files allowed"),
+    ("image", "a.pdf", PDF, "Allowed: JPG, PNG, GIF, BMP"),
+])
+def test_mistyped_files_are_rejected(tmp_path, kind, filename, data, detail):
+    with pytest.raises(HTTPException) as raised:
+        receive(multipart(("files", "ok.pdf" if kind != "image" else "ok.png", PDF if kind != "image" else PNG),
+                          ("files", filename, data)), kind, tmp_path)
+
+    assert raised.value.status_code == 400
+    assert detail in raised.value.detail
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_pdf_header_may_follow_leading_garbage(tmp_path):
+    stored = receive(multipart(("files", "a.pdf", b"\x00" * 500 + PDF)), "pdf", tmp_path)
+
+    assert stored[0].size == 500 + len(PDF)
+
+
+def test_file_over_the_size_limit_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "MAX_UPLOAD_FILE_BYTES", 1500)
+    body = multipart(("files", "small.pdf", PDF[:1000]), ("files", "big.pdf", PDF))
+
+    with pytest.raises(HTTPException) as raised:
+        receive(body, "pdf", tmp_path)
+
+    assert raised.value.status_code == 413
+    assert "File too large: big.pdf" in raised.value.detail
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_request_over_the_size_limit_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "MAX_UPLOAD_REQUEST_BYTES", 3000)
+    body = multipart(("files", "a.pdf", PDF), ("files", "b.pdf", PDF))
+
+    with pytest.raises(HTTPException) as raised:
+        receive(body, "pdf", tmp_path)
+
+    assert raised.value.status_code == 413
+    assert "Request too large" in raised.value.detail
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_file_count_limits(tmp_path):
+    body = multipart(*[("files", f"{i}.pdf", PDF) for i in range(3)])
+    with pytest.raises(HTTPException) as raised:
+        receive(body, "pdf", tmp_path, max_files=2)
+    assert raised.value.status_code == 400
+    assert raised.value.detail == "Too many files. Limit is 2"
+    assert list(tmp_path.iterdir()) == []
+
+    with pytest.raises(HTTPException) as raised:
+        receive(multipart(("files", "a.pdf", PDF)), "pdf", tmp_path, min_files=2)
+    assert raised.value.detail == "At least 2 PDF files required"
+    assert list(tmp_path.iterdir()) == []
+
+    with pytest.raises(HTTPException) as raised:
+        receive(multipart(("other", "a.pdf", PDF)), "pdf", tmp_path)
+    assert raised.value.detail == "No files provided"
+
+
+def test_client_disconnect_removes_written_files(tmp_path):
+    body = multipart(("files", "a.pdf", PDF), ("files", "b.pdf", PDF), complete=False)[:-500]
+
+    with pytest.raises(ClientDisconnect):
+        receive(body, "pdf", tmp_path, request={"disconnect": True})
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_truncated_body_is_rejected(tmp_path):
+    body = multipart(("files", "a.pdf", PDF), complete=False)
+
+    with pytest.raises(HTTPException) as raised:
+        receive(body, "pdf", tmp_path)
+
+    assert raised.value.detail == "Upload was incomplete"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_non_multipart_request_is_rejected(tmp_path):
+    req = request(b"{}")
+    req.scope["headers"] = [(b"content-type", b"application/json")]
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(receive_uploads(req, "files", "pdf", tmp_path))
+
+    assert raised.value.status_code == 400
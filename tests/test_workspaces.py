@@ -0,0 +1,21 @@
+import time
+
+from workspaces import WorkspaceStore
+
+
+def test_extend_pushes_back_expiry(tmp_path):
+    store = WorkspaceStore(str(tmp_path), ttl=10)
+    workspace = store.create()
+
+    assert store.extend(workspace.job_id, 1000)
+    store.sweep(now=time.time() + 500)
+    assert workspace.path.is_dir()
+
+    # A shorter extension never brings the expiry forward
+    assert store.extend(workspace.job_id, 5)
+    store.sweep(now=time.time() + 500)
+    assert workspace.path.is_dir()
+
+    store.sweep(now=time.time() + 1001)
+    assert not workspace.path.exists()
+    assert not store.extend(workspace.job_id)
@@ -1,67 +1,462 @@
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+from PIL import Image
+import io
 import logging
+import os
+import zlib
+
+# Celery's fork of multiprocessing: unlike multiprocessing it can start
+# processes from within Celery's own (daemonic) worker processes
+import billiard
+from pypdf import PdfReader, PdfWriter
+from pypdf.filters import decode_stream_data
+from pypdf.generic import ArrayObject, IndirectObject, NameObject, NumberObject, StreamObject
+
+from tools.file_io import JobCost, Source, Target, is_path, open_source, open_target, source_size
+from tools.instrument import Progress, ProgressCallback, count, stage
+from tools.optimize_pdf import DEFAULT_OPTIMIZE_LEVEL, write_optimized
 
 logger = logging.getLogger(__name__)
 
-def compress_pdf(input_path: str, output_path: str, dpi: int = 144, image_quality: int = 75, color_mode: str = "no-change") -> None:
+# Name under which stages and counts are reported (see tools.instrument)
+TOOL = "compress-pdf"
+
+COLOR_MODES = ("no-change", "grayscale", "monochrome")
+MIN_DPI, MAX_DPI = 72, 300
+MIN_IMAGE_QUALITY, MAX_IMAGE_QUALITY = 10, 100
+
+# Images smaller than this (in pixels per side) are left alone
+MIN_IMAGE_SIDE = 16
+
+# Color spaces whose samples map directly onto a Pillow mode
+_DEVICE_MODES = {"/DeviceGray": "L", "/DeviceRGB": "RGB", "/DeviceCMYK": "CMYK"}
+_ICC_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+
+# Peak memory per input byte and per page, measured with benchmark.py (the
+# parsed document plus the recompressed copies of its images)
+MEMORY_PER_INPUT_BYTE = 3
+MEMORY_PER_PAGE = 32 * 1024
+# Pages whose images are inspected to estimate the largest decoded image
+ESTIMATE_SAMPLE_PAGES = 20
+# Pages per shard when images are recompressed on several processes; shorter
+# documents are always done in one process
+SHARD_PAGES = 50
+
+# Image dictionary entries that are rewritten when an image is re-encoded
+_ENCODING_KEYS = ("/Filter", "/DecodeParms", "/ColorSpace", "/BitsPerComponent", "/Width", "/Height", "/Length")
+
+
+class _ImageJob(NamedTuple):
+    """A unique image XObject to recompress and the largest page it appears on."""
+    stream: StreamObject
+    max_page_size: Tuple[float, float]  # (long side, short side) in points
+    first_page: int = 0
+
+
+class _Recompressed(NamedTuple):
+    data: bytes
+    width: int
+    height: int
+    color_space: str
+    bits_per_component: int
+    filter_name: str
+
+
+def _image_mode(stream: StreamObject) -> Optional[str]:
+    """Return the Pillow mode for the image's color space, or None if it is not supported."""
+    color_space = stream.get("/ColorSpace")
+    if color_space is None:
+        return None
+    color_space = color_space.get_object()
+    if isinstance(color_space, NameObject):
+        return _DEVICE_MODES.get(color_space)
+    if isinstance(color_space, ArrayObject) and len(color_space) == 2 and color_space[0] == "/ICCBased":
+        return _ICC_MODES.get(color_space[1].get_object().get("/N"))
+    return None
+
+
+def _last_filter(stream: StreamObject) -> Optional[str]:
+    filters = stream.get("/Filter")
+    if filters is None:
+        return None
+    filters = filters.get_object()
+    if isinstance(filters, ArrayObject):
+        return filters[-1] if filters else None
+    return filters
+
+
+def _is_recompressible(stream: StreamObject) -> bool:
+    """Only plain 8-bit DCT/Flate images without masks or decode tweaks are touched."""
+    if stream.get("/ImageMask") or "/Decode" in stream or "/Mask" in stream:
+        return False
+    if stream.get("/BitsPerComponent") != 8:
+        return False
+    if _last_filter(stream) not in ("/DCTDecode", "/FlateDecode"):
+        return False
+    width, height = stream.get("/Width", 0), stream.get("/Height", 0)
+    if width < MIN_IMAGE_SIDE or height < MIN_IMAGE_SIDE:
+        return False
+    return _image_mode(stream) is not None
+
+
+def _decode_image(stream: StreamObject) -> Image.Image:
+    data = decode_stream_data(stream)
+    if _last_filter(stream) == "/DCTDecode":
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        return img
+    mode = _image_mode(stream)
+    return Image.frombytes(mode, (stream["/Width"], stream["/Height"]), data)
+
+
+def _target_scale(size: Tuple[int, int], max_page_size: Tuple[float, float], dpi: int) -> float:
     """
-    Compress a PDF file using PyPDF2 for maximum compatibility.
-    Works on any platform without external dependencies.
-    
+    Scale factor that brings the image down to the target DPI, assuming it
+    is displayed at most as large as the page it sits on.
+    """
+    long_side, short_side = max(size), min(size)
+    allowed_long = max_page_size[0] / 72.0 * dpi
+    allowed_short = max_page_size[1] / 72.0 * dpi
+    return min(1.0, max(allowed_long / long_side, allowed_short / short_side))
+
+
+def _recompress_image(job: _ImageJob, dpi: int, image_quality: int, color_mode: str) -> Optional[_Recompressed]:
+    """
+    Decode, downsample and re-encode one image. Runs in a worker thread;
+    Pillow releases the GIL while decoding, resampling and encoding.
+
+    Returns:
+        The new encoding, or None if the image should be kept as is
+    """
+    stream = job.stream
+    try:
+        img = _decode_image(stream)
+    except Exception as e:
+        logger.debug(f"Skipping image that could not be decoded: {e}")
+        return None
+
+    try:
+        scale = _target_scale(img.size, job.max_page_size, dpi)
+        if scale < 1.0:
+            new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        if color_mode == "monochrome":
+            bilevel = img.convert("L").point(lambda p: 255 if p > 127 else 0, mode="1")
+            # PDF DeviceGray at 1 bit uses 1 for white, like Pillow's "1" mode
+            return _Recompressed(
+                zlib.compress(bilevel.tobytes(), 9), bilevel.width, bilevel.height,
+                "/DeviceGray", 1, "/FlateDecode"
+            )
+
+        if color_mode == "grayscale" or img.mode == "L":
+            img = img.convert("L")
+            color_space = "/DeviceGray"
+        else:
+            img = img.convert("RGB")
+            color_space = "/DeviceRGB"
+
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=image_quality, optimize=True)
+        data = buffer.getvalue()
+
+        # Keep the original if nothing was resized or converted and the new
+        # encoding is not smaller
+        if scale >= 1.0 and color_mode == "no-change" and len(data) >= len(stream._data):
+            return None
+
+        return _Recompressed(data, img.width, img.height, color_space, 8, "/DCTDecode")
+    finally:
+        img.close()
+
+
+def _collect_images(pages) -> List[_ImageJob]:
+    """
+    Find every unique image XObject reachable from the pages, including
+    inside forms, in the order of the page each first appears on.
+    """
+    jobs: Dict[int, _ImageJob] = {}
+    visited_forms = set()
+
+    def visit(resources, page_size: Tuple[float, float], page_number: int) -> None:
+        if resources is None:
+            return
+        xobjects = resources.get_object().get("/XObject")
+        if xobjects is None:
+            return
+        for ref in xobjects.get_object().values():
+            xobj = ref.get_object()
+            if not isinstance(xobj, StreamObject):
+                continue
+            key = id(xobj)
+            subtype = xobj.get("/Subtype")
+            if subtype == "/Image":
+                if not _is_recompressible(xobj):
+                    continue
+                previous = jobs.get(key)
+                first_page = page_number
+                if previous is not None:
+                    page_size = (max(page_size[0], previous.max_page_size[0]),
+                                 max(page_size[1], previous.max_page_size[1]))
+                    first_page = previous.first_page
+                jobs[key] = _ImageJob(xobj, page_size, first_page)
+            elif subtype == "/Form" and key not in visited_forms:
+                visited_forms.add(key)
+                visit(xobj.get("/Resources"), page_size, page_number)
+
+    for page_number, page in enumerate(pages):
+        box = page.mediabox
+        width, height = float(box.width), float(box.height)
+        visit(page.get("/Resources"), (max(width, height), min(width, height)), page_number)
+
+    return list(jobs.values())
+
+
+def _apply(stream: StreamObject, result: _Recompressed) -> None:
+    """Replace an image stream's data and encoding entries in place, keeping its references."""
+    for key in _ENCODING_KEYS:
+        if key in stream:
+            del stream[key]
+    stream[NameObject("/Filter")] = NameObject(result.filter_name)
+    stream[NameObject("/ColorSpace")] = NameObject(result.color_space)
+    stream[NameObject("/BitsPerComponent")] = NumberObject(result.bits_per_component)
+    stream[NameObject("/Width")] = NumberObject(result.width)
+    stream[NameObject("/Height")] = NumberObject(result.height)
+    StreamObject.set_data(stream, result.data)
+    stream.decoded_self = None
+
+
+def _recompress_shard(
+    source: Union[str, bytes],
+    images: List[Tuple[int, int, Tuple[float, float]]],
+    dpi: int,
+    image_quality: int,
+    color_mode: str
+) -> List[Optional[_Recompressed]]:
+    """
+    Recompress one shard's images, given as (object number, generation,
+    largest page size). Runs in a worker process, which opens the document
+    itself and only reads the objects it needs.
+    """
+    with open_source(source) as input_file:
+        reader = PdfReader(input_file)
+        return [
+            _recompress_image(
+                _ImageJob(IndirectObject(number, generation, reader).get_object(), page_size),
+                dpi, image_quality, color_mode
+            )
+            for number, generation, page_size in images
+        ]
+
+
+def _recompress_sharded(
+    jobs: List[_ImageJob],
+    source: Union[str, bytes],
+    dpi: int,
+    image_quality: int,
+    color_mode: str,
+    processes: int
+) -> Iterator[Optional[_Recompressed]]:
+    """
+    Recompress the images in page-range shards of SHARD_PAGES pages, each
+    on a worker process. An image belongs to the shard of the first page
+    it appears on, so images shared across shards are still done once,
+    with their size limit from all their pages. Yields the results in the
+    order of jobs.
+    """
+    shards: Dict[int, list] = {}
+    for job in jobs:
+        reference = job.stream.indirect_reference
+        shards.setdefault(job.first_page // SHARD_PAGES, []).append(
+            (reference.idnum, reference.generation, job.max_page_size)
+        )
+    task = partial(_recompress_shard, source, dpi=dpi, image_quality=image_quality, color_mode=color_mode)
+    with billiard.Pool(min(processes, len(shards))) as pool:
+        for results in pool.imap(task, shards.values()):
+            yield from results
+
+
+def _recompress_images(
+    pages,
+    dpi: int,
+    image_quality: int,
+    color_mode: str,
+    workers: int,
+    source: Optional[Union[str, bytes]] = None,
+    processes: int = 1,
+    progress: Optional[ProgressCallback] = None
+) -> int:
+    """
+    Recompress all images on the pages in place, in parallel: on worker
+    threads, or in page-range shards on worker processes when processes
+    is above 1 and there is more than one shard (the pages must then be
+    those of a reader of source). Returns the number of images replaced.
+    """
+    jobs = _collect_images(pages)
+    if not jobs:
+        return 0
+    if processes > 1 and len(pages) > SHARD_PAGES:
+        results = _recompress_sharded(jobs, source, dpi, image_quality, color_mode, processes)
+        return _apply_results(jobs, results, progress)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+        results = pool.map(lambda job: _recompress_image(job, dpi, image_quality, color_mode), jobs)
+        return _apply_results(jobs, results, progress)
+
+
+def _apply_results(
+    jobs: List[_ImageJob], results: Iterator[Optional[_Recompressed]], progress: Optional[ProgressCallback]
+) -> int:
+    replaced = 0
+    for done, (job, result) in enumerate(zip(jobs, results), start=1):
+        if result is not None:
+            _apply(job.stream, result)
+            replaced += 1
+        if progress is not None:
+            progress(Progress("recompress_images", done, len(jobs), "images"))
+    return replaced
+
+
+def estimate_cost(input_path: Source, workers: Optional[int] = None) -> JobCost:
+    """
+    Estimate the cost of compress_pdf from the input size, its page count
+    and the dimensions of the images on the first ESTIMATE_SAMPLE_PAGES
+    pages, extrapolated to the whole document; no image is decoded. For
+    the peak memory, every worker thread may hold a decoded image and its
+    resampled copy at the same time.
+
+    Raises:
+        ValueError: If the input is not a readable PDF
+    """
+    workers = workers or os.cpu_count() or 1
+    largest_image = sampled_pixels = 0
+    try:
+        with open_source(input_path) as input_file:
+            reader = PdfReader(input_file)
+            pages = len(reader.pages)
+            sample = reader.pages[:ESTIMATE_SAMPLE_PAGES]
+            for page in sample:
+                xobjects = page.get("/Resources", {}).get("/XObject", {})
+                for ref in xobjects.values():
+                    xobj = ref.get_object()
+                    if xobj.get("/Subtype") == "/Image":
+                        mode = _image_mode(xobj) or "RGB"
+                        pixels = xobj.get("/Width", 0) * xobj.get("/Height", 0)
+                        sampled_pixels += pixels
+                        largest_image = max(largest_image, pixels * len(mode))
+    except Exception as e:
+        raise ValueError(f"Could not read PDF: {e}")
+    input_bytes = source_size(input_path)
+    memory = input_bytes * MEMORY_PER_INPUT_BYTE + pages * MEMORY_PER_PAGE + workers * largest_image * 2
+    pixels = sampled_pixels * pages // len(sample) if sample else 0
+    return JobCost(memory, input_bytes, pages, pixels, largest_image)
+
+
+def _shard_source(input_path: Source, input_file) -> Union[str, bytes]:
+    """The input as worker processes can open it again: its path, or its bytes."""
+    if is_path(input_path):
+        return os.fspath(input_path)
+    if isinstance(input_path, bytes):
+        return input_path
+    input_file.seek(0)
+    return input_file.read()
+
+
+def compress_pdf(
+    input_path: Source,
+    output_path: Target,
+    dpi: int = 144,
+    image_quality: int = 75,
+    color_mode: str = "no-change",
+    workers: Optional[int] = None,
+    optimize_level: int = DEFAULT_OPTIMIZE_LEVEL,
+    progress: Optional[ProgressCallback] = None,
+    processes: int = 1
+) -> None:
+    """
+    Compress a PDF file by downsampling and re-encoding its images.
+
+    Every image XObject whose effective resolution (assuming it fills at
+    most its page) is above the target DPI is downsampled, then re-encoded
+    as JPEG at image_quality, converted to grayscale or 1-bit monochrome
+    when requested. Images shared between pages are processed once, and
+    images are processed in parallel. The result is then written with
+    lossless structural optimization (see tools.optimize_pdf).
+
+    With processes, documents of more than SHARD_PAGES pages have their
+    images recompressed in page-range shards on that many processes. Only
+    the new image data comes back; it replaces the images of the one
+    document read here, which is then written once, so shared resources
+    stay shared and the output is the same as from a single process.
+
     Args:
-        input_path: Path to the input PDF file
-        output_path: Path where the compressed PDF should be saved
+        input_path: Input PDF as a path, bytes or binary file
+        output_path: Path where the compressed PDF should be saved, or a
+            writable binary file
         dpi: DPI for image resampling (72-300, recommended: 144 for balance, 72 for max compression)
         image_quality: JPEG quality for images (10-100, recommended: 60-85)
         color_mode: Color mode conversion ('no-change', 'grayscale', 'monochrome')
+        workers: Threads used for image recompression (default: CPU count)
+        optimize_level: Lossless optimization effort (0-3, see OPTIMIZE_LEVELS)
+        progress: Called with a Progress once the pages are read, after
+            each image and once the output is written
+        processes: Worker processes for page-range shards (1: threads only)
     """
-    
+    if not MIN_DPI <= dpi <= MAX_DPI:
+        raise ValueError(f"dpi must be between {MIN_DPI} and {MAX_DPI}")
+    if not MIN_IMAGE_QUALITY <= image_quality <= MAX_IMAGE_QUALITY:
+        raise ValueError(f"image_quality must be between {MIN_IMAGE_QUALITY} and {MAX_IMAGE_QUALITY}")
+    if color_mode not in COLOR_MODES:
+        raise ValueError(f"color_mode must be one of: {', '.join(COLOR_MODES)}")
+
     try:
-        # Import with fallback support for both pypdf and PyPDF2
-        try:
-            from pypdf import PdfReader, PdfWriter
-        except ImportError:
-            try:
-                from PyPDF2 import PdfReader, PdfWriter
-            except ImportError:
-                raise ImportError("Neither pypdf nor PyPDF2 is installed. Please install pypdf>=4.0.0")
-        
-        logger.debug(f"Starting PDF compression: {input_path}")
-        
-        # Read the PDF
-        reader = PdfReader(input_path)
-        writer = PdfWriter()
-        
-        # Copy pages from reader to writer with compression
-        for page_num in range(len(reader.pages)):
-            page = reader.pages[page_num]
-            
-            # Add page to writer (PyPDF2 applies compression)
-            writer.add_page(page)
-        
-        # Write the compressed PDF
-        with open(output_path, "wb") as output_file:
-            writer.write(output_file)
-        
-        logger.debug(f"PDF written to: {output_path}")
-        
-        # Verify output file was created
-        if not Path(output_path).exists():
-            raise Exception("Compression completed but output file was not created")
-        
-        output_size = Path(output_path).stat().st_size
-        if output_size == 0:
-            raise Exception("Output file is empty after compression")
-        
-        input_size = Path(input_path).stat().st_size
+        logger.debug(f"Starting PDF compression: {input_path if is_path(input_path) else 'in-memory input'}")
+
+        with open_source(input_path) as input_file:
+            with stage(TOOL, "read"):
+                reader = PdfReader(input_file)
+                pages = len(reader.pages)
+                input_size = input_file.seek(0, os.SEEK_END)
+
+            count(TOOL, "pages", pages)
+            if progress is not None:
+                progress(Progress("read", pages, pages, "pages"))
+
+            # Images are replaced in the reader's objects, before the pages
+            # are copied, so shards can refer to them by object number
+            with stage(TOOL, "recompress_images"):
+                replaced = _recompress_images(
+                    reader.pages,
+                    dpi,
+                    image_quality,
+                    color_mode,
+                    workers or os.cpu_count() or 1,
+                    source=_shard_source(input_path, input_file) if processes > 1 and pages > SHARD_PAGES else None,
+                    processes=processes,
+                    progress=progress
+                )
+            count(TOOL, "images", replaced)
+            logger.debug(f"Recompressed {replaced} images")
+
+            with stage(TOOL, "copy"):
+                writer = PdfWriter()
+                for page in reader.pages:
+                    writer.add_page(page)
+
+        # Write the compressed PDF; the output file is removed again if this fails
+        with open_target(output_path) as output_file, stage(TOOL, "write"):
+            start = output_file.tell()
+            write_optimized(writer, output_file, optimize_level)
+            output_size = output_file.tell() - start
+
+            if output_size == 0:
+                raise Exception("Output file is empty after compression")
+        if progress is not None:
+            progress(Progress("write", pages, pages, "pages", output_size))
+
         logger.info(f"PDF compression successful: {input_size} -> {output_size} bytes")
-            
+
     except Exception as e:
         logger.error(f"PDF compression failed: {str(e)}", exc_info=True)
-        # Clean up output file if it exists but compression failed
-        if Path(output_path).exists():
-            try:
-                Path(output_path).unlink()
-            except Exception:
-                pass
         raise Exception(f"PDF compression failed: {str(e)}")
@@ -0,0 +1,112 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, NamedTuple, Optional, Union
+import io
+import os
+
+from pypdf import PdfReader
+
+# What the tools accept as input: a path, the file's bytes or an open binary file
+Source = Union[str, os.PathLike, bytes, bytearray, memoryview, BinaryIO]
+# Where the tools write their output: a path or a writable binary file
+Target = Union[str, os.PathLike, BinaryIO]
+
+
+class InputTooLarge(ValueError):
+    """An input that would need more resources than allowed, e.g. a decompression bomb."""
+
+
+class JobCost(NamedTuple):
+    """A job's estimated cost, worked out from file sizes, headers and page trees."""
+    memory: int  # peak bytes
+    input_bytes: int
+    pages: int
+    pixels: int  # pixels of the images to decode, 0 if not known
+    largest_image: int = 0  # bytes of the largest decoded image, 0 if not known
+
+
+def is_path(value) -> bool:
+    return isinstance(value, (str, os.PathLike))
+
+
+def load_source(source: Source) -> Union[str, os.PathLike, bytes]:
+    """
+    Return the source as a path or as bytes. File objects are read from
+    their current position so the result can be reopened (or pickled for
+    a worker process) any number of times.
+    """
+    if is_path(source) or isinstance(source, bytes):
+        return source
+    if isinstance(source, (bytearray, memoryview)):
+        return bytes(source)
+    return source.read()
+
+
+@contextmanager
+def open_source(source: Source) -> Iterator[BinaryIO]:
+    """Open a source for reading; paths are opened and closed, bytes are wrapped."""
+    if is_path(source):
+        with open(source, "rb") as f:
+            yield f
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(source)
+    else:
+        yield source
+
+
+def read_source(source: Source) -> bytes:
+    with open_source(source) as f:
+        return f.read()
+
+
+def pdf_page_count(source: Source) -> int:
+    """
+    Number of pages of a PDF, read from its page tree without loading the
+    pages' contents.
+
+    Raises:
+        ValueError: If the source is not a readable PDF
+    """
+    try:
+        with open_source(source) as f:
+            position = f.tell()
+            try:
+                return len(PdfReader(f).pages)
+            finally:
+                f.seek(position)
+    except Exception as e:
+        raise ValueError(f"Could not read PDF: {e}")
+
+
+def source_size(source: Source) -> int:
+    """Size of a source in bytes, without reading it."""
+    if is_path(source):
+        return os.path.getsize(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    position = source.tell()
+    size = source.seek(0, os.SEEK_END)
+    source.seek(position)
+    return size - position
+
+
+@contextmanager
+def open_target(target: Target) -> Iterator[BinaryIO]:
+    """
+    Open a target for writing. A path is removed again if the block fails,
+    so no partial output is left behind; file objects are left to the caller.
+    """
+    if not is_path(target):
+        yield target
+        return
+    try:
+        with open(target, "wb") as f:
+            yield f
+    except BaseException:
+        Path(target).unlink(missing_ok=True)
+        raise
+
+
+def target_name(target: Target) -> Optional[str]:
+    """Base name of a path target (without extension), or None for file objects."""
+    return Path(target).stem if is_path(target) else None
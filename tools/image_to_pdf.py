@@ -1,76 +1,463 @@
-from PIL import Image, ImageOps
-from typing import List
+from PIL import ExifTags, Image, ImageOps
+from concurrent.futures import Executor, ProcessPoolExecutor
+from collections import deque
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+import io
+import threading
 
-def convert_images_to_pdf(image_paths: List[str], output_path: str) -> None:
+from tools.file_io import (
+    InputTooLarge, JobCost, Source, Target, load_source, open_source, open_target, read_source, source_size, target_name
+)
+from tools.instrument import Progress, ProgressCallback, count, stage
+from tools.pdf_stream import StreamingPdfWriter
+
+# Use reasonable DPI for faster processing while maintaining quality
+DPI = 200  # Reduced from 300 for faster processing
+MAX_DIMENSION = 2000  # Max dimension to prevent huge files
+JPEG_QUALITY = 85  # Good balance between quality and file size
+# Images with more pixels are refused before decoding (decompression bombs)
+MAX_IMAGE_PIXELS = 100_000_000
+
+# Name under which stages and counts are reported (see tools.instrument)
+TOOL = 'image-to-pdf'
+
+# JPEG modes whose DCT data can be embedded in the PDF unchanged
+PASSTHROUGH_MODES = {'RGB': 'DeviceRGB', 'L': 'DeviceGray'}
+
+
+class RenderedPage(NamedTuple):
+    """An encoded page image ready to be written by StreamingPdfWriter."""
+    data: bytes
+    width: int
+    height: int
+    color_space: str = 'DeviceRGB'
+    orientation: int = 1  # EXIF orientation still to be applied on the page
+
+
+# Resize quality presets: whether JPEGs may be decoded at a reduced DCT scale
+# (draft mode) and the reducing_gap passed to Image.resize, which lets Pillow
+# shrink by an integer factor with Image.reduce before the final LANCZOS pass.
+RESIZE_QUALITY_PRESETS = {
+    'best': {'draft': False, 'reducing_gap': None},  # full decode, exact LANCZOS
+    'balanced': {'draft': True, 'reducing_gap': 3.0},
+    'fast': {'draft': True, 'reducing_gap': 2.0},
+}
+DEFAULT_RESIZE_QUALITY = 'balanced'
+
+
+_pools: Dict[int, Executor] = {}
+_pools_lock = threading.Lock()
+
+
+def get_process_pool(workers: int) -> Executor:
+    """
+    Return a process pool with the given number of workers, creating it on
+    first use. Pools are kept for the lifetime of the process so repeated
+    requests do not pay the start-up cost again.
+    """
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            _pools[workers] = pool
+        return pool
+
+
+def shutdown_process_pools() -> None:
+    """Shut down every pool created by get_process_pool()."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _pools.clear()
+
+
+def _fit_within_max(width: int, height: int) -> Optional[Tuple[int, int]]:
+    """Return the size that fits (width, height) into MAX_DIMENSION, or None if it already fits."""
+    if width <= MAX_DIMENSION and height <= MAX_DIMENSION:
+        return None
+    if width > height:
+        return MAX_DIMENSION, int(height * (MAX_DIMENSION / width))
+    return int(width * (MAX_DIMENSION / height)), MAX_DIMENSION
+
+
+def _prepare_image(img_path: Source, resize_quality: str = DEFAULT_RESIZE_QUALITY) -> Image.Image:
+    """
+    Load a single image, apply EXIF rotation, flatten it to RGB and
+    shrink it to MAX_DIMENSION.
+
+    Oversized JPEGs are decoded directly at the smallest DCT scale that is
+    still at least the target size (draft mode), and other formats are
+    shrunk with Image.reduce before resampling, so the LANCZOS resize only
+    covers the last factor of two or three.
+
+    Args:
+        img_path: Path to the image file, or its bytes
+        resize_quality: One of RESIZE_QUALITY_PRESETS
+
+    Returns:
+        A detached RGB image that the caller must close
+    """
+    preset = RESIZE_QUALITY_PRESETS[resize_quality]
+
+    # Open and auto-rotate based on EXIF
+    with open_source(img_path) as f, Image.open(f) as img_file:
+        # Target size is computed from the stored size; EXIF rotations by
+        # 90 degrees (orientations 5-8) swap it after transposing.
+        target = _fit_within_max(*img_file.size)
+        if target is not None and img_file.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8):
+            rotated_target = (target[1], target[0])
+        else:
+            rotated_target = target
+
+        with stage(TOOL, 'decode'):
+            if target is not None and preset['draft'] and img_file.format == 'JPEG':
+                img_file.draft(None, target)
+            img_file.load()
+
+        with stage(TOOL, 'exif_transpose'):
+            img = ImageOps.exif_transpose(img_file)
+            if img is None:
+                img = img_file
+
+        with stage(TOOL, 'resize'):
+            # Convert to RGB efficiently
+            if img.mode == 'RGBA':
+                # Create RGB background and paste
+                rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+                if len(img.split()) == 4:
+                    rgb_img.paste(img, mask=img.split()[3])
+                else:
+                    rgb_img.paste(img)
+                img = rgb_img
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            # Resize if image is too large (speeds up processing significantly)
+            if rotated_target is not None and img.size != rotated_target:
+                img = img.resize(
+                    rotated_target,
+                    Image.Resampling.LANCZOS,
+                    reducing_gap=preset['reducing_gap']
+                )
+
+        # Create a copy to keep after the context manager closes
+        return img.copy()
+
+
+def _encode_jpeg(img: Image.Image) -> bytes:
+    """Encode an RGB image the same way Pillow's PDF writer does."""
+    buffer = io.BytesIO()
+    with stage(TOOL, 'encode'):
+        img.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def _passthrough_jpeg(img_path: Source) -> Optional[RenderedPage]:
+    """
+    Return the original JPEG bytes when they can be embedded as-is, i.e. the
+    file is a baseline/progressive RGB or grayscale JPEG that needs no
+    resizing. EXIF rotation is not applied to the pixels; it is recorded so
+    the page can rotate the image losslessly instead.
+
+    Returns:
+        RenderedPage with the untouched DCT stream, or None if the image has
+        to be decoded and re-encoded
+    """
+    with open_source(img_path) as f, Image.open(f) as img_file:
+        if img_file.format != 'JPEG' or img_file.mode not in PASSTHROUGH_MODES:
+            return None
+        width, height = img_file.size
+        if width > MAX_DIMENSION or height > MAX_DIMENSION:
+            return None
+        orientation = img_file.getexif().get(ExifTags.Base.Orientation, 1)
+        if orientation not in range(1, 9):
+            orientation = 1
+        color_space = PASSTHROUGH_MODES[img_file.mode]
+
+    return RenderedPage(read_source(img_path), width, height, color_space, orientation)
+
+
+def _image_peak_memory(
+    width: int,
+    height: int,
+    mode: str,
+    image_format: str,
+    file_size: int,
+    passthrough: bool,
+    resize_quality: str
+) -> int:
+    """Bytes held at once while _render_page processes one image, following its stages."""
+    target = _fit_within_max(width, height)
+    if passthrough and image_format == 'JPEG' and mode in PASSTHROUGH_MODES and target is None:
+        return file_size * 2
+
+    # Draft mode decodes JPEGs at the smallest DCT scale still above the target
+    scale = 1
+    if target is not None and RESIZE_QUALITY_PRESETS[resize_quality]['draft'] and image_format == 'JPEG':
+        while scale < 8 and width // (scale * 2) >= target[0] and height // (scale * 2) >= target[1]:
+            scale *= 2
+    pixels = (width // scale) * (height // scale)
+    bytes_per_pixel = 4 if mode in ('I', 'F', 'I;16', 'RGBA', 'CMYK') else Image.getmodebands(mode)
+
+    # Decoded image and the copy returned by exif_transpose
+    peak = pixels * bytes_per_pixel * 2
+    if mode == 'RGBA':
+        peak += pixels * 4 + pixels * 3  # split bands and flattened copy
+    elif mode != 'RGB':
+        peak += pixels * 3  # converted copy
+    if target is None:
+        final = pixels * 3
+    else:
+        final = target[0] * target[1] * 3
+        peak += target[0] * (height // scale) * 3  # intermediate pass of the resampling
+    # Resized image and its detached copy, plus the encoded JPEG
+    return peak + final * 2 + final // 4
+
+
+def estimate_cost(
+    image_paths: List[Source],
+    passthrough: bool = True,
+    resize_quality: str = DEFAULT_RESIZE_QUALITY
+) -> JobCost:
+    """
+    Estimate the cost of convert_images_to_pdf (serial streaming mode) from
+    the image headers alone; nothing is decoded. Pages are processed one at
+    a time, so the peak memory is that of the costliest image.
+
+    Raises:
+        InputTooLarge: If an image has more than MAX_IMAGE_PIXELS pixels
+        ValueError: If an image cannot be read
+    """
+    peak = input_bytes = total_pixels = 0
+    for index, img_path in enumerate(image_paths, start=1):
+        try:
+            with open_source(img_path) as f, Image.open(f) as img_file:
+                width, height = img_file.size
+                mode, image_format = img_file.mode, img_file.format
+        except Image.DecompressionBombError:
+            raise InputTooLarge(f"Image {index} is too large (more than {MAX_IMAGE_PIXELS} pixels)")
+        except Exception as e:
+            raise ValueError(f"Image {index} could not be read: {e}")
+        if width * height > MAX_IMAGE_PIXELS:
+            raise InputTooLarge(
+                f"Image {index} is too large: {width}x{height} pixels (limit {MAX_IMAGE_PIXELS} pixels)"
+            )
+        file_size = source_size(img_path)
+        peak = max(peak, _image_peak_memory(
+            width, height, mode, image_format, file_size, passthrough, resize_quality
+        ))
+        input_bytes += file_size
+        total_pixels += width * height
+    return JobCost(peak, input_bytes, len(image_paths), total_pixels)
+
+
+def _orientation_matrix(orientation: int, page_width: float, page_height: float) -> Tuple[float, ...]:
+    """
+    Image placement matrix that displays a stored image with the given EXIF
+    orientation upright on a page of the given (already rotated) size.
+    """
+    w, h = page_width, page_height
+    return {
+        1: (w, 0, 0, h, 0, 0),
+        2: (-w, 0, 0, h, w, 0),      # mirrored horizontally
+        3: (-w, 0, 0, -h, w, h),     # rotated 180
+        4: (w, 0, 0, -h, 0, h),      # mirrored vertically
+        5: (0, -h, -w, 0, w, h),     # transposed
+        6: (0, -h, w, 0, 0, h),      # rotated 90 clockwise
+        7: (0, h, w, 0, 0, 0),       # transversed
+        8: (0, h, -w, 0, w, 0),      # rotated 90 counter-clockwise
+    }[orientation]
+
+
+def _render_page(
+    img_path: Source,
+    passthrough: bool = True,
+    resize_quality: str = DEFAULT_RESIZE_QUALITY
+) -> RenderedPage:
+    """
+    Run every per-image stage (decode, rotate, flatten, resize, encode) for
+    one image. JPEGs that need no resizing skip all of them and are copied
+    through untouched. Module-level so it can be shipped to a worker process.
+    """
+    if passthrough:
+        with stage(TOOL, 'passthrough'):
+            page = _passthrough_jpeg(img_path)
+        if page is not None:
+            return page
+
+    img = _prepare_image(img_path, resize_quality)
+    try:
+        width, height = img.size
+        return RenderedPage(_encode_jpeg(img), width, height)
+    finally:
+        img.close()
+
+
+def _render_pages(
+    image_paths: List[Source],
+    workers: int,
+    passthrough: bool,
+    resize_quality: str
+) -> Iterator[RenderedPage]:
+    """
+    Yield rendered pages in input order. With more than one worker the pages
+    are rendered in a process pool, keeping at most two pages per worker in
+    flight so memory stays bounded.
+    """
+    if workers <= 1 or len(image_paths) == 1:
+        for img_path in image_paths:
+            yield _render_page(img_path, passthrough, resize_quality)
+        return
+
+    pool = get_process_pool(workers)
+    window = workers * 2
+    pending = deque()
+    remaining = iter(image_paths)
+    try:
+        for img_path in remaining:
+            pending.append(pool.submit(_render_page, img_path, passthrough, resize_quality))
+            if len(pending) >= window:
+                break
+        while pending:
+            result = pending.popleft().result()
+            next_path = next(remaining, None)
+            if next_path is not None:
+                pending.append(pool.submit(_render_page, next_path, passthrough, resize_quality))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def convert_images_to_pdf(
+    image_paths: List[Source],
+    output_path: Target,
+    streaming: bool = True,
+    workers: int = 1,
+    passthrough: bool = True,
+    resize_quality: str = DEFAULT_RESIZE_QUALITY,
+    progress: Optional[ProgressCallback] = None
+) -> None:
     """
     Convert multiple images to a single PDF file with optimization for speed.
     Uses efficient memory management and processing.
-    
+
+    In streaming mode (the default) each page is encoded and written to the
+    PDF as soon as its image has been processed, and the decoded bitmap is
+    released before the next image is opened. Peak memory therefore stays at
+    roughly one page regardless of the number of images.
+
+    Inputs and output may also be in memory, so small jobs never touch
+    the disk.
+
     Args:
-        image_paths: List of paths to image files
-        output_path: Path where the PDF should be saved
+        image_paths: List of image files, each a path, bytes or binary file
+        output_path: Path where the PDF should be saved, or a writable
+            binary file
+        streaming: Write pages incrementally instead of holding all
+            decoded images until the end
+        workers: Number of worker processes used to decode, resize and
+            encode images in parallel (streaming mode only). Pages keep
+            their original order.
+        passthrough: Embed JPEGs that need no resizing without decoding
+            and re-encoding them; EXIF rotation is applied on the page
+            instead of to the pixels (streaming mode only)
+        resize_quality: Downscaling preset for images larger than
+            MAX_DIMENSION: 'best' (full decode + LANCZOS), 'balanced'
+            (reduced JPEG decoding, reducing_gap=3) or 'fast' (reducing_gap=2)
+        progress: Called with a Progress after each image, in images
     """
     if not image_paths:
         raise ValueError("No images provided")
-    
-    # Use reasonable DPI for faster processing while maintaining quality
-    DPI = 200  # Reduced from 300 for faster processing
-    MAX_DIMENSION = 2000  # Max dimension to prevent huge files
-    
+
+    if resize_quality not in RESIZE_QUALITY_PRESETS:
+        raise ValueError(
+            f"Invalid resize quality: {resize_quality}. "
+            f"Allowed: {', '.join(RESIZE_QUALITY_PRESETS)}"
+        )
+
+    # File objects cannot be reopened or sent to worker processes
+    image_paths = [load_source(img_path) for img_path in image_paths]
+    count(TOOL, 'images', len(image_paths))
+
+    if streaming:
+        _convert_streaming(image_paths, output_path, workers, passthrough, resize_quality, progress)
+    else:
+        _convert_buffered(image_paths, output_path, resize_quality, progress)
+
+
+def _convert_streaming(
+    image_paths: List[Source],
+    output_path: Target,
+    workers: int,
+    passthrough: bool,
+    resize_quality: str,
+    progress: Optional[ProgressCallback]
+) -> None:
+    with open_target(output_path) as output_file:
+        writer = StreamingPdfWriter(output_file, title=target_name(output_path))
+        for page in _render_pages(image_paths, workers, passthrough, resize_quality):
+            width, height = page.width, page.height
+            if page.orientation >= 5:
+                width, height = height, width
+            page_width = width * 72.0 / DPI
+            page_height = height * 72.0 / DPI
+            with stage(TOOL, 'write'):
+                writer.add_image_page(
+                    page.data,
+                    page.width,
+                    page.height,
+                    color_space=page.color_space,
+                    page_width=page_width,
+                    page_height=page_height,
+                    transform=_orientation_matrix(page.orientation, page_width, page_height),
+                )
+            count(TOOL, 'pages')
+            if progress is not None:
+                progress(Progress('write', writer.page_count, len(image_paths), 'images', writer.bytes_written))
+        with stage(TOOL, 'write'):
+            writer.close()
+        if progress is not None:
+            progress(Progress('write', writer.page_count, len(image_paths), 'images', writer.bytes_written))
+
+
+def _convert_buffered(
+    image_paths: List[Source],
+    output_path: Target,
+    resize_quality: str,
+    progress: Optional[ProgressCallback]
+) -> None:
     processed_images: List[Image.Image] = []
-    
+
     try:
         for img_path in image_paths:
-            # Open and auto-rotate based on EXIF
-            with Image.open(img_path) as img_file:
-                img = ImageOps.exif_transpose(img_file)
-                if img is None:
-                    img = img_file
-                
-                # Convert to RGB efficiently
-                if img.mode == 'RGBA':
-                    # Create RGB background and paste
-                    rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                    if len(img.split()) == 4:
-                        rgb_img.paste(img, mask=img.split()[3])
-                    else:
-                        rgb_img.paste(img)
-                    img = rgb_img
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # Resize if image is too large (speeds up processing significantly)
-                width, height = img.size
-                if width > MAX_DIMENSION or height > MAX_DIMENSION:
-                    if width > height:
-                        new_width = MAX_DIMENSION
-                        new_height = int(height * (MAX_DIMENSION / width))
-                    else:
-                        new_height = MAX_DIMENSION
-                        new_width = int(width * (MAX_DIMENSION / height))
-                    
-                    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                
-                # Create a copy to keep after the context manager closes
-                processed_images.append(img.copy())
-        
+            processed_images.append(_prepare_image(img_path, resize_quality))
+            if progress is not None:
+                progress(Progress('prepare', len(processed_images), len(image_paths), 'images'))
+
         if not processed_images:
             raise ValueError("No valid images to convert")
-        
+
         # Save all images to PDF with optimization
         first_image = processed_images[0]
         other_images = processed_images[1:] if len(processed_images) > 1 else []
-        
-        first_image.save(
-            output_path,
-            "PDF",
-            resolution=DPI,
-            save_all=True,
-            append_images=other_images,
-            quality=85,  # Good balance between quality and file size
-            optimize=True
-        )
-    
+
+        with open_target(output_path) as output_file, stage(TOOL, 'write'):
+            start = output_file.tell()
+            first_image.save(
+                output_file,
+                "PDF",
+                resolution=DPI,
+                save_all=True,
+                append_images=other_images,
+                quality=JPEG_QUALITY,
+                optimize=True
+            )
+            written = output_file.tell() - start
+        count(TOOL, 'pages', len(processed_images))
+        if progress is not None:
+            progress(Progress('write', len(processed_images), len(image_paths), 'images', written))
+
     finally:
         # Clean up all images from memory
         for img in processed_images:
@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+from typing import Callable, Iterator, NamedTuple, Optional, Protocol
+import time
+
+
+class Recorder(Protocol):
+    """Receives the measurements reported by the tools (see metrics.py)."""
+
+    def observe_stage(self, tool: str, stage: str, seconds: float) -> None: ...
+
+    def count(self, tool: str, name: str, amount: int) -> None: ...
+
+
+class Progress(NamedTuple):
+    """How far a tool has got, passed to the progress callback the tools accept."""
+    stage: str  # e.g. "read", "recompress_images", "write"
+    done: int
+    total: int
+    unit: str  # what done and total count: "images", "documents" or "pages"
+    bytes_written: int = 0  # output written so far
+
+
+# Called by a tool, on the thread running it, each time it makes progress
+ProgressCallback = Callable[[Progress], None]
+
+_recorder: Optional[Recorder] = None
+
+
+def set_recorder(recorder: Optional[Recorder]) -> None:
+    """
+    Install the recorder that receives stage timings and counts. Until one
+    is installed, stage() and count() do nothing, so the tools can be used
+    without any metrics backend.
+    """
+    global _recorder
+    _recorder = recorder
+
+
+@contextmanager
+def stage(tool: str, name: str) -> Iterator[None]:
+    """Time the enclosed block as one stage of a tool, whether it succeeds or fails."""
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.observe_stage(tool, name, time.perf_counter() - start)
+
+
+def count(tool: str, name: str, amount: int = 1) -> None:
+    """Add amount to one of a tool's counters, e.g. pages or images."""
+    recorder = _recorder
+    if recorder is not None and amount:
+        recorder.count(tool, name, amount)
@@ -1,13 +1,87 @@
 from pypdf import PdfWriter, PdfReader
-from typing import List
+from typing import List, Optional
 
-def merge_pdfs(pdf_paths: List[str], output_path: str) -> None:
+from tools.file_io import JobCost, Source, Target, open_source, open_target, pdf_page_count, source_size
+from tools.instrument import Progress, ProgressCallback, count, stage
+from tools.optimize_pdf import DEFAULT_OPTIMIZE_LEVEL, ObjectDeduplicator, write_optimized
+
+# Name under which stages and counts are reported (see tools.instrument)
+TOOL = "merge-pdf"
+
+# Peak memory per input byte and per page while merging, measured with
+# benchmark.py (parsed source objects plus the writer's copies)
+MEMORY_PER_INPUT_BYTE = 3
+MEMORY_PER_PAGE = 32 * 1024
+
+def _release_reader(writer: PdfWriter, reader: PdfReader) -> None:
+    """
+    Drop the writer's bookkeeping for a source document. pypdf keeps every
+    source reader (and every object it parsed) alive for the writer's
+    lifetime so later copies can reuse its translations; merge_pdfs never
+    copies from a source twice, so it can be freed as soon as it is done.
+
+    pypdf also points internal links (e.g. /Dest of link annotations) at
+    the merged pages only when the document is written, looking them up
+    through that bookkeeping; the source's links are resolved here instead,
+    while its pages can still be found.
+    """
+    # Only this source's links are pending: earlier ones were resolved already
+    writer._resolve_links()
+    writer._unresolved_links.clear()
+    writer._id_translated.pop(id(reader), None)
+    # Parsed objects point back at the reader; clearing its cache breaks the
+    # cycle so the memory is returned right away rather than at the next GC
+    reader.resolved_objects.clear()
+    writer._merged_in_pages = {
+        source: target
+        for source, target in writer._merged_in_pages.items()
+        if source is None or source.pdf is not reader
+    }
+
+
+def estimate_cost(pdf_paths: List[Source]) -> JobCost:
+    """
+    Estimate the cost of merge_pdfs, including its peak memory, from the
+    sources' sizes and page counts; only the page trees are read.
+
+    Raises:
+        ValueError: If a source is not a readable PDF
+    """
+    total_bytes = pages = 0
+    for index, pdf_path in enumerate(pdf_paths, start=1):
+        try:
+            pages += pdf_page_count(pdf_path)
+        except ValueError as e:
+            raise ValueError(f"File {index}: {e}")
+        total_bytes += source_size(pdf_path)
+    memory = total_bytes * MEMORY_PER_INPUT_BYTE + pages * MEMORY_PER_PAGE
+    return JobCost(memory, total_bytes, pages, 0)
+
+
+def merge_pdfs(
+    pdf_paths: List[Source],
+    output_path: Target,
+    optimize_level: int = DEFAULT_OPTIMIZE_LEVEL,
+    dedupe_resources: bool = True,
+    progress: Optional[ProgressCallback] = None
+) -> None:
     """
     Merge multiple PDF files into a single PDF.
+
+    Each source is opened, its pages are copied into the output and the
+    source is closed before the next one is read. With dedupe_resources,
+    fonts, images and other objects identical to ones already copied from
+    an earlier source are merged right after each source, so output size
+    and memory grow with unique content rather than document count.
     
     Args:
-        pdf_paths: List of paths to PDF files to merge
-        output_path: Path where the merged PDF should be saved
+        pdf_paths: PDF files to merge, each a path, bytes or binary file
+        output_path: Path where the merged PDF should be saved, or a
+            writable binary file
+        optimize_level: Lossless optimization effort (0-3, see tools.optimize_pdf)
+        dedupe_resources: Share identical resources across source documents
+        progress: Called with a Progress after each source and once the
+            output is written, in documents
     """
     if not pdf_paths:
         raise ValueError("No PDF files provided")
@@ -16,11 +90,26 @@ def merge_pdfs(pdf_paths: List[str], output_path: str) -> None:
         raise ValueError("At least 2 PDF files are required for merging")
     
     writer = PdfWriter()
+    deduplicator = ObjectDeduplicator(writer) if dedupe_resources else None
     
-    for pdf_path in pdf_paths:
-        reader = PdfReader(pdf_path)
-        for page in reader.pages:
-            writer.add_page(page)
+    for done, pdf_path in enumerate(pdf_paths, start=1):
+        with stage(TOOL, "read"), open_source(pdf_path) as pdf_file:
+            reader = PdfReader(pdf_file)
+            for page in reader.pages:
+                writer.add_page(page)
+            _release_reader(writer, reader)
+        del reader
+
+        if deduplicator is not None:
+            with stage(TOOL, "dedupe"):
+                deduplicator.dedupe_new_objects()
+        if progress is not None:
+            progress(Progress("read", done, len(pdf_paths), "documents"))
     
-    with open(output_path, 'wb') as output_file:
-        writer.write(output_file)
+    count(TOOL, "pages", len(writer.pages))
+    with open_target(output_path) as output_file, stage(TOOL, "write"):
+        start = output_file.tell()
+        write_optimized(writer, output_file, optimize_level)
+        written = output_file.tell() - start
+    if progress is not None:
+        progress(Progress("write", len(pdf_paths), len(pdf_paths), "documents", written))
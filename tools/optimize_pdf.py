@@ -0,0 +1,304 @@
+from typing import BinaryIO, Dict, List, Tuple
+import hashlib
+import io
+import logging
+import struct
+import zlib
+
+from pypdf import PdfWriter
+from pypdf.filters import decode_stream_data
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+logger = logging.getLogger(__name__)
+
+# Effort levels for lossless structural optimization:
+#   0 - write the document as pypdf builds it
+#   1 - Flate-compress every unfiltered stream (page contents, fonts, forms)
+#   2 - also merge identical objects, drop unreferenced ones and pack
+#       non-stream objects into object streams with a cross-reference stream
+#   3 - also re-deflate existing Flate streams at maximum compression
+OPTIMIZE_LEVELS = (0, 1, 2, 3)
+DEFAULT_OPTIMIZE_LEVEL = 2
+
+# Objects per object stream; small enough that readers can load one quickly
+OBJECTS_PER_STREAM = 100
+
+# Streams shorter than this are not worth a Flate filter
+MIN_STREAM_LENGTH = 64
+
+
+# Objects that must stay distinct even when their content is identical
+_UNIQUE_TYPES = ("/Page", "/Pages", "/Catalog", "/Annot")
+
+
+def _content_key(obj) -> bytes:
+    """
+    Digest of an object's serialized form. Streams are keyed on their raw
+    (still encoded) data so nothing has to be decompressed.
+    """
+    digest = hashlib.sha256(obj.__class__.__name__.encode())
+    if isinstance(obj, StreamObject):
+        digest.update(repr(DictionaryObject(obj)).encode())
+        digest.update(obj._data)
+    else:
+        digest.update(repr(obj).encode())
+    return digest.digest()
+
+
+def _is_unique(obj) -> bool:
+    if isinstance(obj, DictionaryObject):
+        return obj.get("/Type") in _UNIQUE_TYPES or "/Parent" in obj
+    return False
+
+
+def _replace_refs(obj, mapping: Dict[int, IndirectObject]) -> None:
+    if isinstance(obj, DictionaryObject):
+        items = list(obj.items())
+    elif isinstance(obj, ArrayObject):
+        items = list(enumerate(obj))
+    else:
+        return
+    for key, value in items:
+        if isinstance(value, IndirectObject):
+            replacement = mapping.get(value.idnum)
+            if replacement is not None:
+                obj[key] = replacement
+        else:
+            _replace_refs(value, mapping)
+
+
+class ObjectDeduplicator:
+    """
+    Incrementally merges identical objects in a PdfWriter.
+
+    Call dedupe_new_objects() after each batch of pages is added (e.g. after
+    each source document of a merge). Objects added since the previous call
+    that are identical to an object seen earlier - fonts, ICC profiles or
+    images repeated across documents - are dropped and every reference to
+    them is pointed at the first copy. Duplicates are therefore released
+    right away instead of accumulating until the final write. Passes repeat
+    until nothing changes, so containers of deduplicated objects (e.g. font
+    dictionaries pointing at a shared font file) are merged too.
+    """
+
+    def __init__(self, writer: PdfWriter):
+        self.writer = writer
+        self._index: Dict[bytes, IndirectObject] = {}
+        self._start = 0
+        self.removed = 0
+
+    def dedupe_new_objects(self) -> int:
+        """Deduplicate objects added since the last call. Returns how many were removed."""
+        objects = self.writer._objects
+        new_range = range(self._start, len(objects))
+        removed = 0
+
+        while True:
+            mapping: Dict[int, IndirectObject] = {}
+            for index in new_range:
+                obj = objects[index]
+                if obj is None or _is_unique(obj):
+                    continue
+                ref = obj.indirect_reference
+                key = _content_key(obj)
+                existing = self._index.setdefault(key, ref)
+                if existing.idnum != ref.idnum:
+                    mapping[ref.idnum] = existing
+                    objects[index] = None
+            if not mapping:
+                break
+            removed += len(mapping)
+            for index in new_range:
+                if objects[index] is not None:
+                    _replace_refs(objects[index], mapping)
+
+        self._start = len(objects)
+        self.removed += removed
+        return removed
+
+
+def _compress_unfiltered_streams(writer: PdfWriter, zlib_level: int) -> None:
+    objects = writer._objects
+    for index, obj in enumerate(objects):
+        if not isinstance(obj, StreamObject) or "/Filter" in obj:
+            continue
+        # XMP metadata is meant to stay readable without decompression
+        if obj.get("/Type") == "/Metadata":
+            continue
+        data = obj.get_data()
+        if len(data) < MIN_STREAM_LENGTH:
+            continue
+        encoded = obj.flate_encode(zlib_level)
+        encoded.indirect_reference = obj.indirect_reference
+        objects[index] = encoded
+
+
+def _redeflate_streams(writer: PdfWriter) -> None:
+    """Recompress streams whose only filter is Flate (without predictors) at level 9."""
+    for obj in writer._objects:
+        if not isinstance(obj, StreamObject):
+            continue
+        if obj.get("/Filter") not in ("/FlateDecode", ArrayObject([NameObject("/FlateDecode")])):
+            continue
+        if obj.get("/DecodeParms"):
+            continue
+        try:
+            recompressed = zlib.compress(decode_stream_data(obj), 9)
+        except Exception as e:
+            logger.debug(f"Skipping stream that could not be decoded: {e}")
+            continue
+        if len(recompressed) < len(obj._data):
+            StreamObject.set_data(obj, recompressed)
+            obj.decoded_self = None
+
+
+def optimize_writer(writer: PdfWriter, level: int = DEFAULT_OPTIMIZE_LEVEL) -> None:
+    """
+    Apply the in-memory part of lossless optimization to a writer.
+    Object stream packing happens when writing, see write_optimized().
+
+    Args:
+        writer: Writer holding the finished document
+        level: Effort level, one of OPTIMIZE_LEVELS
+    """
+    if level not in OPTIMIZE_LEVELS:
+        raise ValueError(f"optimize level must be one of: {', '.join(map(str, OPTIMIZE_LEVELS))}")
+    if level == 0:
+        return
+
+    _compress_unfiltered_streams(writer, 9 if level >= 3 else 6)
+    if level >= 2:
+        writer.compress_identical_objects(remove_duplicates=True, remove_unreferenced=True)
+    if level >= 3:
+        _redeflate_streams(writer)
+
+
+def _serialize(obj) -> bytes:
+    buffer = io.BytesIO()
+    obj.write_to_stream(buffer)
+    return buffer.getvalue()
+
+
+class _CountingWriter:
+    """Wraps an output stream and tracks the number of bytes written."""
+
+    def __init__(self, fp: BinaryIO):
+        self._fp = fp
+        self.offset = 0
+
+    def write(self, data: bytes) -> None:
+        self._fp.write(data)
+        self.offset += len(data)
+
+
+def _write_packed(writer: PdfWriter, fp: BinaryIO) -> None:
+    """
+    Serialize the writer as a PDF 1.5 file: streams are written as regular
+    objects, everything else is packed into Flate-compressed object streams,
+    and the cross-reference table is written as a compressed XRef stream.
+    """
+    out = _CountingWriter(fp)
+    objects = writer._objects
+    size = len(objects) + 1
+    # xref entries indexed by object number: (type, field2, field3)
+    entries: List[Tuple[int, int, int]] = [(0, 0, 65535)] + [(0, 0, 0)] * len(objects)
+
+    # Object and cross-reference streams need PDF 1.5
+    header = writer.pdf_header if writer.pdf_header >= "%PDF-1.5" else "%PDF-1.5"
+    out.write(header.encode() + b"\n%\xe2\xe3\xcf\xd3\n")
+
+    packable: List[Tuple[int, bytes]] = []
+    for idnum, obj in enumerate(objects, start=1):
+        if obj is None:
+            continue
+        if isinstance(obj, StreamObject):
+            entries[idnum] = (1, out.offset, 0)
+            out.write(b"%d 0 obj\n" % idnum)
+            obj.write_to_stream(out)
+            out.write(b"\nendobj\n")
+        else:
+            packable.append((idnum, _serialize(obj)))
+
+    next_id = size
+    for start in range(0, len(packable), OBJECTS_PER_STREAM):
+        batch = packable[start:start + OBJECTS_PER_STREAM]
+        stream_id = next_id
+        next_id += 1
+
+        header_parts = []
+        body = io.BytesIO()
+        for index, (idnum, data) in enumerate(batch):
+            header_parts.append(b"%d %d" % (idnum, body.tell()))
+            body.write(data)
+            body.write(b"\n")
+            entries[idnum] = (2, stream_id, index)
+        header = b" ".join(header_parts) + b"\n"
+
+        object_stream = StreamObject()
+        object_stream[NameObject("/Type")] = NameObject("/ObjStm")
+        object_stream[NameObject("/N")] = NumberObject(len(batch))
+        object_stream[NameObject("/First")] = NumberObject(len(header))
+        object_stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+        object_stream.set_data(zlib.compress(header + body.getvalue(), 9))
+
+        entries.append((1, out.offset, 0))
+        out.write(b"%d 0 obj\n" % stream_id)
+        object_stream.write_to_stream(out)
+        out.write(b"\nendobj\n")
+
+    # Cross-reference stream, which also takes the place of the trailer
+    xref_id = next_id
+    xref_offset = out.offset
+    entries.append((1, xref_offset, 0))
+
+    offset_width = max(1, (max(entry[1] for entry in entries).bit_length() + 7) // 8)
+    index_width = max(1, (max(entry[2] for entry in entries).bit_length() + 7) // 8)
+    rows = b"".join(
+        struct.pack(">B", kind)
+        + field2.to_bytes(offset_width, "big")
+        + field3.to_bytes(index_width, "big")
+        for kind, field2, field3 in entries
+    )
+
+    xref_stream = StreamObject()
+    xref_stream[NameObject("/Type")] = NameObject("/XRef")
+    xref_stream[NameObject("/Size")] = NumberObject(len(entries))
+    xref_stream[NameObject("/W")] = ArrayObject(
+        [NumberObject(1), NumberObject(offset_width), NumberObject(index_width)]
+    )
+    xref_stream[NameObject("/Root")] = writer.root_object.indirect_reference
+    if writer._info is not None:
+        xref_stream[NameObject("/Info")] = writer._info.indirect_reference
+    if writer._ID is not None:
+        xref_stream[NameObject("/ID")] = writer._ID
+    xref_stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+    xref_stream.set_data(zlib.compress(rows, 9))
+
+    out.write(b"%d 0 obj\n" % xref_id)
+    xref_stream.write_to_stream(out)
+    out.write(b"\nendobj\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+
+
+def write_optimized(writer: PdfWriter, fp: BinaryIO, level: int = DEFAULT_OPTIMIZE_LEVEL) -> None:
+    """
+    Optimize the writer losslessly and write it to fp.
+
+    Args:
+        writer: Writer holding the finished document
+        fp: Binary output stream
+        level: Effort level, one of OPTIMIZE_LEVELS
+    """
+    optimize_writer(writer, level)
+    # Encrypted output cannot use object streams through this path
+    if level < 2 or writer._encryption is not None:
+        writer.write(fp)
+        return
+    writer._resolve_links()
+    _write_packed(writer, fp)
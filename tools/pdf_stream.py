@@ -0,0 +1,165 @@
+from PIL import PdfParser
+from PIL.PdfParser import IndirectReference, PdfName, PdfDict, pdf_repr
+from typing import BinaryIO, Dict, List, Optional, Sequence
+import time
+
+
+class StreamingPdfWriter:
+    """
+    Minimal append-only PDF writer for image pages.
+
+    Every page is written to the output as soon as it is added, so only the
+    byte offsets of the objects written so far are kept in memory. The page
+    tree, catalog and cross-reference table are emitted by close().
+    Offsets are tracked internally, which means the output stream does not
+    need to be seekable.
+    """
+
+    def __init__(self, fp: BinaryIO, title: Optional[str] = None):
+        self._fp = fp
+        self._offset = 0
+        self._xref: Dict[int, int] = {}
+        self._next_id = 1
+        self._page_refs: List[IndirectReference] = []
+        self._title = title
+        self._closed = False
+
+        self._catalog_ref = self._allocate()
+        self._pages_ref = self._allocate()
+
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self) -> int:
+        return len(self._page_refs)
+
+    @property
+    def bytes_written(self) -> int:
+        return self._offset
+
+    def _allocate(self) -> IndirectReference:
+        ref = IndirectReference(self._next_id, 0)
+        self._next_id += 1
+        return ref
+
+    def _write(self, data: bytes) -> None:
+        self._fp.write(data)
+        self._offset += len(data)
+
+    def _write_obj(self, ref: IndirectReference, value=None, stream: Optional[bytes] = None, **dict_obj) -> None:
+        self._xref[ref.object_id] = self._offset
+        self._write(b"%d %d obj\n" % (ref.object_id, ref.generation))
+        if stream is not None:
+            dict_obj["Length"] = len(stream)
+        if dict_obj:
+            self._write(pdf_repr(dict_obj))
+        if value is not None:
+            self._write(pdf_repr(value))
+        if stream is not None:
+            self._write(b"\nstream\n")
+            self._write(stream)
+            self._write(b"\nendstream")
+        self._write(b"\nendobj\n")
+
+    def add_image_page(
+        self,
+        image_data: bytes,
+        width: int,
+        height: int,
+        color_space: str,
+        page_width: float,
+        page_height: float,
+        filter_name: str = "DCTDecode",
+        bits_per_component: int = 8,
+        decode: Optional[list] = None,
+        transform: Optional[Sequence[float]] = None,
+    ) -> None:
+        """
+        Write one page showing a single already-encoded image scaled to the page.
+
+        Args:
+            image_data: Encoded image stream (e.g. JPEG bytes for DCTDecode)
+            width: Image width in pixels
+            height: Image height in pixels
+            color_space: PDF color space name ('DeviceRGB', 'DeviceGray', ...)
+            page_width: Page width in points
+            page_height: Page height in points
+            filter_name: PDF filter the image stream is encoded with
+            bits_per_component: Bits per color component
+            decode: Optional /Decode array
+            transform: Optional 6-element matrix (a b c d e f) mapping the
+                unit square onto the page. Defaults to scaling the image to
+                fill the page; other matrices can rotate or mirror it without
+                touching the image data.
+        """
+        if self._closed:
+            raise ValueError("Cannot add pages to a closed PDF writer")
+
+        image_ref = self._allocate()
+        contents_ref = self._allocate()
+        page_ref = self._allocate()
+
+        self._write_obj(
+            image_ref,
+            stream=image_data,
+            Type=PdfName("XObject"),
+            Subtype=PdfName("Image"),
+            Width=width,
+            Height=height,
+            Filter=PdfName(filter_name),
+            BitsPerComponent=bits_per_component,
+            ColorSpace=PdfName(color_space),
+            Decode=decode,
+        )
+
+        procset = "ImageB" if color_space == "DeviceGray" else "ImageC"
+        if transform is None:
+            transform = (page_width, 0, 0, page_height, 0, 0)
+        page_contents = b"q %f %f %f %f %f %f cm /image Do Q\n" % tuple(transform)
+        self._write_obj(contents_ref, stream=page_contents)
+
+        self._write_obj(
+            page_ref,
+            Type=PdfName("Page"),
+            Parent=self._pages_ref,
+            Resources=PdfDict(
+                ProcSet=[PdfName("PDF"), PdfName(procset)],
+                XObject=PdfDict(image=image_ref),
+            ),
+            MediaBox=[0, 0, page_width, page_height],
+            Contents=contents_ref,
+        )
+        self._page_refs.append(page_ref)
+
+    def close(self) -> None:
+        """Write the page tree, catalog, info dictionary and trailer."""
+        if self._closed:
+            return
+        self._closed = True
+
+        self._write_obj(
+            self._pages_ref,
+            Type=PdfName("Pages"),
+            Count=len(self._page_refs),
+            Kids=self._page_refs,
+        )
+        self._write_obj(self._catalog_ref, Type=PdfName("Catalog"), Pages=self._pages_ref)
+
+        info_ref = self._allocate()
+        now = time.gmtime()
+        info = PdfDict(CreationDate=now, ModDate=now)
+        if self._title:
+            info.Title = PdfParser.encode_text(self._title)
+        self._write_obj(info_ref, info)
+
+        xref_offset = self._offset
+        lines = [b"xref\n", b"0 %d\n" % self._next_id, b"0000000000 65535 f \n"]
+        for object_id in range(1, self._next_id):
+            lines.append(b"%010d 00000 n \n" % self._xref[object_id])
+        self._write(b"".join(lines))
+        self._write(b"trailer\n")
+        self._write(pdf_repr(PdfDict(Size=self._next_id, Root=self._catalog_ref, Info=info_ref)))
+        self._write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+
+        if hasattr(self._fp, "flush"):
+            self._fp.flush()
@@ -0,0 +1,250 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+import io
+import json
+import os
+
+from tools import compress_pdf as compress
+from tools import image_to_pdf as images
+from tools import merge_pdf as merge
+from tools.file_io import JobCost, Source, Target, source_size
+from tools.instrument import ProgressCallback, stage
+from tools.optimize_pdf import OPTIMIZE_LEVELS
+
+# Name under which stages are reported (see tools.instrument)
+TOOL = "pipeline"
+
+# Input reference to the result of the step before
+PREVIOUS = "previous"
+MAX_STEPS = 10
+
+# Options each operation accepts; anything else is rejected
+OPERATION_OPTIONS = {
+    "image-to-pdf": ("resize_quality",),
+    "merge-pdf": ("optimize_level",),
+    "compress-pdf": ("dpi", "image_quality", "color_mode", "optimize_level"),
+}
+OPTION_TYPES = {
+    "resize_quality": str,
+    "optimize_level": int,
+    "dpi": int,
+    "image_quality": int,
+    "color_mode": str,
+}
+
+# Upper bound of one decoded page image in a PDF made by image-to-pdf
+_IMAGE_PAGE_BYTES = images.MAX_DIMENSION * images.MAX_DIMENSION * 3
+
+
+class Step(NamedTuple):
+    """One operation of a pipeline."""
+    operation: str
+    inputs: Tuple[Union[int, str], ...]  # upload indices or PREVIOUS
+    options: Dict[str, Any]
+
+
+def _check_option(name: str, value: Any) -> None:
+    expected = OPTION_TYPES[name]
+    if not isinstance(value, expected) or isinstance(value, bool):
+        raise ValueError(f"{name} must be a{'n integer' if expected is int else ' string'}")
+    if name == "resize_quality" and value not in images.RESIZE_QUALITY_PRESETS:
+        raise ValueError(f"resize_quality must be one of: {', '.join(images.RESIZE_QUALITY_PRESETS)}")
+    if name == "optimize_level" and value not in OPTIMIZE_LEVELS:
+        raise ValueError(f"optimize_level must be one of: {', '.join(map(str, OPTIMIZE_LEVELS))}")
+    if name == "dpi" and not compress.MIN_DPI <= value <= compress.MAX_DPI:
+        raise ValueError(f"dpi must be between {compress.MIN_DPI} and {compress.MAX_DPI}")
+    if name == "image_quality" and not compress.MIN_IMAGE_QUALITY <= value <= compress.MAX_IMAGE_QUALITY:
+        raise ValueError(
+            f"image_quality must be between {compress.MIN_IMAGE_QUALITY} and {compress.MAX_IMAGE_QUALITY}"
+        )
+    if name == "color_mode" and value not in compress.COLOR_MODES:
+        raise ValueError(f"color_mode must be one of: {', '.join(compress.COLOR_MODES)}")
+
+
+def parse_steps(spec: Union[str, List[dict]]) -> List[Step]:
+    """
+    Parse and validate a pipeline: a list (or its JSON) of steps such as
+
+        [{"op": "image-to-pdf", "inputs": [1, 2, 3]},
+         {"op": "merge-pdf", "inputs": [0, "previous"]},
+         {"op": "compress-pdf", "dpi": 100}]
+
+    Inputs are indices of the uploaded files, in upload order, or
+    "previous" for the result of the step before, which every step after
+    the first must use. compress-pdf takes one input and defaults to
+    "previous". Other keys are the operation's options, as accepted by its
+    own endpoint.
+
+    Raises:
+        ValueError: If the pipeline is not valid
+    """
+    if isinstance(spec, str):
+        try:
+            spec = json.loads(spec)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"steps is not valid JSON: {e}")
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("steps must be a non-empty list")
+    if len(spec) > MAX_STEPS:
+        raise ValueError(f"Too many steps. Limit is {MAX_STEPS}")
+
+    steps = []
+    for number, item in enumerate(spec, start=1):
+        if not isinstance(item, dict):
+            raise ValueError(f"Step {number} must be an object")
+        options = dict(item)
+        operation = options.pop("op", None)
+        if operation not in OPERATION_OPTIONS:
+            raise ValueError(f"Step {number}: op must be one of: {', '.join(OPERATION_OPTIONS)}")
+
+        default = [PREVIOUS] if operation == "compress-pdf" and number > 1 else None
+        inputs = options.pop("inputs", default)
+        if not isinstance(inputs, list) or not inputs:
+            raise ValueError(f"Step {number}: inputs must be a non-empty list")
+        for ref in inputs:
+            if ref == PREVIOUS:
+                if number == 1:
+                    raise ValueError("Step 1 cannot use the previous result")
+                if operation == "image-to-pdf":
+                    raise ValueError(f"Step {number}: image-to-pdf takes uploaded images only")
+            elif not isinstance(ref, int) or isinstance(ref, bool) or ref < 0:
+                raise ValueError(f"Step {number}: inputs must be upload indices or \"{PREVIOUS}\"")
+        if number > 1 and PREVIOUS not in inputs:
+            raise ValueError(f"Step {number} must use the previous result")
+        if operation == "merge-pdf" and len(inputs) < 2:
+            raise ValueError(f"Step {number}: merge-pdf needs at least 2 inputs")
+        if operation == "compress-pdf" and len(inputs) != 1:
+            raise ValueError(f"Step {number}: compress-pdf takes exactly 1 input")
+
+        for name, value in options.items():
+            if name not in OPERATION_OPTIONS[operation]:
+                raise ValueError(f"Step {number}: unknown option for {operation}: {name}")
+            try:
+                _check_option(name, value)
+            except ValueError as e:
+                raise ValueError(f"Step {number}: {e}")
+        steps.append(Step(operation, tuple(inputs), options))
+    return steps
+
+
+def check_inputs(steps: List[Step], kinds: List[str]) -> None:
+    """
+    Check the steps' upload indices against the uploaded files, given
+    the kind ('image' or 'pdf') of each.
+
+    Raises:
+        ValueError: If an index is out of range or refers to the wrong kind of file
+    """
+    for number, step in enumerate(steps, start=1):
+        expected = "image" if step.operation == "image-to-pdf" else "pdf"
+        for ref in step.inputs:
+            if ref == PREVIOUS:
+                continue
+            if ref >= len(kinds):
+                raise ValueError(f"Step {number}: there is no upload {ref} ({len(kinds)} files uploaded)")
+            if kinds[ref] != expected:
+                raise ValueError(f"Step {number}: upload {ref} is not {'an image' if expected == 'image' else 'a PDF'}")
+
+
+def estimate_cost(steps: List[Step], sources: List[Source], workers: Optional[int] = None) -> JobCost:
+    """
+    Estimate the cost of run_pipeline from the uploads' headers and page
+    trees. Intermediate results are assumed to be as large as their inputs;
+    the peak memory is that of the costliest step plus the previous result
+    it holds.
+
+    Raises:
+        InputTooLarge: If an image is too large (see image_to_pdf.estimate_cost)
+        ValueError: If an upload cannot be read
+    """
+    workers = workers or os.cpu_count() or 1
+    peak = pixels = 0
+    used = set()
+    # Size, page count and largest image of the previous result
+    previous = (0, 0, 0)
+
+    for step in steps:
+        uploads = [ref for ref in step.inputs if ref != PREVIOUS]
+        used.update(uploads)
+        held, held_pages, held_image = previous if PREVIOUS in step.inputs else (0, 0, 0)
+
+        if step.operation == "image-to-pdf":
+            cost = images.estimate_cost(
+                [sources[ref] for ref in uploads],
+                resize_quality=step.options.get("resize_quality", images.DEFAULT_RESIZE_QUALITY)
+            )
+            pixels += cost.pixels
+            memory = cost.memory
+            previous = (cost.input_bytes, cost.pages, _IMAGE_PAGE_BYTES)
+        elif step.operation == "merge-pdf":
+            size, pages, largest = held, held_pages, held_image
+            for ref in uploads:
+                cost = compress.estimate_cost(sources[ref], workers=1)
+                pixels += cost.pixels
+                size += cost.input_bytes
+                pages += cost.pages
+                largest = max(largest, cost.largest_image)
+            memory = size * merge.MEMORY_PER_INPUT_BYTE + pages * merge.MEMORY_PER_PAGE
+            previous = (size, pages, largest)
+        elif uploads:
+            cost = compress.estimate_cost(sources[uploads[0]], workers=workers)
+            pixels += cost.pixels
+            memory = cost.memory
+            previous = (cost.input_bytes, cost.pages, cost.largest_image)
+        else:
+            memory = (
+                held * compress.MEMORY_PER_INPUT_BYTE
+                + held_pages * compress.MEMORY_PER_PAGE
+                + workers * held_image * 2
+            )
+        peak = max(peak, memory + held)
+
+    input_bytes = sum(source_size(sources[ref]) for ref in used)
+    return JobCost(peak, input_bytes, max(previous[1], 1), pixels)
+
+
+def run_pipeline(
+    steps: List[Step],
+    sources: List[Source],
+    output_path: Target,
+    image_workers: int = 1,
+    progress: Optional[ProgressCallback] = None
+) -> None:
+    """
+    Run the steps of a pipeline one after the other in this process.
+
+    Each intermediate result is kept in memory and handed straight to the
+    next step; only the last step writes to output_path. Intermediate
+    results are written without lossless optimization, since the last step
+    optimizes the whole document anyway (its optimize_level applies).
+
+    Args:
+        steps: The validated steps (see parse_steps and check_inputs)
+        sources: The uploaded files, each a path, bytes or binary file
+        output_path: Path where the final PDF should be saved, or a
+            writable binary file
+        image_workers: Worker processes for image-to-pdf steps
+        progress: Receives each step's Progress, with the step named in
+            its stage, e.g. "merge-pdf (2/3): read"
+    """
+    previous: Optional[bytes] = None
+    for number, step in enumerate(steps, start=1):
+        inputs = [previous if ref == PREVIOUS else sources[ref] for ref in step.inputs]
+        last = number == len(steps)
+        output = output_path if last else io.BytesIO()
+        options = dict(step.options)
+        if not last and step.operation != "image-to-pdf":
+            options["optimize_level"] = 0
+        if progress is not None:
+            prefix = f"{step.operation} ({number}/{len(steps)}): "
+            options["progress"] = lambda p, prefix=prefix: progress(p._replace(stage=prefix + p.stage))
+
+        with stage(TOOL, step.operation):
+            if step.operation == "image-to-pdf":
+                images.convert_images_to_pdf(inputs, output, workers=image_workers, **options)
+            elif step.operation == "merge-pdf":
+                merge.merge_pdfs(inputs, output, **options)
+            else:
+                compress.compress_pdf(inputs[0], output, **options)
+
+        del inputs
+        previous = None if last else output.getvalue()
@@ -0,0 +1,326 @@
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+import hashlib
+import io
+import logging
+import os
+import uuid
+
+import aiofiles
+from fastapi import HTTPException, Request
+from python_multipart.multipart import MultipartParseError, MultipartParser, parse_options_header
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_FILE_BYTES = int(os.environ.get("MAX_UPLOAD_FILE_BYTES", str(100 * 1024 * 1024)))
+MAX_UPLOAD_REQUEST_BYTES = int(os.environ.get("MAX_UPLOAD_REQUEST_BYTES", str(500 * 1024 * 1024)))
+MAX_UPLOAD_FILES = int(os.environ.get("MAX_UPLOAD_FILES", "100"))
+# Requests up to this size are kept in memory and never written to disk (0 disables)
+IN_MEMORY_MAX_BYTES = int(os.environ.get("IN_MEMORY_MAX_BYTES", str(10 * 1024 * 1024)))
+
+ALLOWED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp"}
+
+# Leading bytes of each accepted format
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"BM")
+PDF_SIGNATURE = b"%PDF-"
+# Readers accept the PDF header anywhere in the first 1024 bytes
+PDF_HEADER_WINDOW = 1024
+ZIP_SIGNATURE = b"PK\x03\x04"
+
+
+class StoredUpload(NamedTuple):
+    """An uploaded file, written to the job's workspace or held in memory."""
+    filename: str
+    path: Optional[str]
+    size: int
+    sha256: str
+    data: Optional[bytes] = None
+
+    @property
+    def source(self) -> Union[str, bytes]:
+        """What to hand to the tools: the file's bytes if in memory, else its path."""
+        return self.data if self.data is not None else self.path
+
+
+def upload_kind(filename: str) -> str:
+    """'pdf', 'zip' or 'image', from the extension of an upload received with kind 'any' or 'batch'."""
+    ext = os.path.splitext(filename)[1].lower()
+    return {".pdf": "pdf", ".zip": "zip"}.get(ext, "image")
+
+
+def _check_extension(filename: str, kind: str) -> str:
+    ext = os.path.splitext(filename)[1].lower()
+    if kind == "any" and ext not in ALLOWED_IMAGE_EXTENSIONS | {".pdf"}:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type: {filename}. Allowed: PDF, JPG, PNG, GIF, BMP"
+        )
+    if kind == "batch" and ext not in ALLOWED_IMAGE_EXTENSIONS | {".pdf", ".zip"}:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type: {filename}. Allowed: ZIP, PDF, JPG, PNG, GIF, BMP"
+        )
+    if kind == "image" and ext not in ALLOWED_IMAGE_EXTENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type: {filename}. Allowed: JPG, PNG, GIF, BMP"
+        )
+    if kind == "pdf" and ext != ".pdf":
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type: {filename}. Only PDF files allowed"
+        )
+    return ext
+
+
+def has_valid_signature(head: bytes, kind: str) -> bool:
+    """Whether the leading bytes of a file match its kind ('image', 'pdf' or 'zip')."""
+    if kind == "image":
+        return head.startswith(IMAGE_SIGNATURES)
+    if kind == "zip":
+        return head.startswith(ZIP_SIGNATURE)
+    return PDF_SIGNATURE in head[:PDF_HEADER_WINDOW]
+
+
+class _PartWriter:
+    """
+    Streams one file part to disk (or into a memory buffer) while hashing
+    it and checking its signature.
+    """
+
+    def __init__(self, filename: str, kind: str, directory: Optional[Path]):
+        self.filename = filename
+        ext = _check_extension(filename, kind)
+        # Uploads of kind 'any' or 'batch' must match the format their extension names
+        self.kind = upload_kind(filename) if kind in ("any", "batch") else kind
+        self.path = directory / f"{uuid.uuid4()}{ext}" if directory is not None else None
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._head = b""
+        self._checked = False
+        self._file = None
+        self._buffer = io.BytesIO() if directory is None else None
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > MAX_UPLOAD_FILE_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large: {self.filename}. Limit is {MAX_UPLOAD_FILE_BYTES} bytes"
+            )
+        if not self._checked:
+            self._head += data[:PDF_HEADER_WINDOW]
+            if len(self._head) >= PDF_HEADER_WINDOW:
+                self._check_signature()
+        self._digest.update(data)
+        if self._buffer is not None:
+            self._buffer.write(data)
+            return
+        if self._file is None:
+            self._file = await aiofiles.open(self.path, "wb")
+        await self._file.write(data)
+
+    def _check_signature(self) -> None:
+        self._checked = True
+        if not has_valid_signature(self._head, self.kind):
+            expected = {"image": "an image", "pdf": "a PDF", "zip": "a ZIP archive"}[self.kind]
+            raise HTTPException(status_code=400, detail=f"File is not {expected}: {self.filename}")
+
+    async def finish(self) -> StoredUpload:
+        if not self._checked:
+            self._check_signature()
+        if self._buffer is not None:
+            return StoredUpload(
+                self.filename, None, self.size, self._digest.hexdigest(), self._buffer.getvalue()
+            )
+        if self._file is not None:
+            await self._file.close()
+        return StoredUpload(self.filename, str(self.path), self.size, self._digest.hexdigest())
+
+    async def abort(self) -> None:
+        if self._buffer is not None:
+            return
+        if self._file is not None:
+            await self._file.close()
+        self.path.unlink(missing_ok=True)
+
+
+def remove_uploads(uploads: List[StoredUpload]) -> None:
+    for upload in uploads:
+        if upload.path is not None:
+            Path(upload.path).unlink(missing_ok=True)
+
+
+def spill_uploads(uploads: List[StoredUpload], directory: Path) -> List[StoredUpload]:
+    """Write in-memory uploads to files in directory, e.g. to hand them to a Celery job."""
+    spilled = []
+    for upload in uploads:
+        if upload.data is not None:
+            path = directory / f"{uuid.uuid4()}{os.path.splitext(upload.filename)[1].lower()}"
+            path.write_bytes(upload.data)
+            upload = upload._replace(path=str(path), data=None)
+        spilled.append(upload)
+    return spilled
+
+
+def fits_in_memory(request: Request, limit: int) -> bool:
+    """Whether the request declares a body of at most limit bytes."""
+    content_length = request.headers.get("content-length", "")
+    return content_length.isdigit() and int(content_length) <= limit
+
+
+def _part_name_and_filename(headers: Dict[bytes, bytes]) -> Tuple[Optional[str], Optional[str]]:
+    _, options = parse_options_header(headers.get(b"content-disposition", b""))
+    name = options.get(b"name")
+    filename = options.get(b"filename")
+    return (
+        name.decode("utf-8", "replace") if name is not None else None,
+        filename.decode("utf-8", "replace") if filename is not None else None,
+    )
+
+
+async def receive_uploads(
+    request: Request,
+    field: str,
+    kind: str,
+    directory: Optional[Path],
+    min_files: int = 1,
+    max_files: int = MAX_UPLOAD_FILES
+) -> List[StoredUpload]:
+    """
+    Stream the file parts of a multipart/form-data request straight into
+    directory in a single pass.
+
+    Each part is written once, asynchronously, as it arrives; its SHA-256
+    is computed on the way and its leading bytes are checked against the
+    expected format. Oversized, malformed or mistyped uploads abort the
+    request as soon as they are detected and everything written so far is
+    removed. Parts under other field names are skipped.
+
+    Without a directory the files are kept in memory and never touch the
+    disk; use fits_in_memory() to decide.
+
+    Args:
+        request: Incoming request whose body has not been read yet
+        field: Form field holding the files
+        kind: 'image', 'pdf', 'any' (either, checked against the extension)
+            or 'batch' (also ZIP archives)
+        directory: Where to write the files, or None to keep them in memory
+        min_files: Fewest files accepted
+        max_files: Most files accepted
+
+    Returns:
+        The stored files, in upload order
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+    # The parser is synchronous and reports through callbacks; collect its
+    # events per chunk and act on them (with awaits) after each write
+    events: List[Tuple[str, Any]] = []
+    header_field = bytearray()
+    header_value = bytearray()
+
+    def on_header_value_end() -> None:
+        events.append(("header", (bytes(header_field).lower(), bytes(header_value))))
+        header_field.clear()
+        header_value.clear()
+
+    callbacks = {
+        "on_part_begin": lambda: events.append(("begin", b"")),
+        "on_part_data": lambda data, start, end: events.append(("data", bytes(data[start:end]))),
+        "on_part_end": lambda: events.append(("end", b"")),
+        "on_header_field": lambda data, start, end: header_field.extend(data[start:end]),
+        "on_header_value": lambda data, start, end: header_value.extend(data[start:end]),
+        "on_header_end": on_header_value_end,
+        "on_headers_finished": lambda: events.append(("headers_done", b"")),
+        "on_end": lambda: events.append(("done", b"")),
+    }
+    parser = MultipartParser(boundary, callbacks)
+
+    stored: List[StoredUpload] = []
+    headers: Dict[bytes, bytes] = {}
+    current: Optional[_PartWriter] = None
+    received = 0
+    complete = False
+
+    async def handle_events() -> None:
+        nonlocal headers, current, complete
+        for event, data in events:
+            if event == "begin":
+                headers = {}
+            elif event == "header":
+                headers[data[0]] = data[1]
+            elif event == "headers_done":
+                name, filename = _part_name_and_filename(headers)
+                if name != field or filename is None:
+                    continue
+                if not filename:
+                    raise HTTPException(status_code=400, detail="Filename is required")
+                if len(stored) >= max_files:
+                    raise HTTPException(status_code=400, detail=f"Too many files. Limit is {max_files}")
+                current = _PartWriter(filename, kind, directory)
+            elif event == "data" and current is not None:
+                await current.write(data)
+            elif event == "end" and current is not None:
+                stored.append(await current.finish())
+                current = None
+            elif event == "done":
+                complete = True
+        events.clear()
+
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_UPLOAD_REQUEST_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Request too large. Limit is {MAX_UPLOAD_REQUEST_BYTES} bytes"
+                )
+            try:
+                parser.write(chunk)
+            except MultipartParseError as e:
+                raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+            await handle_events()
+
+        if not complete:
+            raise HTTPException(status_code=400, detail="Upload was incomplete")
+        if not stored:
+            raise HTTPException(status_code=400, detail="No files provided")
+        if len(stored) < min_files:
+            noun = {"pdf": "PDF files", "image": "images"}.get(kind, "files")
+            raise HTTPException(status_code=400, detail=f"At least {min_files} {noun} required")
+    except BaseException:
+        if current is not None:
+            await current.abort()
+        remove_uploads(stored)
+        raise
+
+    logger.debug(f"Received {len(stored)} files ({received} bytes)")
+    return stored
+
+
+def multipart_openapi(field: str, many: bool = True) -> dict:
+    """
+    OpenAPI request body for endpoints that read their uploads with
+    receive_uploads(), which FastAPI cannot infer from the signature.
+    """
+    file_schema = {"type": "string", "format": "binary"}
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": [field],
+                        "properties": {
+                            field: {"type": "array", "items": file_schema} if many else file_schema
+                        },
+                    }
+                }
+            },
+        }
+    }
@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 """
-Script to verify Celery worker, beat, and Redis are properly configured and running.
+Script to verify the Celery workers and Redis are properly configured and running.
 """
 import sys
 import subprocess
 import time
 from redis import Redis
-from celery_app import celery_app
+from celery_app import QUEUE_TIME_LIMITS, celery_app
+
+# Tasks the workers must have registered (see tasks.py)
+EXPECTED_TASKS = (
+    "tasks.process_image_to_pdf",
+    "tasks.process_merge_pdf",
+    "tasks.process_compress_pdf",
+    "tasks.process_pipeline",
+)
 
 
 def check_redis():
@@ -55,18 +63,22 @@ def check_celery_worker():
         return False
 
 
-def check_celery_beat():
-    """Check if Celery beat is configured"""
-    print("\n=== Checking Celery Beat ===")
+def check_celery_config():
+    """Check the queues and their time limits; nothing should be scheduled on beat"""
+    print("\n=== Checking Celery Configuration ===")
     try:
         conf = celery_app.conf
-        print(f"✓ Celery beat configuration exists")
+        print(f"✓ Celery configuration loaded")
         print(f"  - Timezone: {conf.timezone}")
-        print(f"  - Task time limit: {conf.task_time_limit}s")
-        print(f"  - Task soft time limit: {conf.task_soft_time_limit}s")
+        for queue, (soft, hard) in QUEUE_TIME_LIMITS.items():
+            print(f"  - Queue {queue}: {soft}s soft / {hard}s hard time limit")
+        if conf.beat_schedule:
+            print(f"✗ Unexpected beat schedule: {list(conf.beat_schedule)}")
+            return False
+        print(f"  - No beat schedule: expired job files are swept by the API's workspace cleaner")
         return True
     except Exception as e:
-        print(f"✗ Celery beat check failed: {e}")
+        print(f"✗ Celery configuration check failed: {e}")
         return False
 
 
@@ -74,14 +86,16 @@ def test_background_task():
     """Test a sample background task"""
     print("\n=== Testing Background Task ===")
     try:
-        from tasks import process_image_to_pdf
+        import tasks  # noqa: F401  registers the tasks
         
+        missing = [name for name in EXPECTED_TASKS if name not in celery_app.tasks]
+        if missing:
+            print(f"✗ Tasks not registered: {', '.join(missing)}")
+            return False
         print("✓ Celery tasks are importable")
         print(f"  - Available tasks:")
-        print(f"    - process_image_to_pdf")
-        print(f"    - process_merge_pdf")
-        print(f"    - process_compress_pdf")
-        print(f"    - cleanup_old_files")
+        for name in EXPECTED_TASKS:
+            print(f"    - {name}")
         return True
     except Exception as e:
         print(f"✗ Task import failed: {e}")
@@ -97,7 +111,7 @@ def main():
     results = {
         "Redis": check_redis(),
         "Celery Worker": check_celery_worker(),
-        "Celery Beat": check_celery_beat(),
+        "Celery Config": check_celery_config(),
         "Background Tasks": test_background_task()
     }
     
@@ -118,8 +132,9 @@ def main():
         print("✗ SOME CHECKS FAILED - Please review errors above")
         print("\nTo start services:")
         print("  1. Redis:  redis-server --daemonize yes")
-        print("  2. Celery Worker:  celery -A celery_app worker --loglevel=info")
-        print("  3. Celery Beat:  celery -A celery_app beat --loglevel=info")
+        print("  2. Celery Workers, one per queue:")
+        print("     celery -A celery_app worker -Q pdf_fast -n fast@%h --loglevel=info --concurrency=2")
+        print("     celery -A celery_app worker -Q pdf_bulk -n bulk@%h --loglevel=info --concurrency=1")
     print("=" * 60)
     
     return 0 if all_passed else 1
@@ -0,0 +1,208 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+import asyncio
+import fcntl
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+WORKSPACE_DIR = os.environ.get("WORKSPACE_DIR", "workspaces")
+# How long a job's files are kept; synchronous requests normally remove
+# theirs right away and only fall back to this after a crash
+WORKSPACE_TTL = int(os.environ.get("WORKSPACE_TTL", "3600"))
+# How long a background job's inputs are kept while it waits in its queue;
+# once it starts, and again once it succeeds, it gets WORKSPACE_TTL more
+JOB_QUEUE_TTL = int(os.environ.get("JOB_QUEUE_TTL", "86400"))
+CLEANUP_INTERVAL = int(os.environ.get("CLEANUP_INTERVAL", "60"))
+
+# Expired workspaces removed per index transaction
+SWEEP_BATCH = 100
+
+
+class Workspace(NamedTuple):
+    """A job's private directory for its inputs and outputs."""
+    job_id: str
+    path: Path
+
+
+def _tree_size(path: Path) -> int:
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class WorkspaceStore:
+    """
+    Per-job workspace directories with an expiry index.
+
+    Every job gets directory/<job_id>/ and a row in a SQLite index next to
+    the workspaces recording when it expires. Expired jobs are found with an
+    indexed range query, so a sweep costs O(expired jobs) instead of a stat
+    of every file on disk. The index is shared by all API and Celery worker
+    processes on the host; only one of them, elected through an exclusive
+    lock on cleaner.lock, runs the sweeps.
+    """
+
+    def __init__(self, directory: str, ttl: int):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._db_path = self.directory / "index.sqlite3"
+        self._lock_path = self.directory / "cleaner.lock"
+        self._lock_fd: Optional[int] = None
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS workspaces ("
+                " job_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS workspaces_expiry ON workspaces (expires_at)")
+            db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            db.execute(
+                "INSERT OR IGNORE INTO counters (name, value) VALUES"
+                " ('expired', 0), ('reclaimed_bytes', 0)"
+            )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def path_for(self, job_id: str) -> Path:
+        return self.directory / job_id
+
+    def create(self, job_id: Optional[str] = None, ttl: Optional[int] = None) -> Workspace:
+        """
+        Create a workspace that expires after ttl seconds (default: the
+        store's ttl). The index row is written first, so a crash can never
+        leave a directory the cleaner does not know about.
+        """
+        job_id = job_id or str(uuid.uuid4())
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO workspaces (job_id, expires_at) VALUES (?, ?)",
+                (job_id, expires_at),
+            )
+        path = self.path_for(job_id)
+        path.mkdir(parents=True, exist_ok=True)
+        return Workspace(job_id, path)
+
+    def extend(self, job_id: str, ttl: Optional[int] = None) -> bool:
+        """
+        Keep a workspace for at least ttl more seconds (default: the
+        store's ttl); an expiry further away is left alone.
+
+        Returns:
+            Whether the workspace still exists in the index
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._transaction() as db:
+            updated = db.execute(
+                "UPDATE workspaces SET expires_at = MAX(expires_at, ?) WHERE job_id = ?",
+                (expires_at, job_id),
+            ).rowcount
+        return updated > 0
+
+    def remove(self, job_id: str) -> None:
+        """Delete a workspace right away, e.g. once its response has been sent."""
+        shutil.rmtree(self.path_for(job_id), ignore_errors=True)
+        with self._transaction() as db:
+            db.execute("DELETE FROM workspaces WHERE job_id = ?", (job_id,))
+
+    def sweep(self, now: Optional[float] = None) -> dict:
+        """
+        Delete every workspace whose expiry has passed.
+
+        Returns:
+            Number of workspaces removed and bytes reclaimed
+        """
+        now = time.time() if now is None else now
+        removed = reclaimed = 0
+        while True:
+            with self._transaction() as db:
+                expired = [
+                    row[0] for row in db.execute(
+                        "SELECT job_id FROM workspaces WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                        (now, SWEEP_BATCH),
+                    )
+                ]
+            # Delete outside the transaction so other processes are not blocked
+            for job_id in expired:
+                path = self.path_for(job_id)
+                reclaimed += _tree_size(path)
+                shutil.rmtree(path, ignore_errors=True)
+            with self._transaction() as db:
+                db.executemany("DELETE FROM workspaces WHERE job_id = ?", [(job_id,) for job_id in expired])
+            removed += len(expired)
+            if len(expired) < SWEEP_BATCH:
+                break
+
+        if removed:
+            with self._transaction() as db:
+                db.execute("UPDATE counters SET value = value + ? WHERE name = 'expired'", (removed,))
+                db.execute("UPDATE counters SET value = value + ? WHERE name = 'reclaimed_bytes'", (reclaimed,))
+            logger.info(f"Removed {removed} expired workspaces, reclaimed {reclaimed} bytes")
+        return {"removed": removed, "reclaimed_bytes": reclaimed}
+
+    def try_become_cleaner(self) -> bool:
+        """
+        Try to take the cleaner role for this process. The lock is held
+        until the process exits, after which another process takes over.
+        """
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        logger.info(f"Process {os.getpid()} is the workspace cleaner")
+        return True
+
+    def stats(self) -> dict:
+        with self._transaction() as db:
+            counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+            active, next_expiry = db.execute(
+                "SELECT COUNT(*), MIN(expires_at) FROM workspaces"
+            ).fetchone()
+        return {**counters, "active": active, "next_expiry": next_expiry}
+
+
+async def run_cleaner(store: "WorkspaceStore", interval: int = CLEANUP_INTERVAL) -> None:
+    """
+    Started in every API worker; only the elected one sweeps. The others
+    keep trying to take the role so cleanup continues if the cleaner exits.
+    """
+    while True:
+        try:
+            if await asyncio.to_thread(store.try_become_cleaner):
+                await asyncio.to_thread(store.sweep)
+        except Exception as e:
+            logger.error(f"Workspace cleanup error: {e}")
+        await asyncio.sleep(interval)
+
+
+workspace_store = WorkspaceStore(WORKSPACE_DIR, WORKSPACE_TTL)